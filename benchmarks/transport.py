@@ -0,0 +1,188 @@
+"""Compares the cost of fetching ranges into a file through requests with
+the raw transport, and of uploading them, against a local server so the
+network is not the bottleneck.
+
+    python benchmarks/transport.py [--size MiB] [--chunk KiB] [--ranges N]
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+
+from spry import transport  # noqa: E402
+from spry.io import FileAdapter, HTTPAdapter  # noqa: E402
+from spry.transport import SPLICE, ConnectionPool, RawAdapter, RawUploadAdapter  # noqa: E402
+
+MEBIBYTE = 1024 ** 2
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        data = self.server.data
+        start, end = 0, len(data) - 1
+
+        header = self.headers.get('range')
+        if header:
+            first, _, last = header.split('=', 1)[1].partition('-')
+            start, end = int(first), min(int(last or end), end)
+
+        view = memoryview(data)[start:end + 1]
+        self.send_response(206 if header else 200)
+        self.send_header('Content-Length', str(len(view)))
+        self.end_headers()
+        self.wfile.write(view)
+
+    def do_PUT(self):
+        remaining = int(self.headers['content-length'])
+        buffer = bytearray(MEBIBYTE)
+        while remaining:
+            remaining -= self.rfile.readinto(memoryview(buffer)[:min(remaining, MEBIBYTE)])
+
+        self.send_response(204)
+        self.end_headers()
+
+
+def consume(adapter, fd, offset, chunk_size, mode):
+    if mode == 'splice':
+        while True:
+            moved = adapter.splice(fd, offset, chunk_size)
+            if not moved:
+                break
+            offset += moved
+    elif mode == 'readinto':
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        while True:
+            received = adapter.readinto(buffer)
+            if not received:
+                break
+            offset += os.pwrite(fd, view[:received], offset)
+    else:
+        while True:
+            chunk = adapter.read(chunk_size)
+            if not chunk:
+                break
+            offset += os.pwrite(fd, chunk, offset)
+    adapter.close()
+
+
+def measure(name, create, fd, size, ranges, chunk_size, mode='read'):
+    range_size = size // ranges
+    start = time.time()
+    cpu = time.process_time() if hasattr(time, 'process_time') else time.clock()
+
+    for i in range(ranges):
+        headers = {'range': 'bytes={}-{}'.format(i * range_size, (i + 1) * range_size - 1)}
+        consume(create(headers), fd, i * range_size, chunk_size, mode)
+
+    elapsed = time.time() - start
+    cpu = (time.process_time() if hasattr(time, 'process_time') else time.clock()) - cpu
+    chunks = size // chunk_size
+
+    print('{:<24} {:>8.1f} MiB/s {:>8.2f} us/chunk {:>8.2f} us cpu/chunk'.format(
+        name, size / MEBIBYTE / elapsed, elapsed / chunks * 1e6, cpu / chunks * 1e6
+    ))
+
+
+def measure_upload(name, url, pool, path, size, ranges, chunk_size, mode):
+    range_size = size // ranges
+    source = FileAdapter(path, 'rb', buffering=0)
+    fd = source.fileno()
+
+    transport.SENDFILE = mode == 'sendfile'
+    start = time.time()
+    cpu = time.process_time() if hasattr(time, 'process_time') else time.clock()
+
+    for i in range(ranges):
+        offset = i * range_size
+        headers = {'Content-Range': 'bytes {}-{}/{}'.format(offset, offset + range_size - 1, size)}
+        adapter = RawUploadAdapter(url, source, range_size, pool, headers=headers)
+
+        for position in range(offset, offset + range_size, chunk_size):
+            nbytes = min(chunk_size, offset + range_size - position)
+            if mode == 'read':
+                adapter.connection.send(os.pread(fd, nbytes, position))
+            else:
+                adapter.send_file(position, nbytes)
+
+        adapter.get_response()
+        adapter.close()
+
+    elapsed = time.time() - start
+    cpu = (time.process_time() if hasattr(time, 'process_time') else time.clock()) - cpu
+    chunks = size // chunk_size
+    source.close()
+
+    print('{:<24} {:>8.1f} MiB/s {:>8.2f} us/chunk {:>8.2f} us cpu/chunk'.format(
+        name, size / MEBIBYTE / elapsed, elapsed / chunks * 1e6, cpu / chunks * 1e6
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=256, help='MiB read per transport')
+    parser.add_argument('--chunk', type=int, default=16, help='KiB per read')
+    parser.add_argument('--ranges', type=int, default=64, help='Range requests the size is split into')
+    args = parser.parse_args()
+
+    size = args.size * MEBIBYTE
+    chunk_size = args.chunk * 1024
+
+    # In a process of its own, so only the client's time is measured
+    server = Server(('127.0.0.1', 0), Handler)
+    server.data = os.urandom(size)
+    process = multiprocessing.Process(target=server.serve_forever)
+    process.start()
+    url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    fd, path = tempfile.mkstemp()
+
+    try:
+        session = requests.Session()
+        pool = ConnectionPool()
+
+        def raw(headers):
+            return RawAdapter(url, pool, headers=headers)
+
+        measure('requests', lambda headers: HTTPAdapter(url, session, headers=headers, stream=True),
+                fd, size, args.ranges, chunk_size)
+        measure('raw read', raw, fd, size, args.ranges, chunk_size)
+        measure('raw readinto', raw, fd, size, args.ranges, chunk_size, mode='readinto')
+        if SPLICE:
+            measure('raw splice', raw, fd, size, args.ranges, chunk_size, mode='splice')
+
+        os.pwrite(fd, server.data, 0)
+        measure_upload('upload read', url, pool, path, size, args.ranges, chunk_size, 'read')
+        measure_upload('upload mmap', url, pool, path, size, args.ranges, chunk_size, 'mmap')
+        if hasattr(os, 'sendfile'):
+            measure_upload('upload sendfile', url, pool, path, size, args.ranges, chunk_size, 'sendfile')
+    finally:
+        os.close(fd)
+        os.remove(path)
+        process.terminate()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from spry.db import DATA_DIR, CacheEntry, get_db_session
+from spry.utils import GIBIBYTE, MEBIBYTE, clone_file
+
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+
+# Default number of bytes the cache may hold before evicting
+CACHE_SIZE = GIBIBYTE * 10
+
+HASH_BLOCK_SIZE = MEBIBYTE * 1
+
+
+def hash_file(path, block_size=HASH_BLOCK_SIZE):
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+class DownloadCache:
+    """A local store of downloaded files addressed by their SHA-256, so that
+    the same content fetched from several URLs is only kept once. Each URL
+    remembers the ``ETag`` and ``Last-Modified`` validators it was served
+    with, letting transfers revalidate with a conditional request and copy
+    the cached file instead of downloading it again when the server answers
+    ``304 Not Modified``.
+
+    Files are served by reflink where the file system supports it, which
+    costs no extra space, otherwise by hard link if allowed and finally by
+    copying. Once the cache outgrows ``max_size`` the least recently used
+    files are evicted.
+
+    :param directory: Where cached files are stored. Default: ``cache`` in
+                      the spry data directory
+    :type directory: str
+    :param max_size: The maximum number of bytes to keep. Default: 10 GiB
+    :type max_size: int
+    :param hardlink: Whether or not cache hits may be hard links to cached
+                     files when reflinks are unsupported. Hard links need no
+                     extra space, but modifying the downloaded file also
+                     modifies the cached one. Default: ``False``
+    :type hardlink: bool
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_size=CACHE_SIZE, hardlink=False):
+        self.directory = directory
+        self.max_size = max_size
+        self.hardlink = hardlink
+        self.lock = threading.Lock()
+
+    # Transfers running in worker processes receive a copy
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get_blob_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def lookup(self, url):
+        """Returns the entry cached for ``url`` or ``None``. Entries whose
+        file went missing are forgotten.
+        """
+
+        db = get_db_session()
+        entry = db.query(CacheEntry).filter_by(url=url).first()
+
+        if entry is not None and not os.path.isfile(self.get_blob_path(entry.digest)):
+            db.delete(entry)
+            db.commit()
+            entry = None
+
+        return entry
+
+    @staticmethod
+    def get_validators(entry):
+        """Returns the headers making a request conditional on the cached
+        ``entry`` being out of date.
+        """
+
+        headers = {}
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def serve(self, entry, path):
+        """Places the cached file of ``entry`` at ``path`` and returns
+        whether a reflink, hard link or copy was used.
+        """
+
+        method = clone_file(self.get_blob_path(entry.digest), path, hardlink=self.hardlink)
+
+        entry.last_access = time.time()
+        get_db_session().commit()
+
+        return method
+
+    def store(self, url, path, headers):
+        """Adds the downloaded file at ``path`` to the cache as the content
+        of ``url``. Responses without an ``ETag`` or ``Last-Modified`` header
+        cannot be revalidated and are not stored. Returns the entry or
+        ``None``.
+        """
+
+        etag = headers.get('etag')
+        last_modified = headers.get('last-modified')
+        if not etag and not last_modified:
+            return None
+
+        size = os.path.getsize(path)
+        if size > self.max_size:
+            return None
+
+        digest = hash_file(path)
+        blob_path = self.get_blob_path(digest)
+
+        with self.lock:
+            if not os.path.isfile(blob_path):
+                blob_dir = os.path.dirname(blob_path)
+                if not os.path.exists(blob_dir):
+                    os.makedirs(blob_dir)
+
+                # Never link, the downloaded file is the user's to modify.
+                # The rename makes the blob appear complete or not at all.
+                # Temporary names are unique, as processes share the cache.
+                fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=blob_dir)
+                os.close(fd)
+                try:
+                    clone_file(path, temp_path)
+                    os.rename(temp_path, blob_path)
+                except Exception:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    raise
+
+            db = get_db_session()
+            entry = db.query(CacheEntry).filter_by(url=url).first()
+            if entry is None:
+                entry = CacheEntry(url=url)
+                db.add(entry)
+
+            # The URL's previous content, unless other URLs still have it
+            replaced = entry.digest if entry.digest != digest else None
+
+            entry.digest = digest
+            entry.size = size
+            entry.etag = etag
+            entry.last_modified = last_modified
+            entry.last_access = time.time()
+            db.commit()
+
+            if replaced is not None and db.query(CacheEntry).filter_by(digest=replaced).first() is None:
+                self._remove_blob(replaced)
+
+            self._evict(db)
+
+        return entry
+
+    def _evict(self, db):
+        # Several URLs may share a file, which is as recent as its most
+        # recently used URL.
+        blobs = {}
+        for entry in db.query(CacheEntry):
+            size, last_access = blobs.get(entry.digest, (entry.size, 0))
+            blobs[entry.digest] = (size, max(last_access, entry.last_access or 0))
+
+        total = sum(size for size, _ in blobs.values())
+        if total <= self.max_size:
+            return
+
+        for digest, (size, _) in sorted(blobs.items(), key=lambda item: item[1][1]):
+            db.query(CacheEntry).filter_by(digest=digest).delete()
+            self._remove_blob(digest)
+
+            total -= size
+            if total <= self.max_size:
+                break
+
+        db.commit()
+
+    def _remove_blob(self, digest):
+        try:
+            os.remove(self.get_blob_path(digest))
+        except OSError:
+            pass
+
+    def get_size(self):
+        """Returns the number of bytes held by cached files"""
+
+        sizes = dict(get_db_session().query(CacheEntry.digest, CacheEntry.size))
+        return sum(sizes.values())
@@ -1,19 +1,31 @@
+import json
+import os
 import sys
 import time
+from collections import OrderedDict
+
+try:
+    from queue import Empty, Queue
+except ImportError:  # pragma: no cover
+    from Queue import Empty, Queue
 
 import click
-from requests.auth import HTTPBasicAuth, HTTPDigestAuth
 
-from spry import api
+from spry import api, events
+from spry.hooks import Profiler, SpanExporter, TimingHistogram
+from spry.scheduling import POLICIES, PRIORITY
+from spry.workers import WORKER_THREADS, WorkerPool
 from spry.utils import (
-    BINARY_PREFIX, bytes_to_unit_pair, parse_kwargs, parse_speed_limit, seconds_to_eta_string
+    BINARY_PREFIX, PREALLOCATE_AUTO, PREALLOCATION_MODES, REQUESTS, STATE_CHECK, TRANSPORTS, bytes_to_unit_pair,
+    parse_kwargs, parse_speed_limit, seconds_to_eta_string, unit_pair_to_bytes
 )
 
 
 # TODO: support all
+# Values are names in requests.auth, which is only imported once needed
 AUTH_MAP = {
-    'basic': HTTPBasicAuth,
-    'digest': HTTPDigestAuth,
+    'basic': 'HTTPBasicAuth',
+    'digest': 'HTTPDigestAuth',
     'oauth1': None,
     'kerberos': None,
     'ntlm': None
@@ -23,6 +35,25 @@ GLOBAL_CONTEXT_SETTINGS = {
     'max_content_width': 300
 }
 
+PROGRESS_MODES = ('bar', 'json', 'dashboard')
+
+
+def get_auth(auth_type, username, password):
+    from requests import auth
+
+    return getattr(auth, AUTH_MAP[auth_type])(username, password)
+
+
+def read_urls(f):
+    """Lazily yields URLs from a file, one per line. Blank
+    lines and lines starting with # are skipped.
+    """
+
+    for line in f:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
 
 def get_password(ctx, param, value):
     username = ctx.params.get('username', None)
@@ -36,11 +67,28 @@ def get_password(ctx, param, value):
 @click.option('--limit', '-l', type=(float, click.Choice(BINARY_PREFIX.keys())), default=(0.0, 'KiB'),
               metavar='NUMBER [{}]'.format('|'.join(BINARY_PREFIX.keys())),
               help='Speed limit per second\nDefault: None')
+@click.option('--shared-limit', type=(float, click.Choice(BINARY_PREFIX.keys())), default=(0.0, 'KiB'),
+              metavar='NUMBER [{}]'.format('|'.join(BINARY_PREFIX.keys())),
+              help='Speed limit per second of all spry processes on this host\nDefault: None')
 @click.option('--timeout', '-t', type=int, default=20, help='Number of seconds to wait on a disconnection\nDefault: 20')
+@click.option('--host-limit', type=int, default=0,
+              help='Maximum connections per host across all transfers\nDefault: None')
+@click.option('--preallocate', type=click.Choice(PREALLOCATION_MODES), default=PREALLOCATE_AUTO,
+              help='How disk space is reserved before writing\nDefault: {}'.format(PREALLOCATE_AUTO))
+@click.option('--buffer', '-b', type=(float, click.Choice(BINARY_PREFIX.keys())), default=(1.0, 'MiB'),
+              metavar='NUMBER [{}]'.format('|'.join(BINARY_PREFIX.keys())),
+              help='Data collected per connection before writing to disk\nDefault: 1 MiB')
+@click.option('--threads', type=int, default=WORKER_THREADS,
+              help='Maximum number of connection threads\nDefault: {}'.format(WORKER_THREADS))
+@click.option('--processes', is_flag=True, help='Transfers each file in its own process')
 @click.option('--silent', '-s', is_flag=True, help='Disables progress updates')
+@click.option('--progress', type=click.Choice(PROGRESS_MODES), default='bar',
+              help='A single line, an event per line as JSON, or a line per file\nDefault: bar')
 @click.option('--restart', is_flag=True)
-def spry(restart, parts, limit, timeout, silent):
-    pass
+def spry(restart, parts, limit, shared_limit, timeout, host_limit, preallocate, buffer, threads, processes, silent,
+         progress):
+    if processes and host_limit:
+        raise click.UsageError('--host-limit cannot be used with --processes')
 
 
 @spry.group(chain=True, short_help='Connect via HTTP(S)', context_settings=GLOBAL_CONTEXT_SETTINGS)
@@ -55,39 +103,178 @@ def http(username, password, auth, secure):
 
 @http.command(context_settings=GLOBAL_CONTEXT_SETTINGS)
 @click.pass_context
-@click.option('--url', '-u', required=True, multiple=True)
+@click.option('--url', '-u', multiple=True)
+@click.option('--input', '-i', 'input_file', type=click.File('r'),
+              help='File with a URL per line, read as transfers finish. Use - for stdin')
 @click.option('--path', '-p', required=True)
 @click.option('--persist/--new', default=True)
-def get(ctx, url, path, persist):
+@click.option('--policy', type=click.Choice(POLICIES), default=PRIORITY,
+              help='Order in which queued files are started\nDefault: {}'.format(PRIORITY))
+@click.option('--cache', is_flag=True, help='Reuses unmodified files from a local download cache')
+@click.option('--hedge', is_flag=True, help='Races slow parts with a duplicate request')
+@click.option('--profile', type=click.Path(dir_okay=False),
+              help='Writes a cProfile of the transfers here and prints timing percentiles')
+@click.option('--trace', type=click.Path(dir_okay=False), help='Appends a span per part as JSON lines here')
+@click.option('--transport', type=click.Choice(TRANSPORTS), default=REQUESTS,
+              help='How parts are fetched, raw uses lean keep-alive connections\nDefault: {}'.format(REQUESTS))
+@click.option('--manifest', is_flag=True, help='Records block hashes to verify and repair files later')
+def get(ctx, url, input_file, path, persist, policy, cache, hedge, profile, trace, transport, manifest):
+    if not url and input_file is None:
+        raise click.UsageError('Provide at least one --url or an --input file')
+
     general_params = ctx.parent.parent.params
     http_params = ctx.parent.params
 
     restart = general_params['restart']
     parts = general_params['parts']
     limit = general_params['limit']
+    shared_limit = unit_pair_to_bytes(general_params['shared_limit'])
     timeout = general_params['timeout']
+    host_limit = general_params['host_limit']
+    preallocate = general_params['preallocate']
+    buffer_size = unit_pair_to_bytes(general_params['buffer'])
+    threads = general_params['threads']
+    processes = general_params['processes']
     silent = general_params['silent']
+    progress = general_params['progress']
 
     username = http_params['username']
     password = http_params['password']
     auth_type = http_params['auth']
     secure = http_params['secure']
 
-    session = api.HTTPSession(concurrent=4, parts=parts, speed_limit=limit, timeout=timeout, restart=restart)
+    hub = events.EventHub() if progress != 'bar' and not silent else None
+
+    session = api.HTTPSession(concurrent=4, parts=parts, speed_limit=limit, timeout=timeout, restart=restart,
+                              host_limit=host_limit, policy=policy, preallocate=preallocate,
+                              buffer_size=buffer_size, threads=threads, processes=processes, cache=cache,
+                              hub=hub, shared_limit=shared_limit, manifest=manifest)
     session.limiter.promote()
 
+    if profile:
+        histogram, profiler = TimingHistogram(), Profiler()
+        session.add_hook(histogram)
+        session.add_hook(profiler)
+        profiler.start()
+    if trace:
+        exporter = SpanExporter(trace)
+        session.add_hook(exporter)
+
+    transfer_kwargs = dict(
+        parts=parts, speed_limit=limit, timeout=timeout, restart=restart, persist=persist,
+        preallocate=preallocate, buffer_size=buffer_size, hedge=hedge, transport=transport,
+        auth=get_auth(auth_type, username, password), verify=secure
+    )
+
     for u in url:
-        session.get(
-            url=u, path=path, parts=parts, speed_limit=limit, timeout=timeout, restart=restart,
-            persist=persist, auth=AUTH_MAP[auth_type](username, password), verify=secure
-        )
+        session.get(url=u, path=path, **transfer_kwargs)
 
-    show_progress(session, method='get', silent=silent)
+    if input_file is not None:
+        session.get_many(read_urls(input_file), path, **transfer_kwargs)
+
+    if hub is not None:
+        show_events(session, hub, mode=progress)
+    else:
+        show_progress(session, method='get', silent=silent)
+
+    if profile:
+        profiler.stop()
+        profiler.dump(profile)
+        print(histogram.format())
+    if trace:
+        exporter.close()
 
 
 @http.command(context_settings=GLOBAL_CONTEXT_SETTINGS)
-def send():
-    print('send')
+@click.pass_context
+@click.option('--url', '-u', required=True, help='Where to PUT the file')
+@click.option('--path', '-p', required=True, type=click.Path(exists=True, dir_okay=False))
+def send(ctx, url, path):
+    general_params = ctx.parent.parent.params
+    http_params = ctx.parent.params
+
+    limit = general_params['limit']
+    silent = general_params['silent']
+    progress = general_params['progress']
+
+    hub = events.EventHub() if progress != 'bar' and not silent else None
+
+    session = api.HTTPSession(concurrent=1, parts=general_params['parts'], speed_limit=limit,
+                              timeout=general_params['timeout'], host_limit=general_params['host_limit'],
+                              threads=general_params['threads'], processes=general_params['processes'],
+                              hub=hub, shared_limit=unit_pair_to_bytes(general_params['shared_limit']))
+    session.limiter.promote()
+
+    try:
+        session.send(url, path, parts=general_params['parts'], speed_limit=limit, timeout=general_params['timeout'],
+                     auth=get_auth(http_params['auth'], http_params['username'], http_params['password']),
+                     verify=http_params['secure'])
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--auth')
+
+    if hub is not None:
+        show_events(session, hub, mode=progress)
+    else:
+        show_progress(session, method='send', silent=silent)
+
+
+def load_manifest(path, metalink, threads):
+    from spry.manifest import ManifestStore, fetch_metalink
+
+    if metalink:
+        try:
+            manifest = fetch_metalink(metalink, name=os.path.basename(path))
+        except (IOError, ValueError) as e:
+            raise click.ClickException(str(e))
+        if manifest is None:
+            raise click.ClickException('{} has no piece hashes'.format(metalink))
+    else:
+        manifest = ManifestStore().load(path)
+        if manifest is None:
+            raise click.ClickException('No manifest was recorded for {}, download it with --manifest'.format(path))
+
+    return manifest, WorkerPool(threads)
+
+
+@spry.command(context_settings=GLOBAL_CONTEXT_SETTINGS)
+@click.pass_context
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--metalink', '-m', help='Metalink file or URL whose piece hashes to use instead of the recorded ones')
+def verify(ctx, path, metalink):
+    """Checks a downloaded file for corrupt blocks"""
+
+    manifest, pool = load_manifest(path, metalink, ctx.parent.params['threads'])
+    broken = manifest.verify(path, pool=pool)
+
+    for index in broken:
+        start, end = manifest.get_range(index)
+        print('Block {} (bytes {}-{}) does not match'.format(index, start, end))
+
+    size = os.path.getsize(path)
+    if size != manifest.size:
+        print('Size is {} instead of {}'.format(size, manifest.size))
+
+    if broken or size != manifest.size:
+        ctx.exit(1)
+    print('{} is intact'.format(path))
+
+
+@spry.command(context_settings=GLOBAL_CONTEXT_SETTINGS)
+@click.pass_context
+@click.argument('path', type=click.Path(dir_okay=False))
+@click.option('--url', '-u', help='Where to fetch corrupt blocks from\nDefault: where the file was downloaded from')
+@click.option('--metalink', '-m', help='Metalink file or URL whose piece hashes to use instead of the recorded ones')
+def repair(ctx, path, url, metalink):
+    """Fetches only the corrupt blocks of a downloaded file again"""
+
+    manifest, pool = load_manifest(path, metalink, ctx.parent.params['threads'])
+
+    try:
+        repaired = manifest.repair(path, url=url, pool=pool, timeout=ctx.parent.params['timeout'])
+    except (IOError, ValueError) as e:
+        raise click.ClickException(str(e))
+
+    print('Repaired {} of {} blocks of {}'.format(len(repaired), len(manifest.hashes), path))
 
 
 @spry.group(short_help='Connect via SFTP')
@@ -105,6 +292,166 @@ def send():
     print('send')
 
 
+@spry.group(short_help='Run or control a background session', context_settings=GLOBAL_CONTEXT_SETTINGS)
+@click.option('--socket', 'socket_path', help='Path of the control socket\nDefault: daemon.sock in the data directory')
+def daemon(socket_path):
+    pass
+
+
+def request_daemon(ctx, command, **args):
+    from spry.daemon import SOCKET_PATH, DaemonClient
+
+    try:
+        with DaemonClient(ctx.parent.params['socket_path'] or SOCKET_PATH) as client:
+            return client.request(command, **args)
+    except IOError as e:
+        raise click.ClickException(str(e))
+
+
+@daemon.command(context_settings=GLOBAL_CONTEXT_SETTINGS)
+@click.pass_context
+@click.option('--concurrent', '-c', type=int, default=4, help='Number of files transferred at once\nDefault: 4')
+@click.option('--policy', type=click.Choice(POLICIES), default=PRIORITY,
+              help='Order in which queued files are started\nDefault: {}'.format(PRIORITY))
+@click.option('--cache', is_flag=True, help='Reuses unmodified files from a local download cache')
+@click.option('--hedge', is_flag=True, help='Races slow parts with a duplicate request')
+@click.option('--transport', type=click.Choice(TRANSPORTS), default=REQUESTS,
+              help='How parts are fetched, raw uses lean keep-alive connections\nDefault: {}'.format(REQUESTS))
+@click.option('--manifest', is_flag=True, help='Records block hashes to verify and repair files later')
+def start(ctx, concurrent, policy, cache, hedge, transport, manifest):
+    """Runs a session in the foreground that other commands control"""
+
+    from spry.daemon import HISTORY, SOCKET_PATH, Daemon
+
+    general_params = ctx.parent.parent.params
+    path = ctx.parent.params['socket_path'] or SOCKET_PATH
+
+    session = api.HTTPSession(concurrent=concurrent, parts=general_params['parts'],
+                              speed_limit=general_params['limit'], timeout=general_params['timeout'],
+                              restart=general_params['restart'], host_limit=general_params['host_limit'],
+                              policy=policy, preallocate=general_params['preallocate'],
+                              buffer_size=unit_pair_to_bytes(general_params['buffer']),
+                              threads=general_params['threads'], processes=general_params['processes'],
+                              cache=cache, history=HISTORY, hedge=hedge, hub=events.EventHub(),
+                              shared_limit=unit_pair_to_bytes(general_params['shared_limit']),
+                              transport=transport, manifest=manifest)
+    session.limiter.promote()
+
+    server = Daemon(session, path)
+    print('Listening on {}'.format(path))
+
+    try:
+        server.serve_forever()
+    except IOError as e:
+        raise click.ClickException(str(e))
+    except KeyboardInterrupt:
+        pass
+
+
+@daemon.command(context_settings=GLOBAL_CONTEXT_SETTINGS)
+@click.pass_context
+@click.option('--url', '-u', multiple=True, required=True)
+@click.option('--path', '-p', required=True)
+@click.option('--priority', type=float, default=1, help='Higher is started first and gets more bandwidth\nDefault: 1')
+def get(ctx, url, path, priority):
+    """Queues downloads, printing their ids"""
+
+    path = os.path.abspath(path)
+    for u in url:
+        print(request_daemon(ctx, 'get', url=u, path=path, priority=priority)['id'])
+
+
+@daemon.command(context_settings=GLOBAL_CONTEXT_SETTINGS)
+@click.pass_context
+@click.argument('transfer_id', required=False, type=int)
+def status(ctx, transfer_id):
+    """Shows the progress of all transfers or of one"""
+
+    response = request_daemon(ctx, 'status', id=transfer_id)
+    transfers = response['transfers'] if transfer_id is None else [response]
+
+    for transfer in transfers:
+        state = transfer['state']
+        if state in ('queued', 'running'):
+            name = os.path.basename(transfer['path'] or '') or transfer['url']
+            line = format_progress(name, transfer['bytes'], transfer['size'], transfer['rate'], transfer['eta'])
+        elif state == 'finished':
+            line = 'Saved to {}'.format(transfer['path'])
+        elif state == 'failed':
+            line = '{}: {}'.format(transfer['url'], transfer['error'] or 'incomplete')
+        else:
+            line = transfer['url']
+        print('{:>5} {:<9} {}'.format(transfer['id'], state, line))
+
+    if transfer_id is None:
+        total = format_progress('Total', response['bytes'], response['size'], response['rate'], response['eta'])
+        print('{:>5} {:<9} {}'.format('', 'paused' if response['paused'] else '', total))
+
+
+@daemon.command(context_settings=GLOBAL_CONTEXT_SETTINGS)
+@click.pass_context
+@click.argument('transfer_id', required=False, type=int)
+def pause(ctx, transfer_id):
+    """Pauses a transfer, or everything"""
+
+    request_daemon(ctx, 'pause', id=transfer_id)
+
+
+@daemon.command(context_settings=GLOBAL_CONTEXT_SETTINGS)
+@click.pass_context
+@click.argument('transfer_id', required=False, type=int)
+def resume(ctx, transfer_id):
+    """Resumes a transfer, or everything"""
+
+    request_daemon(ctx, 'resume', id=transfer_id)
+
+
+@daemon.command(context_settings=GLOBAL_CONTEXT_SETTINGS)
+@click.pass_context
+@click.argument('transfer_id', required=False, type=int)
+def stop(ctx, transfer_id):
+    """Stops or cancels a transfer, or shuts the daemon down"""
+
+    request_daemon(ctx, 'stop', id=transfer_id)
+
+
+@daemon.command(context_settings=GLOBAL_CONTEXT_SETTINGS)
+@click.pass_context
+@click.argument('transfer_id', type=int)
+@click.argument('value', type=float)
+def priority(ctx, transfer_id, value):
+    """Changes the priority of a transfer"""
+
+    request_daemon(ctx, 'priority', id=transfer_id, priority=value)
+
+
+@daemon.command(context_settings=GLOBAL_CONTEXT_SETTINGS)
+@click.pass_context
+@click.argument('value', type=float)
+@click.argument('unit', type=click.Choice(BINARY_PREFIX.keys()), default='KiB')
+def limit(ctx, value, unit):
+    """Sets the speed limit of all transfers, 0 meaning none"""
+
+    request_daemon(ctx, 'limit', value=value, unit=unit)
+
+
+@daemon.command(context_settings=GLOBAL_CONTEXT_SETTINGS)
+@click.pass_context
+def watch(ctx):
+    """Prints the daemon's events as JSON, one per line"""
+
+    from spry.daemon import SOCKET_PATH, DaemonClient
+
+    try:
+        with DaemonClient(ctx.parent.params['socket_path'] or SOCKET_PATH) as client:
+            for event in client.watch():
+                write_json(event)
+    except IOError as e:
+        raise click.ClickException(str(e))
+    except KeyboardInterrupt:
+        pass
+
+
 def show_progress(session, method='get', silent=False):
 
     print('')
@@ -112,10 +459,11 @@ def show_progress(session, method='get', silent=False):
     if method == 'get':
         for file in session.unfinished:
             print('Getting {}'.format(file.remote_path))
+        if session.sources:
+            print('Getting more as they are read')
     else:
-        if not session.local_path:
-            time.sleep(.5)
-        print('\nSending {}\n'.format(session.local_path))
+        for file in session.unfinished:
+            print('Sending {}'.format(file.local_path))
 
     print('\n')
     session.run()
@@ -162,7 +510,8 @@ def show_progress(session, method='get', silent=False):
         for file in session.finished:
             print('Saved to {}'.format(file.local_path))
     else:
-        print('\n\nSent to {}\n'.format(session.remote_path))
+        for file in session.finished:
+            print('Sent to {}'.format(file.remote_path))
 
     print('\n')
 
@@ -170,3 +519,105 @@ def show_progress(session, method='get', silent=False):
         print('Transfer successful')
     else:
         print('Error. Try again with --resume')
+
+
+def write_json(event):
+    sys.stdout.write('{}\n'.format(json.dumps(event)))
+    sys.stdout.flush()
+
+
+def format_progress(name, total, size, rate, eta):
+    s_value, s_unit = bytes_to_unit_pair(size)
+    t_value, t_unit = bytes_to_unit_pair(total, s_unit if size else None)
+    bps_value, bps_unit = bytes_to_unit_pair(rate)
+    percent = '{:5.1f}%'.format(total / size * 100) if size else '    ?%'
+
+    return '{} {} <|> {:.2f} {} / {:.2f} {} <|> {:.2f} {}/s <|> ETA: {}'.format(
+        percent, name, t_value, t_unit, s_value, s_unit, bps_value, bps_unit, seconds_to_eta_string(eta)
+    )
+
+
+class Dashboard:
+    """Renders events as a line per running transfer plus a total, redrawn
+    in place. Finished transfers are printed once above them.
+    """
+
+    def __init__(self, stream=sys.stdout):
+        self.stream = stream
+        self.active = OrderedDict()
+        self.total = None
+        self.lines = 0
+
+    def __call__(self, event):
+        kind = event['event']
+        done = []
+
+        if kind in (events.START, events.PROGRESS):
+            self.active[event['id']] = event
+        elif kind == events.FINISH:
+            self.active.pop(event['id'], None)
+            done.append('Saved to {}'.format(event['path']))
+        elif kind == events.ERROR:
+            self.active.pop(event['id'], None)
+            done.append('Failed {}: {}'.format(event['url'], event['error'] or 'incomplete'))
+        elif kind == events.SESSION_PROGRESS:
+            self.total = event
+        elif kind == events.SESSION_START:
+            return
+
+        self.draw(done)
+
+    def draw(self, done):
+        rows = []
+        for event in self.active.values():
+            name = os.path.basename(event['path'] or '') or event['url']
+            row = format_progress(name, event.get('bytes', 0), event.get('size', 0), event.get('rate', 0),
+                                  event.get('eta', 0))
+            if event.get('retries'):
+                row += ' <|> Retries: {}'.format(event['retries'])
+            rows.append(row)
+
+        if self.total is not None:
+            rows.append(format_progress('Total', self.total['bytes'], self.total['size'], self.total['rate'],
+                                        self.total['eta']))
+
+        # Back to the top of the previous drawing, then clear below it
+        output = '\x1b[{}F\x1b[J'.format(self.lines) if self.lines else ''
+        output += ''.join('{}\n'.format(line) for line in done + rows)
+
+        self.stream.write(output)
+        self.stream.flush()
+        self.lines = len(rows)
+
+
+def show_events(session, hub, mode='json'):
+    """Renders events pushed by the session until it finishes, so nothing
+    is done while there is nothing new to show.
+    """
+
+    queue = Queue()
+    hub.subscribe(queue.put)
+    render = write_json if mode == 'json' else Dashboard()
+
+    session.run()
+
+    while True:
+        try:
+            event = queue.get(timeout=STATE_CHECK)
+        except Empty:
+            # Stopped without finishing, e.g. by an unexpected error
+            if not session.is_running:
+                break
+            continue
+
+        render(event)
+
+        if event['event'] == events.SESSION_FINISH:
+            break
+
+    if mode != 'json':
+        print('')
+        if not session.errors:
+            print('Transfer successful')
+        else:
+            print('Error. Try again with --resume')
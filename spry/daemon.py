@@ -0,0 +1,384 @@
+import json
+import os
+import socket
+import threading
+from collections import OrderedDict
+
+try:
+    import socketserver
+    from queue import Empty, Queue
+except ImportError:  # pragma: no cover
+    import SocketServer as socketserver
+    from Queue import Empty, Queue
+
+from spry import events
+from spry.db import DATA_DIR
+from spry.utils import STATE_CHECK
+
+SOCKET_PATH = os.path.join(DATA_DIR, 'daemon.sock')
+
+# Number of finished, failed and cancelled transfers the daemon remembers
+HISTORY = 1000
+
+# Seconds clients wait on the daemon before giving up
+CLIENT_TIMEOUT = 10
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, controller):
+        socketserver.UnixStreamServer.__init__(self, path, DaemonHandler)
+        self.controller = controller
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """Answers each JSON request line with a JSON response line, except for
+    ``watch`` which turns the connection into a stream of events.
+    """
+
+    def handle(self):
+        controller = self.server.controller
+
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                command = request.pop('command')
+
+                if command == 'watch':
+                    self.watch(controller)
+                    return
+
+                response = controller.handle(command, **request)
+                response['ok'] = True
+            except Exception as e:
+                response = {'ok': False, 'error': str(e) or e.__class__.__name__}
+
+            self.send(response)
+
+    def send(self, data):
+        self.wfile.write('{}\n'.format(json.dumps(data)).encode('utf-8'))
+        self.wfile.flush()
+
+    def watch(self, controller):
+        queue = Queue()
+        controller.session.hub.subscribe(queue.put)
+
+        try:
+            self.send({'ok': True})
+            while controller.is_serving:
+                try:
+                    self.send(queue.get(timeout=STATE_CHECK))
+                except Empty:
+                    continue
+        # The client went away
+        except (IOError, OSError):
+            pass
+        finally:
+            controller.session.hub.unsubscribe(queue.put)
+
+
+class Daemon:
+    """Keeps a :class:`~spry.sessions.Session` running and lets other
+    processes control it over a Unix socket, so connection pools, caches and
+    limiter state are shared by every download instead of rebuilt by each
+    command. Clients send one JSON object per line with a ``command`` and
+    get one back with ``ok`` and either the result or an ``error``:
+
+    - ``get``: queues ``url`` to be saved at ``path``, optionally with a
+      ``priority``, ``deadline`` or ``size_hint``. Returns its ``id``.
+    - ``status``: returns the session's progress and its ``transfers``, or
+      just the transfer with ``id``.
+    - ``pause``, ``resume`` and ``stop``: apply to the transfer with ``id``,
+      or the whole session without one. Stopping a queued transfer cancels
+      it, stopping the session shuts the daemon down.
+    - ``priority``: changes the ``priority`` of the transfer with ``id``.
+    - ``limit``: sets the session's speed limit to ``value`` ``unit``.
+    - ``watch``: streams events, see :class:`~spry.events.EventHub`.
+
+    Transfers are started with the session's defaults, e.g. its number of
+    parts and timeout.
+
+    :param session: The session running transfers. An
+                    :class:`~spry.events.EventHub` is created for it if it
+                    has none.
+    :type session: :class:`~spry.http.HTTPSession`
+    :param path: The path of the Unix socket. Default: ``daemon.sock`` in
+                 the spry data directory
+    :type path: str
+    :param history: The number of ended transfers to remember. Default: 1000
+    :type history: int
+    """
+
+    def __init__(self, session, path=SOCKET_PATH, history=HISTORY):
+        self.session = session
+        self.path = path
+        self.history = history
+        self.server = None
+        self.is_serving = False
+
+        if session.hub is None:
+            session.hub = events.EventHub()
+        session.hub.subscribe(self._on_event)
+
+        # Queued and running transfers by id, then the records of those
+        # that ended. Held while queueing so events never precede it.
+        self.transfers = OrderedDict()
+        self.running = set()
+        self.ended = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _on_event(self, event):
+        kind = event['event']
+
+        if kind == events.START:
+            with self.lock:
+                self.running.add(event['id'])
+        elif kind in (events.FINISH, events.ERROR):
+            with self.lock:
+                self.transfers.pop(event['id'], None)
+                self.running.discard(event['id'])
+                self._end(event['id'], FINISHED if kind == events.FINISH else FAILED, event['url'],
+                          event['path'], event['bytes'], error=event.get('error'))
+
+    def _end(self, transfer_id, state, url, path, total, error=None):
+        self.ended[transfer_id] = {'id': transfer_id, 'state': state, 'url': url, 'path': path, 'bytes': total,
+                                   'error': error}
+        while len(self.ended) > self.history:
+            self.ended.popitem(last=False)
+
+    def _get_transfer(self, transfer_id):
+        try:
+            return self.transfers[int(transfer_id)]
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('no queued or running transfer with id {}'.format(transfer_id))
+
+    def _describe(self, transfer):
+        rate, eta, total, size = transfer.get_progress()
+        return {'id': transfer.transfer_id, 'state': RUNNING if transfer.transfer_id in self.running else QUEUED,
+                'url': transfer.remote_path, 'path': transfer.local_path, 'bytes': total, 'size': size,
+                'rate': rate, 'eta': eta, 'priority': transfer.priority}
+
+    def handle(self, command, **args):
+        """Runs a command and returns its result as a dict"""
+
+        method = getattr(self, 'do_{}'.format(command), None)
+        if method is None:
+            raise ValueError('unknown command: {}'.format(command))
+        return method(**args)
+
+    def do_get(self, url, path, priority=1, deadline=None, size_hint=None):
+        with self.lock:
+            transfer = self.session.get(url, path, use_defaults=True, priority=priority, deadline=deadline,
+                                        size_hint=size_hint)
+            self.transfers[transfer.transfer_id] = transfer
+        return {'id': transfer.transfer_id}
+
+    def do_status(self, id=None):
+        if id is not None:
+            with self.lock:
+                if int(id) in self.ended:
+                    return dict(self.ended[int(id)])
+                return self._describe(self._get_transfer(id))
+
+        rate, eta, total, size = self.session.get_progress()
+        with self.lock:
+            transfers = [self._describe(transfer) for transfer in self.transfers.values()]
+            transfers.extend(dict(record) for record in self.ended.values())
+
+        return {'bytes': total, 'size': size, 'rate': rate, 'eta': eta, 'paused': self.session.is_paused,
+                'transfers': transfers}
+
+    def do_pause(self, id=None):
+        if id is None:
+            self.session.pause()
+        else:
+            self._get_transfer(id).pause()
+        return {}
+
+    def do_resume(self, id=None):
+        if id is None:
+            self.session.resume()
+        else:
+            self._get_transfer(id).resume()
+        return {}
+
+    def do_stop(self, id=None):
+        if id is None:
+            self.shutdown()
+            return {}
+
+        with self.lock:
+            transfer = self._get_transfer(id)
+            if self._dequeue(transfer):
+                del self.transfers[transfer.transfer_id]
+                self._end(transfer.transfer_id, CANCELLED, transfer.remote_path, transfer.local_path, 0)
+            # Already started, the session records it as failed once stopped
+            else:
+                transfer.stop()
+        return {}
+
+    def _dequeue(self, transfer):
+        """Removes a transfer that is queued, or put off until there is
+        space for it, and returns whether it was.
+        """
+
+        try:
+            self.session.unfinished.remove(transfer)
+            return True
+        except KeyError:
+            pass
+
+        try:
+            self.session.deferred.remove(transfer)
+            return True
+        except ValueError:
+            return False
+
+    def do_priority(self, id, priority):
+        self.session.set_priority(self._get_transfer(id), priority)
+        return {}
+
+    def do_limit(self, value, unit='KiB'):
+        self.session.set_speed_limit(value, unit)
+        return {}
+
+    def serve_forever(self):
+        """Starts the session and answers clients until stopped"""
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        if os.path.exists(self.path):
+            if is_listening(self.path):
+                raise IOError('a daemon is already listening on {}'.format(self.path))
+
+            # Left behind by a daemon that did not shut down cleanly
+            os.remove(self.path)
+
+        # Only the user may control their transfers. The socket is created
+        # with those permissions rather than changed after binding, which
+        # would leave others a moment to connect.
+        umask = os.umask(0o077)
+        try:
+            self.server = DaemonServer(self.path, self)
+        finally:
+            os.umask(umask)
+
+        self.is_serving = True
+        self.session.run(forever=True)
+
+        try:
+            self.server.serve_forever(STATE_CHECK)
+        finally:
+            self.is_serving = False
+            self.session.stop()
+            self.server.server_close()
+
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def shutdown(self):
+        """Stops serving clients, then the session along with all transfers.
+        Must not be called from the thread running :meth:`serve_forever`.
+        """
+
+        self.is_serving = False
+
+        # From a handler thread, which serve_forever must not wait on
+        threading.Thread(target=self.server.shutdown).start()
+
+
+def is_listening(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except (IOError, OSError):
+        return False
+    finally:
+        sock.close()
+
+
+class DaemonClient:
+    """Sends commands to a :class:`Daemon`, e.g.
+    ``DaemonClient().request('get', url=url, path=path)``.
+
+    :param path: The path of the daemon's Unix socket. Default: ``daemon.sock``
+                 in the spry data directory
+    :type path: str
+    :param timeout: Seconds to wait on responses. Default: 10
+    :type timeout: float
+    :raises IOError: If no daemon is listening.
+    """
+
+    def __init__(self, path=SOCKET_PATH, timeout=CLIENT_TIMEOUT):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+
+        try:
+            self.sock.connect(path)
+        except (IOError, OSError):
+            self.sock.close()
+            raise IOError('no spry daemon is listening on {}'.format(path))
+
+        self.file = self.sock.makefile('rwb')
+
+    def _send(self, command, **args):
+        args['command'] = command
+        self.file.write('{}\n'.format(json.dumps(args)).encode('utf-8'))
+        self.file.flush()
+
+    def _receive(self):
+        line = self.file.readline()
+        if not line:
+            raise IOError('the spry daemon closed the connection')
+
+        response = json.loads(line.decode('utf-8'))
+        if response.pop('ok', True) is False:
+            raise IOError(response['error'])
+        return response
+
+    def request(self, command, **args):
+        """Sends a command and returns the daemon's response.
+
+        :raises IOError: If the command failed.
+        """
+
+        self._send(command, **args)
+        return self._receive()
+
+    def watch(self):
+        """Yields the daemon's events until it shuts down"""
+
+        self._send('watch')
+        self._receive()
+
+        # Events may be far apart
+        self.sock.settimeout(None)
+
+        while True:
+            try:
+                yield self._receive()
+            except IOError:
+                return
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
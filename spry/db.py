@@ -4,25 +4,49 @@ import threading
 
 from appdirs import AppDirs
 from sqlalchemy import Column, ForeignKey, create_engine
-from sqlalchemy.dialects.sqlite import INTEGER, TEXT
+from sqlalchemy.dialects.sqlite import BLOB, FLOAT, INTEGER, TEXT
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, scoped_session, sessionmaker
 
 DATA_DIR = AppDirs('spry').user_data_dir
 DB_FILE = os.path.join(DATA_DIR, 'sessions.db')
 
-if not os.path.exists(DATA_DIR):
-    os.makedirs(DATA_DIR)
+# The engine, and with it the data directory and database file, is only
+# created on first use so that merely importing spry stays cheap.
+_engine = None
+_engine_lock = threading.Lock()
 
-engine = create_engine('sqlite:///{}'.format(DB_FILE))
-engine.connect()
-
-session_factory = sessionmaker(bind=engine)
+session_factory = sessionmaker()
 DBSession = scoped_session(session_factory)
 
 Base = declarative_base()
 
 
+def get_engine():
+    global _engine
+
+    with _engine_lock:
+        if _engine is None:
+            if not os.path.exists(DATA_DIR):
+                os.makedirs(DATA_DIR)
+
+            engine = create_engine('sqlite:///{}'.format(DB_FILE))
+            Base.metadata.create_all(engine)
+            session_factory.configure(bind=engine)
+            _engine = engine
+
+    return _engine
+
+
+def get_db_session():
+    """Returns the thread-local database session, creating the
+    engine if this is the first time the database is used.
+    """
+
+    get_engine()
+    return DBSession()
+
+
 class Request(Base):
     __tablename__ = 'requests'
 
@@ -55,6 +79,50 @@ class Section(Base):
         return 'Size: {}, Start: {}, End: {}'.format(self.size, self.start, self.end)
 
 
+class Transfer(Base):
+    __tablename__ = 'transfers'
+
+    id = Column(INTEGER, primary_key=True)
+    remote_path = Column(TEXT)
+    local_path = Column(TEXT)
+    size = Column(INTEGER)
+    duration = Column(FLOAT)
+    status = Column(TEXT)
+
+    def __repr__(self):
+        return '{}: {}, Status: {}'.format(self.remote_path, self.local_path, self.status)
+
+
+class CacheEntry(Base):
+    __tablename__ = 'cache'
+
+    id = Column(INTEGER, primary_key=True)
+    url = Column(TEXT, unique=True, index=True)
+    digest = Column(TEXT, index=True)
+    size = Column(INTEGER)
+    etag = Column(TEXT, nullable=True)
+    last_modified = Column(TEXT, nullable=True)
+    last_access = Column(FLOAT)
+
+    def __repr__(self):
+        return 'URL: {}, Digest: {}, Size: {}'.format(self.url, self.digest, self.size)
+
+
+class ManifestEntry(Base):
+    __tablename__ = 'manifests'
+
+    id = Column(INTEGER, primary_key=True)
+    local_path = Column(TEXT, unique=True, index=True)
+    url = Column(TEXT, nullable=True)
+    size = Column(INTEGER)
+    block_size = Column(INTEGER)
+    algorithm = Column(TEXT)
+    hashes = Column(BLOB)
+
+    def __repr__(self):
+        return 'Path: {}, Size: {}, Block size: {}'.format(self.local_path, self.size, self.block_size)
+
+
 class RWLock:
     # Taken from https://github.com/django/django/blob/master/django/utils/synch.py
     def __init__(self):
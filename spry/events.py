@@ -0,0 +1,52 @@
+import threading
+from time import time
+
+# Transfer events
+START = 'start'
+PROGRESS = 'progress'
+FINISH = 'finish'
+ERROR = 'error'
+
+# Session events
+SESSION_START = 'session_start'
+SESSION_PROGRESS = 'session_progress'
+SESSION_FINISH = 'session_finish'
+
+
+class EventHub:
+    """Pushes events about a :class:`~spry.sessions.Session` and its
+    transfers to subscribers, so that progress can be rendered or logged
+    without polling. Events are dicts with at least ``event``, the kind,
+    and ``time``. Transfer events also have ``id``, ``url`` and ``path``:
+
+    - ``start``: a transfer was started.
+    - ``progress``: ``bytes``, ``size``, ``rate`` in bytes per second,
+      ``eta`` in seconds and ``retries``. Only sent when bytes changed.
+    - ``finish``: ``bytes`` and ``duration`` of a successful transfer.
+    - ``error``: ``bytes``, ``duration`` and ``error`` of a failed one.
+    - ``session_start``, ``session_progress`` with the session's ``bytes``,
+      ``size``, ``rate`` and ``eta``, and ``session_finish`` with the
+      number of ``finished`` and failed transfers, ``errors``.
+
+    Subscribers are called on the session's thread and must return quickly,
+    e.g. by putting events on a :class:`queue.Queue`.
+    """
+
+    def __init__(self):
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.subscribers = self.subscribers + [callback]
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers = [subscriber for subscriber in self.subscribers if subscriber != callback]
+
+    def emit(self, kind, **data):
+        data['event'] = kind
+        data['time'] = time()
+
+        for callback in self.subscribers:
+            callback(data)
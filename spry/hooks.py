@@ -0,0 +1,425 @@
+from __future__ import division
+
+import binascii
+import json
+import os
+import threading
+from time import time
+
+# Callbacks of Hooks, in the order they happen to a streamer
+CALLBACKS = ('on_start', 'on_connect', 'on_first_byte', 'on_limiter_wait', 'on_read', 'on_write', 'on_reconnect',
+             'on_section_done', 'on_end')
+
+
+class Hooks:
+    """Instrumentation of the transfer hot path. Subclasses override the
+    callbacks they need, which are called on the thread running the
+    streamer of a section with the :class:`~spry.sessions.Streamer` first
+    and durations in seconds. Callbacks run for every chunk, so they must
+    be quick and may not raise. Register hooks with
+    :meth:`~spry.sessions.Session.add_hook`.
+    """
+
+    def on_start(self, streamer):
+        """A thread started running the streamer, after it got a connection slot"""
+
+    def on_connect(self, streamer, duration, connected):
+        """A request was sent and its response headers received, or not"""
+
+    def on_first_byte(self, streamer, delay):
+        """The first chunk of an attempt arrived ``delay`` after it began"""
+
+    def on_limiter_wait(self, streamer, duration):
+        """The speed limiter was asked for the size of the next read"""
+
+    def on_read(self, streamer, nbytes, duration):
+        """A chunk was received. Chunks spliced straight into the file are
+        not written separately, so :meth:`on_write` is not called for them.
+        """
+
+    def on_write(self, streamer, offset, nbytes, duration):
+        """Buffered bytes were written, or handed to the Session's disk
+        writers, in which case ``duration`` is the time spent waiting for
+        them to accept the buffer.
+        """
+
+    def on_reconnect(self, streamer, attempt):
+        """The connection was lost and attempt number ``attempt`` begins"""
+
+    def on_section_done(self, streamer, duration):
+        """All bytes of the section were received and written"""
+
+    def on_end(self, streamer):
+        """The streamer stopped running, whether it finished, failed or was stopped"""
+
+
+class HookChain:
+    """Dispatches callbacks to registered :class:`Hooks`. Only hooks that
+    override a callback are called for it. Streamers get no chain at all
+    while it is empty, so unused instrumentation costs nothing.
+    """
+
+    def __init__(self, hooks=()):
+        self.lock = threading.Lock()
+        self._rebuild(list(hooks))
+
+    def add(self, hook):
+        with self.lock:
+            self._rebuild(self.hooks + [hook])
+
+    def remove(self, hook):
+        with self.lock:
+            self._rebuild([other for other in self.hooks if other is not hook])
+
+    def _rebuild(self, hooks):
+        self.hooks = hooks
+
+        for name in CALLBACKS:
+            default = getattr(Hooks, name)
+            callbacks = [
+                getattr(hook, name) for hook in hooks
+                if getattr(type(hook), name, default) is not default
+            ]
+            setattr(self, '_{}'.format(name), callbacks)
+
+    def on_start(self, streamer):
+        for callback in self._on_start:
+            callback(streamer)
+
+    def on_connect(self, streamer, duration, connected):
+        for callback in self._on_connect:
+            callback(streamer, duration, connected)
+
+    def on_first_byte(self, streamer, delay):
+        for callback in self._on_first_byte:
+            callback(streamer, delay)
+
+    def on_limiter_wait(self, streamer, duration):
+        for callback in self._on_limiter_wait:
+            callback(streamer, duration)
+
+    def on_read(self, streamer, nbytes, duration):
+        for callback in self._on_read:
+            callback(streamer, nbytes, duration)
+
+    def on_write(self, streamer, offset, nbytes, duration):
+        for callback in self._on_write:
+            callback(streamer, offset, nbytes, duration)
+
+    def on_reconnect(self, streamer, attempt):
+        for callback in self._on_reconnect:
+            callback(streamer, attempt)
+
+    def on_section_done(self, streamer, duration):
+        for callback in self._on_section_done:
+            callback(streamer, duration)
+
+    def on_end(self, streamer):
+        for callback in self._on_end:
+            callback(streamer)
+
+    def __len__(self):
+        return len(self.hooks)
+
+    def __bool__(self):
+        return bool(self.hooks)
+
+    __nonzero__ = __bool__
+
+
+class TimingHistogram(Hooks):
+    """Collects histograms of how long connecting, the first byte, limiter
+    waits, reads and writes take, which shows whether the network, the disk
+    or the limiter hold a transfer back. Buckets double in size starting at
+    1 microsecond. Per-chunk events are sampled to keep the overhead low.
+
+    :param every: Record one in this many reads, writes and limiter waits.
+                  Default: 10
+    :type every: int
+    """
+
+    EVENTS = ('connect', 'first_byte', 'limiter', 'read', 'write', 'section')
+
+    def __init__(self, every=10):
+        self.every = every
+        self.counts = dict((event, {}) for event in self.EVENTS)
+        self.seen = dict.fromkeys(self.EVENTS, 0)
+        self.lock = threading.Lock()
+
+    def record(self, event, duration):
+        bucket = int(duration * 1000000).bit_length()
+        counts = self.counts[event]
+
+        with self.lock:
+            counts[bucket] = counts.get(bucket, 0) + 1
+
+    def sample(self, event):
+        # Races only make sampling slightly uneven
+        self.seen[event] += 1
+        return self.seen[event] % self.every == 0
+
+    def on_connect(self, streamer, duration, connected):
+        self.record('connect', duration)
+
+    def on_first_byte(self, streamer, delay):
+        self.record('first_byte', delay)
+
+    def on_limiter_wait(self, streamer, duration):
+        if self.sample('limiter'):
+            self.record('limiter', duration)
+
+    def on_read(self, streamer, nbytes, duration):
+        if self.sample('read'):
+            self.record('read', duration)
+
+    def on_write(self, streamer, offset, nbytes, duration):
+        if self.sample('write'):
+            self.record('write', duration)
+
+    def on_section_done(self, streamer, duration):
+        self.record('section', duration)
+
+    def get_histogram(self, event):
+        """Returns ``(upper bound in seconds, count)`` of each bucket"""
+
+        with self.lock:
+            counts = sorted(self.counts[event].items())
+        return [((1 << bucket) / 1000000, count) for bucket, count in counts]
+
+    def get_percentile(self, event, percent):
+        """Returns the upper bound in seconds of the bucket holding the
+        given percentile, or ``None`` if nothing was recorded.
+        """
+
+        histogram = self.get_histogram(event)
+        total = sum(count for _, count in histogram)
+        if not total:
+            return None
+
+        seen = 0
+        for upper, count in histogram:
+            seen += count
+            if seen >= total * percent / 100:
+                return upper
+
+    def format(self):
+        """Returns a line per event with its sample count and percentiles"""
+
+        lines = []
+        for event in self.EVENTS:
+            histogram = self.get_histogram(event)
+            if histogram:
+                lines.append('{:<10} n={:<8} p50<={:.6f}s p90<={:.6f}s p99<={:.6f}s'.format(
+                    event, sum(count for _, count in histogram), self.get_percentile(event, 50),
+                    self.get_percentile(event, 90), self.get_percentile(event, 99)
+                ))
+        return '\n'.join(lines)
+
+
+class Profiler(Hooks):
+    """Profiles the threads running streamers with :mod:`cProfile` and,
+    optionally, traces memory allocations with :mod:`tracemalloc`, so the
+    CPU time of a session's transfers can be told apart from time waiting.
+    Use it around a session::
+
+        profiler = Profiler()
+        session.add_hook(profiler)
+        with profiler:
+            session._run()
+        profiler.dump('session.prof')
+
+    :param memory: Whether or not to trace memory allocations too, which
+                   slows everything down. Default: ``False``
+    :type memory: bool
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.stats = None
+        self.snapshot = None
+        self.running = False
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.memory:
+            import tracemalloc
+            tracemalloc.start()
+        self.running = True
+
+    def stop(self):
+        self.running = False
+        if self.memory:
+            import tracemalloc
+            self.snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+    def on_start(self, streamer):
+        if not self.running:
+            return
+
+        import cProfile
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        # Another profiler is active on this thread
+        except ValueError:
+            return
+        self.local.profile = profile
+
+    def on_end(self, streamer):
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            return
+
+        import pstats
+
+        profile.disable()
+        self.local.profile = None
+
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def dump(self, path):
+        """Writes the profile to ``path`` in the format read by :mod:`pstats`
+        and, when tracing memory, the snapshot to ``path`` with ``.mem``
+        appended, which :meth:`tracemalloc.Snapshot.load` reads.
+        """
+
+        with self.lock:
+            if self.stats is not None:
+                self.stats.dump_stats(path)
+        if self.snapshot is not None:
+            self.snapshot.dump('{}.mem'.format(path))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class SpanExporter(Hooks):
+    """Writes a span per attempt of each section to a file as a JSON object
+    per line, shaped like OpenTelemetry spans so that they can be converted
+    for any tracing backend. Spans of the same file share a trace, and a
+    ``connect`` span is nested in each attempt. First bytes and reconnects
+    are span events, and attributes hold the bytes received and the seconds
+    spent reading, writing and waiting on the limiter.
+
+    :param path: The file to append spans to.
+    :type path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a')
+        self.traces = {}
+        self.spans = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def new_id(nbytes):
+        return binascii.hexlify(os.urandom(nbytes)).decode('ascii')
+
+    def get_trace_id(self, streamer):
+        with self.lock:
+            trace_id = self.traces.get(streamer.local_path)
+            if trace_id is None:
+                trace_id = self.traces[streamer.local_path] = self.new_id(16)
+            return trace_id
+
+    def begin(self, streamer, attempt, now=None):
+        now = now or time()
+        self.spans[id(streamer)] = {
+            'name': 'section',
+            'trace_id': self.get_trace_id(streamer),
+            'span_id': self.new_id(8),
+            'parent_span_id': None,
+            'start_time_unix_nano': int(now * 1e9),
+            'attributes': {
+                'url': streamer.remote_path, 'path': streamer.local_path, 'range.start': streamer.section.start,
+                'range.end': streamer.section.end, 'attempt': attempt, 'bytes': 0, 'read.seconds': 0.0,
+                'write.seconds': 0.0, 'limiter.seconds': 0.0
+            },
+            'events': [],
+            'status': 'unset'
+        }
+
+    def end(self, streamer, status, now=None):
+        span = self.spans.pop(id(streamer), None)
+        if span is None:
+            return
+
+        span['end_time_unix_nano'] = int((now or time()) * 1e9)
+        span['status'] = status
+        self.write(span)
+
+    def write(self, span):
+        line = '{}\n'.format(json.dumps(span))
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def on_start(self, streamer):
+        self.begin(streamer, streamer.retries + 1)
+
+    def on_connect(self, streamer, duration, connected):
+        span = self.spans.get(id(streamer))
+        if span is None:
+            return
+
+        now = time()
+        self.write({
+            'name': 'connect', 'trace_id': span['trace_id'], 'span_id': self.new_id(8),
+            'parent_span_id': span['span_id'], 'start_time_unix_nano': int((now - duration) * 1e9),
+            'end_time_unix_nano': int(now * 1e9), 'attributes': {'url': streamer.remote_path},
+            'events': [], 'status': 'ok' if connected else 'error'
+        })
+
+    def on_first_byte(self, streamer, delay):
+        span = self.spans.get(id(streamer))
+        if span is not None:
+            span['events'].append({'name': 'first_byte', 'time_unix_nano': int(time() * 1e9),
+                                   'attributes': {'delay.seconds': delay}})
+
+    def on_limiter_wait(self, streamer, duration):
+        span = self.spans.get(id(streamer))
+        if span is not None:
+            span['attributes']['limiter.seconds'] += duration
+
+    def on_read(self, streamer, nbytes, duration):
+        span = self.spans.get(id(streamer))
+        if span is not None:
+            attributes = span['attributes']
+            attributes['bytes'] += nbytes
+            attributes['read.seconds'] += duration
+
+    def on_write(self, streamer, offset, nbytes, duration):
+        span = self.spans.get(id(streamer))
+        if span is not None:
+            span['attributes']['write.seconds'] += duration
+
+    def on_reconnect(self, streamer, attempt):
+        # The lost attempt ends and the next one begins
+        now = time()
+        self.end(streamer, 'error', now)
+        self.begin(streamer, attempt, now)
+        self.spans[id(streamer)]['events'].append({'name': 'reconnect', 'time_unix_nano': int(now * 1e9),
+                                                   'attributes': {}})
+
+    def on_section_done(self, streamer, duration):
+        self.end(streamer, 'ok')
+
+    def on_end(self, streamer):
+        # Neither done nor reconnecting, so failed or stopped
+        self.end(streamer, 'error')
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -1,22 +1,36 @@
+import logging
 import os
-
-import requests
-
-from spry.db import Section, Session, RWLock
-from spry.io import FileAdapter, HTTPAdapter
-from spry.sessions import FileSync, Session, Streamer
+import time
+
+from spry.io import FileAdapter, HTTPAdapter, import_requests
+from spry.processes import ProcessFileSync, ProcessGroup
+from spry.progress import TransferStats
+from spry.ranges import RangeFetcher
+from spry.remote import RemoteFile
+from spry.scheduling import PRIORITY
+from spry.sessions import FileSync, Section, Session, Streamer, TransferRequest
+from spry.transport import ConnectionPool, RawAdapter, RawUploadAdapter, supports_raw
+from spry.workers import DISK_WRITERS, MEMORY_LIMIT, WORKER_THREADS
 from spry.utils import (
-    calc_section_data, create_null_file, get_timestamp, parse_fname_from_headers
+    PREALLOCATE_AUTO, RAW, REQUESTS, STATE_CHECK, WRITE_BUFFER_SIZE, calc_section_data, create_null_file, get_origin,
+    get_timestamp, parse_fname_from_headers, parse_fname_from_url, parse_metalink_url
 )
 
-# Until GUI, this will mainly be for developers so no warnings
-requests.packages.urllib3.disable_warnings()
+log = logging.getLogger(__name__)
 
 
 class HTTPReader(Streamer):
-    def __init__(self, url, local_path, section, tracker, limiter, counter, timeout, session=None, **kwargs):
-        super(HTTPReader, self).__init__(url, local_path, section, tracker, limiter, counter, timeout)
+    __slots__ = ('session', 'transport', 'connection_pool', 'kwargs')
+
+    def __init__(self, url, local_path, section, tracker, limiter, counter, timeout, session=None,
+                 connections=None, buffer_size=WRITE_BUFFER_SIZE, disk=None, stats=None, pool=None, hooks=None,
+                 completed=None, transport=REQUESTS, connection_pool=None, **kwargs):
+        super(HTTPReader, self).__init__(url, local_path, section, tracker, limiter, counter, timeout,
+                                         connections=connections, buffer_size=buffer_size, disk=disk,
+                                         stats=stats, pool=pool, hooks=hooks, completed=completed)
         self.session = session
+        self.transport = transport
+        self.connection_pool = connection_pool
         self.kwargs = kwargs
 
     def _setup(self):
@@ -25,34 +39,248 @@ class HTTPReader(Streamer):
         else:
             headers = {'range': 'bytes={}-{}'.format(self.section.start, self.section.end)}
 
-        self.reader = HTTPAdapter(self.remote_path, self.session, headers=headers, stream=True, **self.kwargs)
-        self.writer = FileAdapter(self.local_path, 'r+b')
-        self.writer.seek(self.section.start)
+        if self.transport == RAW:
+            self.reader = RawAdapter(self.remote_path, self.connection_pool, headers=headers, **self.kwargs)
+        else:
+            self.reader = HTTPAdapter(self.remote_path, self.session, headers=headers, stream=True, **self.kwargs)
+        # Unbuffered, as data is already coalesced before positional writes
+        self.writer = FileAdapter(self.local_path, 'r+b', buffering=0)
 
 
 class HTTPWriter(Streamer):
-    def __init__(self, url, local_path, section, tracker, limiter, counter, timeout, session=None, **kwargs):
-        super(HTTPWriter, self).__init__(url, local_path, section, tracker, limiter, counter, timeout)
-        self.session = session
+    """Uploads a section of a local file with a PUT request, which carries a
+    ``Content-Range`` header unless the section is the whole file. Bytes go
+    from the file to the socket without passing through Python, see
+    :class:`~spry.transport.RawUploadAdapter`. A request cut short cannot be
+    resumed, so every attempt sends the whole section.
+    """
+
+    __slots__ = ('file_size', 'connection_pool', 'kwargs')
+
+    def __init__(self, url, local_path, section, tracker, limiter, counter, timeout, file_size,
+                 connections=None, stats=None, pool=None, hooks=None, completed=None, connection_pool=None,
+                 **kwargs):
+        super(HTTPWriter, self).__init__(url, local_path, section, tracker, limiter, counter, timeout,
+                                         connections=connections, stats=stats, pool=pool, hooks=hooks,
+                                         completed=completed)
+        self.file_size = file_size
+        self.connection_pool = connection_pool
         self.kwargs = kwargs
 
+    def run(self):
+        if not self._begin():
+            return
+
+        hooks = self.hooks
+        if hooks is not None:
+            hooks.on_start(self)
+
+        if self.started is None:
+            self.started = time.time()
+
+        start = self.section.start
+        size = self.section.size
+        tracker = self.tracker
+        get_size = self.limiter.get
+
+        last_active = time.time()
+        attempted = False
+
+        while self.is_running:
+
+            if attempted:
+                self.retries += 1
+                if hooks is not None:
+                    hooks.on_reconnect(self, self.retries + 1)
+            attempted = True
+
+            attempt_start = time.time()
+            try:
+                self._setup()
+                self.is_connected = True
+            except:
+                self.is_connected = False
+
+            if hooks is not None:
+                hooks.on_connect(self, time.time() - attempt_start, self.is_connected)
+
+            self.timings = dict.fromkeys(TransferStats.FIELDS, 0.0)
+            timings = self.timings
+
+            sent = 0
+            self.position = start
+
+            while self.is_connected and sent < size:
+
+                if not self.is_running:
+                    break
+                elif self.is_paused:
+                    self.wake.wait(STATE_CHECK)
+                    continue
+
+                wait_start = time.time()
+                chunk_size = min(get_size(), size - sent)
+                send_start = time.time()
+                timings['limiter'] += send_start - wait_start
+
+                try:
+                    nbytes = self.writer.send_file(start + sent, chunk_size)
+                except:
+                    self.is_connected = False
+                    break
+
+                send_end = time.time()
+                timings['network'] += send_end - send_start
+
+                if hooks is not None:
+                    hooks.on_limiter_wait(self, send_start - wait_start)
+                    hooks.on_write(self, start + sent, nbytes, send_end - send_start)
+
+                tracker.add(nbytes)
+                sent += nbytes
+                self.received += nbytes
+                self.position += nbytes
+
+            status = None
+            if self.is_connected and self.is_running and sent == size:
+                try:
+                    status = self.writer.get_response()
+                except:
+                    self.is_connected = False
+
+            self._sync()
+
+            if status is not None:
+                if 200 <= status < 300:
+                    self.section.size -= sent
+                    if self.completed is not None:
+                        self.completed.add(start, start + sent - 1)
+                    self._finish()
+                else:
+                    self.error = IOError('upload of bytes {}-{} rejected with status {}'.format(
+                        start, start + size - 1, status
+                    ))
+                self.cleanup()
+                return
+
+            # Whatever part of the section the server got is of no use
+            tracker.remove(sent)
+            self.received -= sent
+
+            if sent:
+                last_active = time.time()
+            elif self.timeout and time.time() - last_active >= self.timeout:
+                break
+
+            if self.writer is not None:
+                self.writer.close()
+            if self.reader is not None:
+                self.reader.close()
+
+        self.cleanup()
+
     def _setup(self):
-        if not self.section.end:
-            headers = {}
-        else:
-            headers = {'range': 'bytes={}-{}'.format(self.section.start, self.section.end)}
+        size = self.section.size
+        kwargs = dict(self.kwargs)
+        headers = dict(kwargs.pop('headers', None) or {})
+        if size != self.file_size:
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                self.section.start, self.section.start + size - 1, self.file_size
+            )
 
-        # self.reader = HTTPAdapter(self.remote_path, self.session, headers=headers, stream=True, **self.kwargs)
-        # self.writer = FileAdapter(self.local_path, 'r+b')
+        self.reader = FileAdapter(self.local_path, 'rb', buffering=0)
+        self.writer = RawUploadAdapter(self.remote_path, self.reader, size, self.connection_pool,
+                                       headers=headers, **kwargs)
 
 
 class HTTPFileSync(FileSync):
     def __init__(self, method, url, path, session=None, persist=True, keep=False, parts=4,
-                 speed_limit=None, timeout=20, restart=False, tracker=None, limiter=None, **kwargs):
+                 speed_limit=None, timeout=20, restart=False, tracker=None, limiter=None, connections=None,
+                 priority=1, deadline=None, size_hint=None, preallocate=PREALLOCATE_AUTO,
+                 buffer_size=WRITE_BUFFER_SIZE, disk=None, stats=None, pool=None, cache=None, hedge=False,
+                 shared_limiter=None, space=None, hooks=None, transport=REQUESTS, connection_pool=None,
+                 manifest=None, **kwargs):
         super(HTTPFileSync, self).__init__(method, url, path, keep=keep, parts=parts, speed_limit=speed_limit,
-                                           timeout=timeout, restart=restart, tracker=tracker, limiter=limiter)
-        self.session = session or requests.Session() if persist else None
+                                           timeout=timeout, restart=restart, tracker=tracker, limiter=limiter,
+                                           connections=connections, priority=priority, deadline=deadline,
+                                           size_hint=size_hint, preallocate=preallocate, buffer_size=buffer_size,
+                                           disk=disk, stats=stats, pool=pool, hedge=hedge,
+                                           shared_limiter=shared_limiter, space=space, hooks=hooks)
+        self.session = session or import_requests().Session() if persist else None
         self.kwargs = kwargs
+        self.cache = cache
+        self.manifest = manifest
+        self.file_size = None
+
+        # Uploads are sent from the file by the kernel, which needs the raw
+        # transport. Racing a duplicate request for the rest of a section
+        # would overlap one that cannot be resumed, so they are not hedged.
+        if method.lower() == 'send':
+            if not supports_raw(kwargs):
+                raise ValueError('uploads support no request arguments besides headers, timeout, verify '
+                                 'and basic auth')
+            transport = RAW
+            self.hedge = False
+
+        # Parts skip requests only if the request needs nothing it alone
+        # handles, and go straight to wherever the probe was redirected.
+        self.transport = transport if supports_raw(kwargs) else REQUESTS
+        self.connection_pool = connection_pool or ConnectionPool() if self.transport == RAW else None
+        self.stream_url = url
+        self.cache_hit = False
+        self.validators = {}
+        self.metalink_url = None
+
+    def _inspect(self, entry=None):
+        kwargs = self.kwargs
+
+        # Ask for the body only if it differs from the cached copy
+        if entry is not None:
+            headers = dict(kwargs.get('headers') or {})
+            headers.update(self.cache.get_validators(entry))
+            kwargs = dict(kwargs, headers=headers)
+
+        if self.session:
+            inspection = self.session.get(self.remote_path, stream=True, **kwargs)
+        else:
+            inspection = import_requests().get(self.remote_path, stream=True, **kwargs)
+        inspection.close()
+
+        return inspection
+
+    def _set_local_path(self, headers):
+        if os.path.isdir(self.local_path):
+            self.local_path = os.path.join(self.local_path, get_timestamp())
+
+        parent_dir, filename = os.path.split(self.local_path)
+        remote_name = parse_fname_from_headers(headers) if self.keep else None
+
+        self.local_path = os.path.join(parent_dir, remote_name or filename or get_timestamp())
+
+    def _create_streamer(self, section, tracker):
+        if self.method.lower() == 'send':
+            return HTTPWriter(url=self.remote_path, local_path=self.local_path, section=section,
+                              tracker=tracker, limiter=self.limiter, counter=self.counter,
+                              timeout=self.timeout, file_size=self.file_size, connections=self.connections,
+                              stats=self.stats, pool=self.pool, hooks=self.hooks or None,
+                              completed=self.completed, connection_pool=self.connection_pool, **self.kwargs)
+
+        return HTTPReader(url=self.stream_url, local_path=self.local_path, section=section,
+                          tracker=tracker, limiter=self.limiter, counter=self.counter,
+                          timeout=self.timeout, session=self.session, connections=self.connections,
+                          buffer_size=self.buffer_size, disk=self.disk, stats=self.stats,
+                          pool=self.pool, hooks=self.hooks or None, completed=self.completed,
+                          transport=self.transport, connection_pool=self.connection_pool, **self.kwargs)
+
+    def finish(self):
+        # Caching is best effort, the download itself succeeded
+        if self.cache is not None and not self.cache_hit:
+            try:
+                self.cache.store(self.remote_path, self.local_path, self.validators)
+            except Exception:
+                log.exception('Could not cache %s', self.remote_path)
+        if self.manifest is not None and self.method.lower() == 'get':
+            self.manifest.record(self.remote_path, self.local_path, self.metalink_url, session=self.session)
 
     def _spawn(self, restart=False):
         if self.method.lower() == 'get':
@@ -61,40 +289,77 @@ class HTTPFileSync(FileSync):
 
             if restart or self.restart or not session_saved:
                 self._reset()
-
-                if self.session:
-                    inspection = self.session.get(self.remote_path, stream=True, **self.kwargs)
-                else:
-                    inspection = requests.get(self.remote_path, stream=True, **self.kwargs)
-                inspection.close()
+                self.cache_hit = False
+
+                entry = self.cache.lookup(self.remote_path) if self.cache is not None else None
+                inspection = self._inspect(entry)
+
+                # Not modified, so the cached copy is served without any
+                # streamers, which leaves the transfer finished right away.
+                if entry is not None and inspection.status_code == 304:
+                    self._set_local_path(inspection.headers)
+                    self.cache.serve(entry, self.local_path)
+                    self.cache_hit = True
+
+                    self.tracker.grow(entry.size)
+                    self.tracker.add(entry.size)
+                    return
+
+                self.validators = {
+                    'etag': inspection.headers.get('etag'),
+                    'last-modified': inspection.headers.get('last-modified')
+                }
+
+                # Credentials must not follow a redirect to another origin,
+                # which requests takes care of for the parts it fetches.
+                if self.transport == RAW:
+                    redirected = get_origin(inspection.url) != get_origin(self.remote_path)
+                    if redirected and self.kwargs.get('auth') is not None:
+                        self.transport = REQUESTS
+                    else:
+                        self.stream_url = inspection.url
+                if self.manifest is not None:
+                    self.metalink_url = parse_metalink_url(inspection.headers, inspection.url)
 
                 remote_size = int(inspection.headers.get('content-length', 0))
                 if not remote_size or self.parts >= remote_size:
                     self.parts = 1
 
-                if os.path.isdir(self.local_path):
-                    self.local_path = os.path.join(self.local_path, get_timestamp())
+                self._set_local_path(inspection.headers)
 
-                parent_dir, filename = os.path.split(self.local_path)
-                remote_name = parse_fname_from_headers(inspection.headers) if self.keep else None
+                if self.space is not None and not self.space.reserve(self.local_path, remote_size or 1):
+                    self.deferred = True
+                    return
 
-                self.local_path = os.path.join(parent_dir, remote_name or filename or get_timestamp())
-                create_null_file(self.local_path, remote_size or 1)
+                # An existing file of the right size is only reused when not
+                # restarting, in which case its blocks are already allocated.
+                create_null_file(self.local_path, remote_size or 1, mode=self.preallocate,
+                                 overwrite=restart or self.restart)
 
                 self.tracker.grow(remote_size)
+                self.completed.size = remote_size or None
                 sections = [Section(**data) for data in calc_section_data(remote_size, self.parts)]
 
                 for section in sections:
-                    self.streamers.append(
-                        HTTPReader(url=self.remote_path, local_path=self.local_path, section=section,
-                                   tracker=self.tracker, limiter=self.limiter, counter=self.counter,
-                                   timeout=self.timeout, session=self.session, **self.kwargs)
-                    )
+                    self.streamers.append(self._create_streamer(section, self.tracker))
                 for worker in self.streamers:
                     worker.start()
 
         elif self.method.lower() == 'send':
-            pass
+            self._reset()
+
+            self.file_size = os.path.getsize(self.local_path)
+            if not self.file_size or self.parts >= self.file_size:
+                self.parts = 1
+
+            self.tracker.grow(self.file_size)
+            self.completed.size = self.file_size
+            sections = [Section(**data) for data in calc_section_data(self.file_size, self.parts)]
+
+            for section in sections:
+                self.streamers.append(self._create_streamer(section, self.tracker))
+            for worker in self.streamers:
+                worker.start()
 
 
 class HTTPSession(Session):
@@ -131,18 +396,250 @@ class HTTPSession(Session):
     :param restart: Whether or not to start transfers anew. This can be
                     overridden for each transfer request. Default: ``False``
     :type restart: bool
+    :param host_limit: The maximum number of simultaneous connections to any
+                       single host, shared by all transfers. Parts beyond the
+                       budget wait for a slot to free up. Default: ``None``
+    :type host_limit: int or ``None``
+    :param policy: The order in which queued transfers are started, one of
+                   ``fifo``, ``priority``, ``sjf`` (shortest job first) or
+                   ``fair`` (round-robin between hosts). See
+                   :class:`~spry.scheduling.TransferQueue`.
+                   Default: ``priority``
+    :type policy: str
+    :param preallocate: How disk space is reserved for files before writing,
+                        one of ``auto``, ``fallocate``, ``sparse`` or ``none``.
+                        See :func:`~spry.utils.create_null_file`. This can be
+                        overridden for each transfer request. Default: ``auto``
+    :type preallocate: str
+    :param buffer_size: The number of bytes each part collects in memory before
+                        writing them to disk at once. 0 writes every chunk as
+                        it arrives. This can be overridden for each transfer
+                        request. Default: 1 MiB
+    :type buffer_size: int
+    :param disk_writers: The number of threads writing received data to disk
+                         for all transfers, so that a slow disk does not stall
+                         network reads. 0 makes every connection write its own
+                         data. Default: 2
+    :type disk_writers: int
+    :param memory_limit: The maximum number of received bytes waiting for the
+                         disk writers. Connections pause reading once it is
+                         reached. Default: 64 MiB
+    :type memory_limit: int
+    :param threads: The maximum number of threads running connections for
+                    all transfers. Parts beyond it wait for a thread to free
+                    up. Disk writers and the session loop are not included.
+                    Default: 16
+    :type threads: int
+    :param processes: Whether or not to run each transfer in its own worker
+                      process, for when a single core cannot keep up with the
+                      network. Progress, timings and limits are relayed to and
+                      from this session. See
+                      :class:`~spry.processes.ProcessFileSync`. Worker
+                      processes cannot share ``host_limit``, so the two
+                      cannot be combined. Default: ``False``
+    :type processes: bool
+    :param cache: Whether or not to keep downloaded files in a local cache
+                  and revalidate them with conditional requests, copying
+                  unmodified files from it instead of downloading them again.
+                  Either a bool or a :class:`~spry.cache.DownloadCache`.
+                  Default: ``False``
+    :type cache: bool or :class:`~spry.cache.DownloadCache`
+    :param history: The number of records of finished and of failed
+                    transfers to keep in :attr:`finished` and :attr:`errors`.
+                    ``None`` keeps all of them. Default: ``None``
+    :type history: int or ``None``
+    :param spill: Whether or not to save records beyond ``history`` to the
+                  database instead of dropping them. Default: ``False``
+    :type spill: bool
+    :param hedge: Whether or not to race parts much slower than the other
+                  parts of their file with a duplicate request for their
+                  remaining bytes, keeping whichever finishes first. This
+                  can be overridden for each transfer request.
+                  Default: ``False``
+    :type hedge: bool
+    :param hub: Where to push progress and lifecycle events of the session
+                and its transfers. See :class:`~spry.events.EventHub`.
+                Default: ``None``
+    :type hub: :class:`~spry.events.EventHub` or ``None``
+    :param shared_limit: A limit in bytes per second on the combined speed of
+                         all spry processes on the host using one, enforced
+                         along with ``speed_limit``. Either a number or a
+                         :class:`~spry.shared.SharedLimiter`.
+                         Default: ``None``
+    :type shared_limit: int or :class:`~spry.shared.SharedLimiter` or ``None``
+    :param transport: How parts of files are fetched, either ``requests`` or
+                      ``raw`` for lean keep-alive connections with less
+                      overhead per chunk. Files are still probed with
+                      requests, which handles redirects and auth, and
+                      requests needing more than basic auth stay on it.
+                      See :class:`~spry.transport.RawAdapter`. This can be
+                      overridden for each transfer request.
+                      Default: ``requests``
+    :type transport: str
+    :param manifest: Whether or not to record a hash of every block of
+                     downloaded files, taken from the server's Metalink
+                     piece hashes if it links to any, so that the files can
+                     be verified and their corrupt blocks fetched again.
+                     Either a bool or a :class:`~spry.manifest.ManifestStore`.
+                     Default: ``False``
+    :type manifest: bool or :class:`~spry.manifest.ManifestStore`
     """
 
     def __init__(self, concurrent=4, session=None, persist=True, keep=False,
-                 parts=4, speed_limit=None, timeout=20, restart=False):
+                 parts=4, speed_limit=None, timeout=20, restart=False, host_limit=None,
+                 policy=PRIORITY, preallocate=PREALLOCATE_AUTO, buffer_size=WRITE_BUFFER_SIZE,
+                 disk_writers=DISK_WRITERS, memory_limit=MEMORY_LIMIT, threads=WORKER_THREADS,
+                 processes=False, cache=False, history=None, spill=False, hedge=False, hub=None,
+                 shared_limit=None, transport=REQUESTS, manifest=False):
         super(HTTPSession, self).__init__(concurrent=concurrent, parts=parts, speed_limit=speed_limit,
-                                          timeout=timeout, restart=restart)
-        self.session = session or requests.Session()
+                                          timeout=timeout, restart=restart, host_limit=host_limit,
+                                          policy=policy, preallocate=preallocate, buffer_size=buffer_size,
+                                          disk_writers=disk_writers, memory_limit=memory_limit,
+                                          threads=threads, history=history, spill=spill, hub=hub,
+                                          shared_limit=shared_limit)
+        if processes and host_limit:
+            raise ValueError('host_limit cannot be enforced across worker processes')
+
+        self.session = session or import_requests().Session()
         self.persist = persist
         self.keep = keep
+        self.processes = processes
+        self.hedge = hedge
+        self.transport = transport
+        self.connection_pool = ConnectionPool()
+        self.process_group = ProcessGroup(self.limiter)
+
+        # The cache needs the database, so it is only imported once enabled
+        if cache is True:
+            from spry.cache import DownloadCache
+            cache = DownloadCache()
+        self.cache = cache or None
+
+        if manifest is True:
+            from spry.manifest import ManifestStore
+            manifest = ManifestStore()
+        self.manifest = manifest or None
 
     def get(self, url, path, session=None, persist=True, keep=False, parts=4,
-            speed_limit=None, timeout=20, restart=False, use_defaults=False, **kwargs):
+            speed_limit=None, timeout=20, restart=False, use_defaults=False,
+            priority=1, deadline=None, size_hint=None, preallocate=PREALLOCATE_AUTO,
+            buffer_size=WRITE_BUFFER_SIZE, hedge=False, transport=REQUESTS, **kwargs):
+        """Queues a download and returns its :class:`HTTPFileSync`.
+
+        :param priority: Higher values are started first and, when the
+                         session's limiter is promoted, get a proportionally
+                         larger share of its bandwidth. Default: 1
+        :type priority: int or float
+        :param deadline: A UNIX timestamp. Among equal priorities, the
+                         earliest deadline is started first. Default: ``None``
+        :type deadline: float or ``None``
+        :param size_hint: The expected size in bytes, used by the ``sjf``
+                          policy. Default: ``None``
+        :type size_hint: int or ``None``
+        """
+
+        kwargs = self._get_kwargs(
+            session=session, persist=persist, keep=keep, parts=parts, speed_limit=speed_limit,
+            timeout=timeout, restart=restart, use_defaults=use_defaults, priority=priority,
+            deadline=deadline, size_hint=size_hint, preallocate=preallocate, buffer_size=buffer_size,
+            hedge=hedge, transport=transport, **kwargs
+        )
+
+        # Known right away, so callers can refer to it before it starts
+        transfer = self._create_get(url, path, **kwargs)
+        transfer.transfer_id = next(self.transfer_ids)
+        self.unfinished.append(transfer)
+        self.wake.set()
+
+        return transfer
+
+    def send(self, url, path, parts=4, speed_limit=None, timeout=20, use_defaults=False,
+             priority=1, deadline=None, **kwargs):
+        """Queues an upload of the local file ``path`` to ``url`` and returns
+        its :class:`HTTPFileSync`. The file is sent with PUT requests, one
+        per part, each with a ``Content-Range`` header unless it is the
+        whole file, so servers must accept those for more than one part.
+        Requests need nothing besides headers, timeouts, verification and
+        basic auth, see :class:`HTTPWriter`. Accepts the same scheduling
+        arguments as :meth:`get`.
+        """
+
+        kwargs = self._get_kwargs(
+            parts=parts, speed_limit=speed_limit, timeout=timeout, use_defaults=use_defaults,
+            priority=priority, deadline=deadline, size_hint=os.path.getsize(path), **kwargs
+        )
+
+        # Nothing is downloaded, so there is nothing to cache or verify
+        kwargs['cache'] = None
+        kwargs['manifest'] = None
+
+        transfer = self._create_send(url, path, **kwargs)
+        transfer.transfer_id = next(self.transfer_ids)
+        self.unfinished.append(transfer)
+        self.wake.set()
+
+        return transfer
+
+    def open(self, url, **kwargs):
+        """Returns a seekable, read-only :class:`~spry.remote.RemoteFile` for
+        ``url`` that only fetches the parts being read, e.g. to list a remote
+        zip archive with :mod:`zipfile`. Blocks fetched ahead run on the
+        session's threads.
+        """
+
+        return RemoteFile(url, session=self.session, pool=self.pool, **kwargs)
+
+    def get_ranges(self, url, ranges, output=None, **kwargs):
+        """Fetches many ``(start, end)`` byte ranges of ``url`` with as few
+        requests as possible. See :meth:`~spry.ranges.RangeFetcher.fetch`
+        for what is returned depending on ``output``.
+        """
+
+        return RangeFetcher(url, session=self.session, pool=self.pool, **kwargs).fetch(ranges, output=output)
+
+    def get_many(self, urls, path, **kwargs):
+        """Queues downloads from an iterable of URLs, which is only consumed
+        as transfers finish, e.g. a file with millions of lines. Each item
+        is either a URL saved in the directory ``path`` under the name at
+        the end of the URL, or a ``(url, path)`` tuple. Accepts the same
+        arguments as :meth:`get`.
+        """
+
+        kwargs = self._get_kwargs(**kwargs)
+        priority, deadline, size_hint = kwargs['priority'], kwargs['deadline'], kwargs['size_hint']
+
+        def transfer_requests():
+            for url in urls:
+                if isinstance(url, tuple):
+                    url, local_path = url
+                else:
+                    local_path = os.path.join(path, parse_fname_from_url(url) or '')
+
+                yield TransferRequest(self._create_get, url, local_path, kwargs, priority=priority,
+                                      deadline=deadline, size_hint=size_hint)
+
+        self.add_source(transfer_requests())
+
+    def set_host_limit(self, limit):
+        if self.processes and limit:
+            raise ValueError('host_limit cannot be enforced across worker processes')
+        super(HTTPSession, self).set_host_limit(limit)
+
+    def _create_get(self, url, path, **kwargs):
+        if self.processes:
+            return ProcessFileSync(HTTPFileSync, 'get', url, path, group=self.process_group, **kwargs)
+        return HTTPFileSync('get', url, path, **kwargs)
+
+    def _create_send(self, url, path, **kwargs):
+        if self.processes:
+            return ProcessFileSync(HTTPFileSync, 'send', url, path, group=self.process_group, **kwargs)
+        return HTTPFileSync('send', url, path, **kwargs)
+
+    def _get_kwargs(self, session=None, persist=True, keep=False, parts=4,
+                    speed_limit=None, timeout=20, restart=False, use_defaults=False,
+                    priority=1, deadline=None, size_hint=None, preallocate=PREALLOCATE_AUTO,
+                    buffer_size=WRITE_BUFFER_SIZE, hedge=False, transport=REQUESTS, **kwargs):
+
         if use_defaults:
             session = self.session
             persist = self.persist
@@ -151,15 +648,24 @@ class HTTPSession(Session):
             speed_limit = self.speed_limit
             timeout = self.timeout
             restart = self.restart
-
-        self.unfinished.append(
-            HTTPFileSync(
-                'get', url=url, path=path, session=session, persist=persist, keep=keep,
-                parts=parts, speed_limit=speed_limit, timeout=timeout, restart=restart,
-                tracker=self.tracker, limiter=self.limiter, **kwargs
-            )
+            preallocate = self.preallocate
+            buffer_size = self.buffer_size
+            hedge = self.hedge
+            transport = self.transport
+
+        kwargs.update(
+            session=session, persist=persist, keep=keep,
+            parts=parts, speed_limit=speed_limit, timeout=timeout, restart=restart,
+            tracker=self.tracker, limiter=self.limiter, connections=self.connections, disk=self.disk,
+            stats=self.stats, pool=self.pool,
+            priority=priority, deadline=deadline, size_hint=size_hint, preallocate=preallocate,
+            buffer_size=buffer_size, cache=self.cache, hedge=hedge, shared_limiter=self.shared_limiter,
+            space=self.space, hooks=self.hooks, transport=transport, connection_pool=self.connection_pool,
+            manifest=self.manifest
         )
 
+        return kwargs
+
 
 
 
@@ -1,18 +1,87 @@
+import os
+import socket
 from io import open
 
-import requests
+from spry.utils import CHUNK_SIZE
+
+# Seconds to wait for a connection and, once connected, for any data.
+# A read outlasting the latter fails like a lost connection instead
+# of blocking its thread for good.
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 20
+
+_requests = None
+
+
+def import_requests():
+    """Returns the requests module, which is only imported once spry makes a
+    request as importing it takes longer than importing the rest of spry.
+    """
+
+    global _requests
+
+    if _requests is None:
+        import requests
+
+        # Until GUI, this will mainly be for developers so no warnings
+        requests.packages.urllib3.disable_warnings()
+        _requests = requests
+
+    return _requests
 
 
 class HTTPAdapter:
     def __init__(self, url, session=None, **kwargs):
+        kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+
         if session:
             self.resource = session.get(url, **kwargs)
         else:
-            self.resource = requests.get(url, **kwargs)
+            self.resource = import_requests().get(url, **kwargs)
 
     def read(self, nbytes):
         return self.resource.raw.read(nbytes)
 
+    def readinto(self, b):
+        return self.resource.raw.readinto(b)
+
+    def read_all(self, nbytes=None):
+        """Reads until ``nbytes`` were received or the response ends"""
+
+        data = bytearray()
+        while nbytes is None or len(data) < nbytes:
+            chunk = self.read(CHUNK_SIZE if nbytes is None else nbytes - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def abort(self):
+        """Shuts down the connection from any thread, which makes a read
+        blocked in another thread return or raise right away.
+        """
+
+        raw = self.resource.raw
+        sock = getattr(getattr(raw, '_connection', None), 'sock', None)
+        if sock is None:
+            try:
+                sock = raw._fp.fp.raw._sock
+            except AttributeError:
+                return
+
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+
+    @property
+    def status_code(self):
+        return self.resource.status_code
+
+    @property
+    def headers(self):
+        return self.resource.headers
+
     def close(self):
         self.resource.close()
 
@@ -27,6 +96,27 @@ class FileAdapter:
     def write(self, bytes_):
         self.resource.write(bytes_)
 
+    def fileno(self):
+        return self.resource.fileno()
+
+    def write_at(self, offset, bytes_):
+        """Writes all bytes at an absolute offset, without moving the file
+        position where ``os.pwrite`` is available. Open the file unbuffered
+        as Python's buffer would otherwise be bypassed.
+        """
+
+        if hasattr(os, 'pwrite'):
+            fd = self.resource.fileno()
+            view = memoryview(bytes_)
+            while view:
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+            return
+
+        self.resource.seek(offset)
+        self.resource.write(bytes_)
+
     def seek(self, offset):
         self.resource.seek(offset)
 
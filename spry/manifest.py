@@ -0,0 +1,294 @@
+import binascii
+import hashlib
+import os
+import xml.etree.ElementTree as ElementTree
+
+from spry.db import ManifestEntry, get_db_session
+from spry.io import import_requests
+from spry.ranges import RangeFetcher
+from spry.utils import MEBIBYTE, parse_fname_from_url
+from spry.workers import Latch, WorkerPool
+
+# Large enough that a manifest of a huge file stays small, small enough
+# that repairing a corrupt block does not mean fetching much else.
+BLOCK_SIZE = MEBIBYTE * 4
+
+HASH_ALGORITHM = 'sha256'
+
+# Threads hashing blocks when no pool is given
+HASH_THREADS = 4
+
+METALINK_NAMESPACE = '{urn:ietf:params:xml:ns:metalink}'
+
+
+def get_hash_name(name):
+    """
+    Returns the :mod:`hashlib` name of a Metalink hash type, raising
+    :class:`ValueError` if it is not available.
+
+    Examples:
+        'sha-256' returns 'sha256'
+    """
+
+    name = (name or '').lower().replace('-', '')
+    try:
+        hashlib.new(name)
+    except ValueError:
+        raise ValueError('unsupported hash type: {}'.format(name))
+    return name
+
+
+def get_block_count(size, block_size):
+    return -(-size // block_size)
+
+
+def hash_blocks(path, size, block_size=BLOCK_SIZE, algorithm=HASH_ALGORITHM, indexes=None, pool=None):
+    """Returns the digests of the blocks of the first ``size`` bytes of the
+    file at ``path``, of every block or only of the block numbers in
+    ``indexes``, in their order. Blocks are read and hashed on the threads
+    of ``pool``, as both release the GIL a large file is hashed on several
+    cores at once. Blocks the file is too short for are hashed as far as
+    they go.
+    """
+
+    indexes = list(range(get_block_count(size, block_size)) if indexes is None else indexes)
+    digests = [None] * len(indexes)
+    pool = pool if pool is not None else WorkerPool(HASH_THREADS)
+    latch = Latch()
+
+    # Each block is read through a file of its own, as threads sharing
+    # one would move each other's position.
+    def hash_block(position, index):
+        try:
+            offset = index * block_size
+            digest = hashlib.new(algorithm)
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                digest.update(f.read(min(block_size, size - offset)))
+            digests[position] = digest.digest()
+        except Exception as e:
+            latch.fail(e)
+        else:
+            latch.done()
+
+    for position, index in enumerate(indexes):
+        latch.add()
+        pool.submit(hash_block, position, index)
+    latch.wait()
+
+    return digests
+
+
+class Manifest:
+    """The digest of every ``block_size`` block of a file, so that the file
+    can later be checked for corruption and repaired by fetching only the
+    blocks that no longer match. The last block is usually shorter.
+
+    :param size: The size of the file in bytes.
+    :type size: int
+    :param block_size: The size of each block in bytes.
+    :type block_size: int
+    :param hashes: The digest of each block as bytes, in order.
+    :type hashes: list
+    :param algorithm: The :mod:`hashlib` name of the hash. Default: ``sha256``
+    :type algorithm: str
+    :param url: Where the file can be fetched from. Default: ``None``
+    :type url: str or ``None``
+    """
+
+    def __init__(self, size, block_size, hashes, algorithm=HASH_ALGORITHM, url=None):
+        if len(hashes) != get_block_count(size, block_size):
+            raise ValueError('{} hashes for {} blocks'.format(len(hashes), get_block_count(size, block_size)))
+
+        self.size = size
+        self.block_size = block_size
+        self.hashes = hashes
+        self.algorithm = algorithm
+        self.url = url
+
+    @classmethod
+    def from_file(cls, path, block_size=BLOCK_SIZE, algorithm=HASH_ALGORITHM, url=None, pool=None):
+        size = os.path.getsize(path)
+        return cls(size, block_size, hash_blocks(path, size, block_size, algorithm, pool=pool), algorithm, url)
+
+    def get_range(self, index):
+        """Returns the inclusive ``(start, end)`` byte range of a block"""
+
+        start = index * self.block_size
+        return start, min(start + self.block_size, self.size) - 1
+
+    def verify(self, path, indexes=None, pool=None):
+        """Re-hashes the blocks of the file at ``path``, all of them or only
+        those in ``indexes``, and returns the numbers of those that do not
+        match. Bytes past the manifest's size are not checked.
+        """
+
+        indexes = list(range(len(self.hashes)) if indexes is None else indexes)
+        if not os.path.isfile(path):
+            return indexes
+
+        digests = hash_blocks(path, self.size, self.block_size, self.algorithm, indexes, pool)
+        return [index for index, digest in zip(indexes, digests) if digest != self.hashes[index]]
+
+    def repair(self, path, url=None, session=None, pool=None, **kwargs):
+        """Fetches only the blocks of the file at ``path`` that do not match
+        with range requests to ``url``, by default the URL the manifest was
+        made for, writing each at its offset. Bytes past the manifest's size
+        are cut off. Returns the numbers of the blocks that were fetched.
+
+        :raises IOError: If fetched blocks do not match either, e.g. because
+                         the remote file changed.
+        """
+
+        url = url or self.url
+        if not url:
+            raise ValueError('the manifest of {} has no URL to repair it from'.format(path))
+
+        pool = pool if pool is not None else WorkerPool(HASH_THREADS)
+        broken = self.verify(path, pool=pool)
+
+        if broken:
+            # No gap, the blocks in between are fine
+            fetcher = RangeFetcher(url, session=session, gap=0, pool=pool, **kwargs)
+            fetcher.fetch([self.get_range(index) for index in broken], output=path)
+
+            still_broken = self.verify(path, broken, pool=pool)
+            if still_broken:
+                raise IOError('{} of {} fetched blocks of {} do not match'.format(
+                    len(still_broken), len(broken), url
+                ))
+
+        if os.path.exists(path) and os.path.getsize(path) != self.size:
+            with open(path, 'r+b') as f:
+                f.truncate(self.size)
+
+        return broken
+
+    def to_bytes(self):
+        return b''.join(self.hashes)
+
+    @classmethod
+    def from_bytes(cls, data, size, block_size, algorithm=HASH_ALGORITHM, url=None):
+        digest_size = hashlib.new(algorithm).digest_size
+        hashes = [data[i:i + digest_size] for i in range(0, len(data), digest_size)]
+        return cls(size, block_size, hashes, algorithm, url)
+
+
+def parse_metalink(data, name=None):
+    """
+    Returns a :class:`Manifest` made from the piece hashes of a Metalink 4
+    document (RFC 5854) for the file called ``name``, or else for its first
+    file with piece hashes of a supported type. Returns ``None`` if there
+    is no such file.
+    """
+
+    root = ElementTree.fromstring(data)
+    manifests = []
+
+    for element in root.iter(METALINK_NAMESPACE + 'file'):
+        pieces = element.find(METALINK_NAMESPACE + 'pieces')
+        size = element.findtext(METALINK_NAMESPACE + 'size')
+        if pieces is None or size is None:
+            continue
+
+        try:
+            algorithm = get_hash_name(pieces.get('type'))
+            hashes = [
+                binascii.unhexlify(piece.text.strip()) for piece in pieces.findall(METALINK_NAMESPACE + 'hash')
+            ]
+            url = element.findtext(METALINK_NAMESPACE + 'url')
+            manifest = Manifest(int(size), int(pieces.get('length')), hashes, algorithm, url and url.strip())
+        except (TypeError, ValueError, binascii.Error):
+            continue
+
+        if element.get('name') == name:
+            return manifest
+        manifests.append(manifest)
+
+    return manifests[0] if manifests else None
+
+
+def fetch_metalink(location, session=None, name=None, **kwargs):
+    """Returns the :class:`Manifest` from a Metalink document, which is
+    either a local file or a URL. See :func:`parse_metalink`.
+    """
+
+    if os.path.isfile(location):
+        with open(location, 'rb') as f:
+            data = f.read()
+    else:
+        response = (session or import_requests()).get(location, **kwargs)
+        response.raise_for_status()
+        data = response.content
+
+    return parse_metalink(data, name)
+
+
+class ManifestStore:
+    """Records a :class:`Manifest` of downloaded files in the database next
+    to the other session data, keyed by where the files were saved, so that
+    they can be verified and repaired long after. Servers linking to a
+    Metalink document with piece hashes have those recorded instead, as
+    they are known to be right, whereas hashes of a downloaded file only
+    catch corruption happening after the download.
+
+    :param block_size: The size of hashed blocks. Default: 4 MiB
+    :type block_size: int
+    :param algorithm: The :mod:`hashlib` name of the hash. Default: ``sha256``
+    :type algorithm: str
+    :param threads: The number of threads hashing a file. Default: 4
+    :type threads: int
+    """
+
+    def __init__(self, block_size=BLOCK_SIZE, algorithm=HASH_ALGORITHM, threads=HASH_THREADS):
+        self.block_size = block_size
+        self.algorithm = algorithm
+        self.threads = threads
+
+    def record(self, url, path, metalink_url=None, session=None):
+        """Saves the manifest of the file at ``path`` downloaded from ``url``
+        and returns it. The piece hashes of the Metalink document at
+        ``metalink_url`` are used if they are of a file this size.
+        """
+
+        manifest = None
+        size = os.path.getsize(path)
+
+        if metalink_url:
+            try:
+                manifest = fetch_metalink(metalink_url, session, name=parse_fname_from_url(url))
+            except (IOError, ValueError, ElementTree.ParseError):
+                manifest = None
+
+        if manifest is None or manifest.size != size:
+            manifest = Manifest.from_file(path, self.block_size, self.algorithm, pool=WorkerPool(self.threads))
+
+        manifest.url = url
+        self.save(path, manifest)
+
+        return manifest
+
+    def save(self, path, manifest):
+        db = get_db_session()
+        local_path = os.path.abspath(path)
+
+        entry = db.query(ManifestEntry).filter_by(local_path=local_path).first()
+        if entry is None:
+            entry = ManifestEntry(local_path=local_path)
+            db.add(entry)
+
+        entry.url = manifest.url
+        entry.size = manifest.size
+        entry.block_size = manifest.block_size
+        entry.algorithm = manifest.algorithm
+        entry.hashes = manifest.to_bytes()
+        db.commit()
+
+    def load(self, path):
+        """Returns the manifest recorded for the file at ``path`` or ``None``"""
+
+        entry = get_db_session().query(ManifestEntry).filter_by(local_path=os.path.abspath(path)).first()
+        if entry is None:
+            return None
+
+        return Manifest.from_bytes(entry.hashes, entry.size, entry.block_size, entry.algorithm, entry.url)
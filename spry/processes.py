@@ -0,0 +1,264 @@
+import multiprocessing
+import threading
+
+from spry.progress import TransferStats
+from spry.sessions import FileSync
+
+# Seconds between progress reports sent by worker processes
+REPORT_INTERVAL = 0.25
+
+# Arguments that only make sense in the parent process. Worker processes
+# create their own connections, trackers, limiters and threads, which is
+# why a Session's per-host connection budget cannot apply to them.
+PARENT_ONLY = (
+    'connection_pool', 'connections', 'disk', 'hooks', 'limiter', 'pool', 'session', 'space', 'stats', 'tracker'
+)
+
+
+class ProcessGroup:
+    """The transfers of a :class:`~spry.sessions.Session` running in worker
+    processes. Worker processes cannot share the session's limiter directly,
+    so when it is promoted its limit is split between them by priority and
+    pushed to each one as its own limit.
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.members = set()
+        self.lock = threading.Lock()
+
+    def join(self, transfer):
+        with self.lock:
+            self.members.add(transfer)
+
+    def leave(self, transfer):
+        with self.lock:
+            self.members.discard(transfer)
+
+    def get_limit(self, transfer):
+        """Returns the limit in bytes per second for a member, 0 meaning
+        unlimited, or ``None`` if the transfer's own limit applies.
+        """
+
+        if not self.limiter:
+            return None
+        elif not self.limiter.limit:
+            return 0
+
+        with self.lock:
+            total_weight = sum(member.priority for member in self.members) or transfer.priority
+
+        return max(int(self.limiter.limit * transfer.priority / total_weight), 1)
+
+
+class ProcessFileSync(FileSync):
+    """Runs a transfer in a worker process to scale past the GIL, mirroring
+    its progress, timings and state in this process. It behaves like the
+    wrapped :class:`~spry.sessions.FileSync` so a Session schedules it the
+    same way, and ``pause``, ``resume``, ``stop`` and speed limits are
+    forwarded to the worker.
+
+    Workers are started with the ``spawn`` method, so scripts using this
+    must guard their entry point with ``if __name__ == '__main__'``.
+
+    :param cls: The :class:`~spry.sessions.FileSync` subclass to run, e.g.
+                :class:`~spry.http.HTTPFileSync`. It must be importable.
+    :param group: The :class:`ProcessGroup` sharing a Session's limit.
+                  Default: ``None``
+    """
+
+    def __init__(self, cls, method, remote_path, local_path, group=None, **kwargs):
+        # Set first, as the base class applies speed limits through
+        # set_speed_limit, which forwards them to the worker.
+        self.kwargs = dict((key, value) for key, value in kwargs.items() if key not in PARENT_ONLY)
+        self.conn = None
+        self.send_lock = threading.Lock()
+
+        super(ProcessFileSync, self).__init__(
+            method, remote_path, local_path, keep=kwargs.get('keep', False), parts=kwargs.get('parts', 4),
+            speed_limit=kwargs.get('speed_limit'), restart=kwargs.get('restart', False),
+            tracker=kwargs.get('tracker'), limiter=kwargs.get('limiter'), stats=kwargs.get('stats'),
+            priority=kwargs.get('priority', 1), deadline=kwargs.get('deadline'),
+            size_hint=kwargs.get('size_hint'), shared_limiter=kwargs.get('shared_limiter')
+        )
+        self.cls = cls
+        self.group = group
+
+        self.process = None
+        self.sent_limit = None
+        self.alive = False
+        self.succeeded = False
+
+    def finish(self):
+        # Done by the worker process before reporting success
+        pass
+
+    def _spawn(self, *args, **kwargs):
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+
+        self.process = context.Process(
+            target=run_transfer,
+            args=(self.cls, self.method, self.remote_path, self.local_path, self.kwargs, child_conn)
+        )
+        self.process.daemon = True
+
+        self.alive = True
+        self.succeeded = False
+        self.sent_limit = None
+        self.process.start()
+        child_conn.close()
+
+        if self.group is not None:
+            self.group.join(self)
+
+        thread = threading.Thread(target=self._listen)
+        thread.daemon = True
+        thread.start()
+
+    def _listen(self):
+        tracker = self.tracker
+
+        try:
+            while True:
+                self._update_limit()
+
+                if not self.conn.poll(REPORT_INTERVAL):
+                    continue
+
+                message = self.conn.recv()
+                kind = message[0]
+
+                if kind == 'progress':
+                    _, received, grown, timings = message
+
+                    if grown:
+                        tracker.grow(grown)
+                    if received > 0:
+                        tracker.add(received)
+                    elif received < 0:
+                        tracker.remove(-received)
+                    if timings:
+                        self.stats.add(**timings)
+
+                elif kind == 'path':
+                    self.local_path = message[1]
+
+                elif kind == 'done':
+                    self.succeeded = message[1]
+                    break
+
+        # The worker died without reporting, which counts as a failure
+        except (EOFError, OSError):
+            pass
+
+        finally:
+            if self.group is not None:
+                self.group.leave(self)
+
+            with self.send_lock:
+                self.conn.close()
+
+            self.process.join()
+            self.alive = False
+
+    def _update_limit(self):
+        if self.group is None:
+            return
+
+        limit = self.group.get_limit(self)
+        if limit is not None and limit != self.sent_limit:
+            self.sent_limit = limit
+            self._send('limit', limit)
+
+    def _send(self, *message):
+        with self.send_lock:
+            if self.conn is not None and not self.conn.closed:
+                try:
+                    self.conn.send(message)
+                except (EOFError, OSError):
+                    pass
+
+    def is_alive(self):
+        return self.alive
+
+    def success(self):
+        return self.succeeded
+
+    def stop(self):
+        self._send('stop')
+
+    def pause(self):
+        self._send('pause')
+
+    def resume(self):
+        self._send('resume')
+
+    def set_speed_limit(self, value, unit='KiB'):
+        super(ProcessFileSync, self).set_speed_limit(value, unit)
+        self.kwargs['speed_limit'] = self.speed_limit
+        self._send('limit', self.limiter.limit or 0)
+
+
+def run_transfer(cls, method, remote_path, local_path, kwargs, conn):
+    """The entry point of worker processes. Runs a transfer, applies commands
+    sent by the parent and reports progress deltas until it finishes.
+    """
+
+    reported = {'total': 0, 'size': 0, 'stats': dict.fromkeys(TransferStats.FIELDS, 0.0)}
+
+    def report():
+        total, size = transfer.tracker.total, transfer.tracker.size
+        stats = transfer.stats.get_stats()
+        timings = dict((field, stats[field] - reported['stats'][field]) for field in TransferStats.FIELDS)
+
+        conn.send(('progress', total - reported['total'], size - reported['size'], timings))
+        reported.update(total=total, size=size, stats=stats)
+
+    try:
+        transfer = cls(method, remote_path, local_path, **kwargs)
+        transfer.run()
+    except Exception:
+        conn.send(('done', False))
+        conn.close()
+        return
+
+    conn.send(('path', transfer.local_path))
+
+    try:
+        while True:
+            while conn.poll():
+                message = conn.recv()
+                command = message[0]
+
+                if command == 'stop':
+                    transfer.stop()
+                elif command == 'pause':
+                    transfer.pause()
+                elif command == 'resume':
+                    transfer.resume()
+                elif command == 'limit':
+                    transfer.limiter.set_limit(message[1])
+
+            report()
+
+            if not transfer.is_alive():
+                break
+            transfer.monitor()
+
+            # Doubles as a sleep that wakes up early for commands
+            conn.poll(REPORT_INTERVAL)
+
+        report()
+
+        succeeded = transfer.success()
+        if succeeded:
+            transfer.finish()
+        conn.send(('done', succeeded))
+
+    # The parent went away, there is nobody left to transfer for
+    except (EOFError, OSError):
+        transfer.stop()
+
+    finally:
+        conn.close()
@@ -1,52 +1,114 @@
 from __future__ import division
 
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import defaultdict, deque
-from threading import Lock
+from threading import Condition, Lock
 from time import sleep, time
 
-from spry.utils import CHUNK_SIZE
+from spry.utils import CHUNK_SIZE, disk_usage, find_existing_dir, get_allocated_size
 
 
 class SpeedLimiter:
-    def __init__(self, limit=None, request_size=CHUNK_SIZE, parent=None):
+    __slots__ = ('limit', 'request_size', 'parent', 'priority', 'weight', 'lock', 'requested', 'start_time',
+                 'child_requested', 'child_weights', 'previous_weights', 'shared')
+
+    def __init__(self, limit=None, request_size=CHUNK_SIZE, parent=None, weight=1, shared=None):
         self.limit = limit
         self.request_size = request_size
         self.parent = parent
         self.priority = False
+        self.weight = weight
         self.lock = Lock()
 
         self.requested = 0
         self.start_time = time()
 
-    def get(self):
+        # Per-child accounting for splitting our limit by weight. Children
+        # which requested nothing during the current or previous window are
+        # considered idle and do not count towards the split.
+        self.child_requested = defaultdict(int)
+        self.child_weights = {}
+        self.previous_weights = {}
+
+        # An optional SharedLimiter capping what is allowed here by what
+        # every process on the host may receive.
+        self.shared = shared
+
+    def get(self, child=None):
 
         if self.parent:
-            return self.parent.get()
+            return self.parent.get(self)
 
-        with self.lock:
-            request_size = self.request_size
+        request_size = self._get(child)
+
+        if self.shared is not None:
+            request_size = self.shared.get(request_size)
+
+        return request_size
+
+    def _get(self, child):
+        while True:
+            with self.lock:
+                request_size = self.request_size
+
+                if not self.limit:
+                    return request_size
+
+                now = time()
+                if now - self.start_time >= 1:
+                    self._next_window(now)
+
+                allowance = self.limit - self.requested
+
+                if child is not None and allowance > 0:
+                    allowance = self._child_allowance(child, allowance)
+
+                if allowance > 0:
+                    request_size = min(request_size, allowance)
+                    self.requested += request_size
+
+                    if child is not None:
+                        self.child_requested[child] += request_size
+
+                    return request_size
 
-            if self.limit:
+                wait = self.start_time + 1 - now
 
-                if self.requested + request_size >= self.limit:
-                    request_size = self.limit - self.requested
+            # Sleep outside the lock so other children can still
+            # claim what remains of their share in this window.
+            sleep(max(wait, 0))
 
-                    if request_size <= 0:
-                        self.requested = 0
-                        time_elapsed = time() - self.start_time
+    def _next_window(self, now):
+        self.requested = 0
+        self.start_time = now
+        self.previous_weights = self.child_weights
+        self.child_weights = {}
+        self.child_requested.clear()
+
+    def _child_allowance(self, child, allowance):
+        self.child_weights[child] = child.weight
 
-                        if time_elapsed < 1:
-                            sleep(1 - time_elapsed)
-                        self.start_time = time()
+        weights = dict(self.previous_weights)
+        weights.update(self.child_weights)
+        if len(weights) == 1:
+            return allowance
 
-                        if self.limit and self.requested + self.request_size >= self.limit:
-                            request_size = self.limit - self.requested
-                        else:
-                            request_size = self.request_size
+        total_weight = sum(weights.values())
+        share = self.limit * child.weight / total_weight
+        own_remaining = share - self.child_requested[child]
 
-                self.requested += request_size
+        # Bandwidth not reserved for other active children's shares
+        # is free for whoever asks, so no capacity is left unused.
+        reserved = 0
+        for other, weight in weights.items():
+            if other is not child:
+                reserved += max(0, self.limit * weight / total_weight - self.child_requested[other])
 
-            return request_size
+        return int(min(allowance, max(own_remaining, allowance - reserved)))
 
     def set_limit(self, limit):
         with self.lock:
@@ -56,6 +118,11 @@ class SpeedLimiter:
         with self.lock:
             self.request_size = size
 
+    def set_weight(self, weight):
+        if weight <= 0:
+            raise ValueError('weight must be positive')
+        self.weight = weight
+
     def promote(self):
         self.priority = True
 
@@ -70,8 +137,486 @@ class SpeedLimiter:
     def __bool__(self):
         return self.priority
 
+    __nonzero__ = __bool__
+
+
+class ConnectionLimiter:
+    """Caps the number of simultaneous connections per origin. A single
+    instance is shared by every transfer of a :class:`~spry.sessions.Session`
+    so that e.g. 4 files split into 4 parts on the same host never open
+    more connections than the server tolerates, while transfers to other
+    hosts are unaffected.
+
+    :param limit: The maximum number of connections per origin. A falsy
+                  value means no limit. Default: ``None``
+    :type limit: int or ``None``
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.active = defaultdict(int)
+        self.condition = Condition()
+
+        # Callbacks waiting for a slot per origin, in order, see acquire_later
+        self.waiters = defaultdict(deque)
+
+    def acquire(self, origin, timeout=None, cancel=None):
+        """Blocks until a connection slot for ``origin`` is free, until
+        ``timeout`` seconds have passed or until the ``cancel`` event is
+        set and :meth:`interrupt` called. Returns whether a slot was taken.
+        """
+
+        with self.condition:
+            if timeout is not None:
+                end_time = time() + timeout
+
+            while self.limit and self.active[origin] >= self.limit:
+                if cancel is not None and cancel.is_set():
+                    return False
+                elif timeout is None:
+                    self.condition.wait()
+                else:
+                    remaining = end_time - time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+
+            self.active[origin] += 1
+            return True
+
+    def acquire_later(self, origin, callback):
+        """Takes a slot for ``origin`` and calls ``callback``, right away if
+        one is free or else from whoever releases one, so that nothing blocks
+        meanwhile. Returns whether ``callback`` was called right away.
+        """
+
+        with self.condition:
+            if self.limit and (self.active[origin] >= self.limit or self.waiters.get(origin)):
+                self.waiters[origin].append(callback)
+                return False
+            self.active[origin] += 1
+
+        callback()
+        return True
+
+    def cancel(self, origin, callback):
+        """Withdraws a ``callback`` passed to :meth:`acquire_later`. Returns
+        whether it was still waiting, otherwise it was or is being called.
+        """
+
+        with self.condition:
+            waiters = self.waiters.get(origin)
+            if not waiters or callback not in waiters:
+                return False
+
+            waiters.remove(callback)
+            if not waiters:
+                del self.waiters[origin]
+            return True
+
+    def release(self, origin):
+        with self.condition:
+            # The slot goes straight to the next waiting callback, if any
+            self.active[origin] -= 1
+            callbacks = self._pop_waiters(origin)
+            if self.active[origin] <= 0:
+                del self.active[origin]
+
+            # Wake everyone, waiters for other origins will simply recheck
+            self.condition.notify_all()
+
+        for callback in callbacks:
+            callback()
+
+    def set_limit(self, limit):
+        with self.condition:
+            self.limit = limit
+
+            callbacks = []
+            for origin in list(self.waiters):
+                callbacks.extend(self._pop_waiters(origin))
+
+            self.condition.notify_all()
+
+        for callback in callbacks:
+            callback()
+
+    def _pop_waiters(self, origin):
+        # Takes slots for as many waiting callbacks as fit and returns them
+        waiters = self.waiters.get(origin)
+        callbacks = []
+
+        while waiters and (not self.limit or self.active[origin] < self.limit):
+            callbacks.append(waiters.popleft())
+            self.active[origin] += 1
+
+        if waiters is not None and not waiters:
+            del self.waiters[origin]
+        return callbacks
+
+    def interrupt(self):
+        """Wakes all waiters so cancelled ones can give up"""
+
+        with self.condition:
+            self.condition.notify_all()
+
+    def get_active(self, origin):
+        with self.condition:
+            return self.active.get(origin, 0)
+
+
+class SpaceLedger:
+    """Reserves disk space for files before they are written, so that
+    transfers starting together can not all pass a free space check and then
+    fail halfway once the disk fills up. A single instance is shared by every
+    transfer of a :class:`~spry.sessions.Session`.
+
+    Free space reported by the file system already accounts for what was
+    written, so a reservation only holds back the part of its file that is
+    not allocated yet. Sparse files therefore hold back less and less as
+    they are written, while preallocated ones hold back nothing.
+    """
+
+    def __init__(self):
+        # Maps path -> (device, size)
+        self.reservations = {}
+        self.releases = 0
+        self.lock = Lock()
+
+    def reserve(self, path, size):
+        """Reserves ``size`` bytes for a file at ``path``. Returns whether
+        there was enough space, which may free up once others are released.
+
+        :raises OSError: If there is not enough space even without any
+                         reservations.
+        """
+
+        directory = find_existing_dir(os.path.dirname(path))
+
+        with self.lock:
+            device = os.stat(directory).st_dev
+            free = disk_usage(directory)['free']
+
+            # The space of a file we are about to replace is ours to reuse
+            needed = size - get_allocated_size(path)
+
+            if needed >= free:
+                raise OSError('insufficient storage space remaining')
+            elif needed >= free - self._get_outstanding(device, path):
+                return False
+
+            self.reservations[path] = (device, size)
+            return True
+
+    def _get_outstanding(self, device, exclude=None):
+        outstanding = 0
+        for path, (reserved_device, size) in self.reservations.items():
+            if reserved_device == device and path != exclude:
+                outstanding += max(size - get_allocated_size(path), 0)
+        return outstanding
+
+    def release(self, path):
+        """Releases the reservation of a file once it is complete or will
+        not be written to anymore.
+        """
+
+        with self.lock:
+            if self.reservations.pop(path, None) is not None:
+                self.releases += 1
+
+
+class CompletionMap:
+    """The byte ranges of a file that were persisted, kept as a set of
+    disjoint intervals. Ranges added are merged with those they overlap or
+    touch, and any range can be removed again, e.g. when its bytes turn out
+    to be wrong, which leaves a hole.
+
+    Intervals are sorted in chunks of at most 1024, each a pair of arrays
+    of offsets, with the bounds of every chunk in lists to binary search.
+    Lookups are two binary searches and changes only move the offsets of
+    one chunk, so maps stay fast and take 16 bytes per interval even with
+    millions of them, e.g. from verifying every block of a huge file.
+
+    Offsets are inclusive, like those of :class:`~spry.sessions.Section`.
+    The map is a record kept next to the sections, it does not replace
+    them: streamers still advance their section's offsets and roll back
+    their progress, and resuming still starts from the sections.
+
+    :param size: The size of the file, if known, which bounds the missing
+                 ranges. Default: ``None``
+    :type size: int or ``None``
+    """
+
+    # Intervals per chunk before it is split in two
+    CHUNK_SIZE = 1024
+
+    # Little-endian size followed by the offsets, -1 for an unknown size
+    HEADER = struct.Struct('<q')
+
+    def __init__(self, size=None):
+        self.size = size
+        self.completed = 0
+        self.lock = Lock()
+
+        # Intervals are half-open [start, end) here, i.e. ends are exclusive
+        self.starts = []
+        self.ends = []
+
+        # The first start and last end of every chunk
+        self.firsts = []
+        self.lasts = []
+
+    # Positions of intervals are (chunk, index) tuples. Those past the end
+    # of a chunk are at index 0 of the next one.
+
+    def _first_ending_from(self, offset, right=False):
+        """The position of the first interval ending at or, if ``right``,
+        after ``offset``.
+        """
+
+        find = bisect_right if right else bisect_left
+        chunk = find(self.lasts, offset)
+        if chunk == len(self.lasts):
+            return chunk, 0
+        return chunk, find(self.ends[chunk], offset)
+
+    def _first_starting_from(self, offset, right=False):
+        """The position of the first interval starting at or, if ``right``,
+        after ``offset``.
+        """
+
+        find = bisect_right if right else bisect_left
+        chunk = find(self.firsts, offset)
+        if not chunk:
+            return 0, 0
+
+        chunk -= 1
+        index = find(self.starts[chunk], offset)
+        if index == len(self.starts[chunk]):
+            return chunk + 1, 0
+        return chunk, index
+
+    def _previous(self, position):
+        chunk, index = position
+        if index:
+            return chunk, index - 1
+        elif chunk:
+            return chunk - 1, len(self.starts[chunk - 1]) - 1
+        return None
+
+    def _between(self, first, last):
+        """Yields the intervals from position ``first`` up to ``last``"""
+
+        chunk, index = first
+        while (chunk, index) < last:
+            starts, ends = self.starts[chunk], self.ends[chunk]
+            end = last[1] if chunk == last[0] else len(starts)
+            for i in range(index, end):
+                yield starts[i], ends[i]
+            chunk, index = chunk + 1, 0
+
+    def _replace(self, first, last, starts, ends):
+        """Replaces the intervals from position ``first`` up to ``last``"""
+
+        (chunk, index), (last_chunk, last_index) = first, last
+        all_starts, all_ends = self.starts, self.ends
+
+        if not all_starts:
+            if starts:
+                all_starts.append(array('q', starts))
+                all_ends.append(array('q', ends))
+                self.firsts.append(starts[0])
+                self.lasts.append(ends[-1])
+            return
+
+        # Past the end is the end of the last chunk
+        if chunk == len(all_starts):
+            chunk = last_chunk = len(all_starts) - 1
+            index = last_index = len(all_starts[chunk])
+        elif last_chunk > chunk and not last_index:
+            last_chunk -= 1
+            last_index = len(all_starts[last_chunk])
+
+        if last_chunk == chunk:
+            all_starts[chunk][index:last_index] = array('q', starts)
+            all_ends[chunk][index:last_index] = array('q', ends)
+        else:
+            # What remains of the last chunk joins the first one
+            all_starts[chunk][index:] = array('q', starts) + all_starts[last_chunk][last_index:]
+            all_ends[chunk][index:] = array('q', ends) + all_ends[last_chunk][last_index:]
+            for chunks in (all_starts, all_ends, self.firsts, self.lasts):
+                del chunks[chunk + 1:last_chunk + 1]
+
+        chunk_starts, chunk_ends = all_starts[chunk], all_ends[chunk]
+        if not chunk_starts:
+            for chunks in (all_starts, all_ends, self.firsts, self.lasts):
+                del chunks[chunk]
+            return
+
+        if len(chunk_starts) > self.CHUNK_SIZE:
+            half = len(chunk_starts) // 2
+            all_starts.insert(chunk + 1, chunk_starts[half:])
+            all_ends.insert(chunk + 1, chunk_ends[half:])
+            self.firsts.insert(chunk + 1, chunk_starts[half])
+            self.lasts.insert(chunk + 1, chunk_ends[-1])
+            del chunk_starts[half:]
+            del chunk_ends[half:]
+
+        self.firsts[chunk] = chunk_starts[0]
+        self.lasts[chunk] = chunk_ends[-1]
+
+    def add(self, start, end):
+        """Marks bytes ``start`` through ``end`` as completed"""
+
+        if end < start:
+            return
+
+        stop = end + 1
+        with self.lock:
+            # Intervals overlapping or touching the new one
+            first = self._first_ending_from(start)
+            last = self._first_starting_from(stop, right=True)
+
+            covered = 0
+            for i, (interval_start, interval_end) in enumerate(self._between(first, last)):
+                if not i:
+                    start = min(start, interval_start)
+                stop = max(stop, interval_end)
+                covered += interval_end - interval_start
+
+            self._replace(first, last, [start], [stop])
+            self.completed += stop - start - covered
+
+    def remove(self, start, end):
+        """Marks bytes ``start`` through ``end`` as missing again"""
+
+        if end < start:
+            return
+
+        stop = end + 1
+        with self.lock:
+            # Intervals overlapping the removed range
+            first = self._first_ending_from(start, right=True)
+            last = self._first_starting_from(stop)
+
+            intervals = list(self._between(first, last))
+            if not intervals:
+                return
+
+            # Whatever sticks out on either side stays
+            kept_starts, kept_ends = [], []
+            if intervals[0][0] < start:
+                kept_starts.append(intervals[0][0])
+                kept_ends.append(start)
+            if intervals[-1][1] > stop:
+                kept_starts.append(stop)
+                kept_ends.append(intervals[-1][1])
+
+            self._replace(first, last, kept_starts, kept_ends)
+            self.completed -= (sum(e - s for s, e in intervals) -
+                               sum(e - s for s, e in zip(kept_starts, kept_ends)))
+
+    def contains(self, start, end):
+        """Returns whether bytes ``start`` through ``end`` are all completed"""
+
+        with self.lock:
+            previous = self._previous(self._first_starting_from(start, right=True))
+            return previous is not None and self.ends[previous[0]][previous[1]] > end
+
+    def next_missing(self, offset=0):
+        """Returns the first missing ``(start, end)`` range at or after
+        ``offset``, or ``None`` if there is none. Without a size, the range
+        after the last completed byte is unbounded and not returned.
+        """
+
+        with self.lock:
+            position = self._first_starting_from(offset, right=True)
+
+            previous = self._previous(position)
+            if previous is not None:
+                offset = max(offset, self.ends[previous[0]][previous[1]])
+
+            chunk, index = position
+            if chunk < len(self.starts):
+                end = self.starts[chunk][index] - 1
+            elif self.size is not None:
+                end = self.size - 1
+            else:
+                return None
+
+        if self.size is not None:
+            end = min(end, self.size - 1)
+        return (offset, end) if offset <= end else None
+
+    def missing(self):
+        """Yields every missing ``(start, end)`` range in order"""
+
+        gap = self.next_missing()
+        while gap is not None:
+            yield gap
+            gap = self.next_missing(gap[1] + 1)
+
+    def is_complete(self):
+        return self.size is not None and self.completed >= self.size
+
+    def clear(self):
+        with self.lock:
+            for chunks in (self.starts, self.ends, self.firsts, self.lasts):
+                del chunks[:]
+            self.completed = 0
+
+    def to_bytes(self):
+        """Returns the map in a compact form, e.g. to be stored, restored by
+        :meth:`from_bytes`.
+        """
+
+        with self.lock:
+            offsets = array('q')
+            for starts, ends in zip(self.starts, self.ends):
+                pairs = array('q', (0,)) * (2 * len(starts))
+                pairs[0::2] = starts
+                pairs[1::2] = ends
+                offsets += pairs
+
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        return self.HEADER.pack(-1 if self.size is None else self.size) + offsets.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        size, = cls.HEADER.unpack_from(data)
+        completion = cls(None if size < 0 else size)
+
+        offsets = array('q')
+        offsets.frombytes(data[cls.HEADER.size:])
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+
+        # Chunks start half full so that either kind of change is cheap
+        step = 2 * max(cls.CHUNK_SIZE // 2, 1)
+        for i in range(0, len(offsets), step):
+            starts, ends = offsets[i:i + step:2], offsets[i + 1:i + step:2]
+            completion.starts.append(starts)
+            completion.ends.append(ends)
+            completion.firsts.append(starts[0])
+            completion.lasts.append(ends[-1])
+            completion.completed += sum(ends) - sum(starts)
+
+        return completion
+
+    def __iter__(self):
+        with self.lock:
+            intervals = list(self._between((0, 0), (len(self.starts), 0)))
+        for start, stop in intervals:
+            yield start, stop - 1
+
+    def __len__(self):
+        return sum(len(starts) for starts in self.starts)
+
 
 class ProgressTracker:
+    __slots__ = ('_size', '_window', 'parent', 'total', 'is_finished', 'lock', 'times', 'time_total')
+
     def __init__(self, size=0, window=10, parent=None):
         self._size = size
         self._window = window
@@ -166,6 +711,8 @@ class ProgressTracker:
 
 
 class Counter:
+    __slots__ = ('total', 'lock')
+
     def __init__(self):
         self.total = 0
         self.lock = Lock()
@@ -181,3 +728,49 @@ class Counter:
     def __lt__(self, other):
         with self.lock:
             return self.total < other
+
+
+class TransferStats:
+    """Accumulates where a transfer's time goes. Streamers report in bulk at
+    the end of each connection attempt, and disk writers per buffer, so a
+    disk that cannot keep up shows as ``disk`` and ``backpressure`` time
+    rather than as a slow network.
+
+    - ``network``: seconds spent waiting on socket reads.
+    - ``disk``: seconds spent writing to disk.
+    - ``backpressure``: seconds readers waited for the in-flight memory
+      budget, i.e. for disk writers to catch up.
+    - ``limiter``: seconds spent waiting on the speed limiter.
+    """
+
+    FIELDS = ('network', 'disk', 'backpressure', 'limiter')
+
+    __slots__ = ('parent', 'lock') + FIELDS
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.lock = Lock()
+        self.network = 0.0
+        self.disk = 0.0
+        self.backpressure = 0.0
+        self.limiter = 0.0
+
+    def add(self, network=0.0, disk=0.0, backpressure=0.0, limiter=0.0):
+
+        if self.parent:
+            self.parent.add(network, disk, backpressure, limiter)
+
+        with self.lock:
+            self.network += network
+            self.disk += disk
+            self.backpressure += backpressure
+            self.limiter += limiter
+
+    def get_stats(self):
+        with self.lock:
+            return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    def clear(self):
+        with self.lock:
+            for field in self.FIELDS:
+                setattr(self, field, 0.0)
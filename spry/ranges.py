@@ -0,0 +1,265 @@
+import os
+import re
+from bisect import bisect_right
+
+from spry.io import FileAdapter, HTTPAdapter
+from spry.sessions import Section
+from spry.utils import KIBIBYTE, PREALLOCATE_SPARSE, create_null_file, parse_content_range
+from spry.workers import Latch, WorkerPool
+
+# Ranges closer than this are fetched as one, as the bytes in between
+# cost less than another range in the request and response.
+MERGE_GAP = KIBIBYTE * 4
+
+# Maximum number of ranges per request, servers limit header sizes
+MAX_RANGES = 64
+
+# Threads fetching ranges when no pool is shared with a Session
+RANGE_THREADS = 4
+
+BOUNDARY = re.compile(r'boundary="?([^";]+)"?', re.IGNORECASE)
+
+
+def plan_ranges(ranges, gap=MERGE_GAP):
+    """
+    Sorts inclusive ``(start, end)`` byte ranges and merges those that
+    overlap or are at most ``gap`` bytes apart. Returns a list of
+    :class:`~spry.sessions.Section`.
+
+    Examples:
+        [(10, 19), (0, 4)] with no gap returns sections 0-4 and 10-19
+        [(10, 19), (0, 4)] with a gap of 5 returns section 0-19
+    """
+
+    sections = []
+
+    for start, end in sorted(ranges):
+        if start < 0 or end < start:
+            raise ValueError('invalid range: {}-{}'.format(start, end))
+
+        if sections and start <= sections[-1].end + gap + 1:
+            section = sections[-1]
+            section.end = max(section.end, end)
+            section.size = section.end - section.start + 1
+        else:
+            sections.append(Section(start=start, end=end, size=end - start + 1))
+
+    return sections
+
+
+def parse_byteranges(body, content_type):
+    """
+    Parses a ``multipart/byteranges`` response body into a list of
+    ``(start, end, total, data)``, ``total`` being the size of the whole
+    resource or ``None`` if unknown. Part lengths are taken from their
+    Content-Range so data containing the boundary is never split.
+    """
+
+    match = BOUNDARY.search(content_type or '')
+    if not match:
+        raise ValueError('no boundary in {}'.format(content_type))
+
+    delimiter = b'--' + match.group(1).encode('latin-1')
+    parts = []
+    position = body.find(delimiter)
+
+    while position != -1:
+        position += len(delimiter)
+
+        # The closing delimiter
+        if body[position:position + 2] == b'--':
+            break
+
+        header_end = body.find(b'\r\n\r\n', position)
+        if header_end == -1:
+            break
+
+        content_range = None
+        for line in body[position:header_end].decode('latin-1').split('\r\n'):
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'content-range':
+                content_range = parse_content_range(value.strip())
+
+        if content_range is None:
+            raise ValueError('part without a Content-Range')
+
+        start, end, total = content_range
+        data_start = header_end + 4
+        data = body[data_start:data_start + end - start + 1]
+        parts.append((start, end, total, data))
+
+        position = body.find(delimiter, data_start + len(data))
+
+    return parts
+
+
+def extract_range(parts, start, end):
+    """Returns the bytes from ``start`` to ``end`` inclusive out of
+    ``(start, end, total, data)`` parts, or ``None`` if they are not covered.
+    """
+
+    for part_start, part_end, _, data in parts:
+        if part_start <= start and end <= part_end and len(data) == part_end - part_start + 1:
+            return data[start - part_start:end - part_start + 1]
+    return None
+
+
+class RangeFetcher:
+    """Fetches many byte ranges of a single resource with as few requests as
+    possible. Nearby ranges are merged, then sent in batches as multi-range
+    requests whose ``multipart/byteranges`` responses are split back up.
+    Ranges a server did not return, e.g. because it only answers the first
+    of several ranges, are fetched with single-range requests in parallel
+    over the session's pooled keep-alive connections.
+
+    :param url: The URL of a server supporting range requests.
+    :type url: str
+    :param session: The :class:`requests.Session` to use. Default: ``None``
+    :param gap: Ranges at most this many bytes apart are fetched as one.
+                Default: 4 KiB
+    :type gap: int
+    :param max_ranges: The maximum number of ranges per request. 1 disables
+                       multi-range requests. Default: 64
+    :type max_ranges: int
+    :param pool: The :class:`~spry.workers.WorkerPool` fetching ranges.
+                 Default: a pool of 4 threads
+    """
+
+    def __init__(self, url, session=None, gap=MERGE_GAP, max_ranges=MAX_RANGES, pool=None, **kwargs):
+        self.url = url
+        self.session = session
+        self.gap = gap
+        self.max_ranges = max_ranges
+        self.pool = pool if pool is not None else WorkerPool(RANGE_THREADS)
+        self.kwargs = kwargs
+
+        # Turned off once the server shows it ignores multi-range requests
+        self.multipart = max_ranges > 1
+        self.size = None
+
+    def fetch(self, ranges, output=None):
+        """Fetches inclusive ``(start, end)`` byte ranges. Without ``output``
+        a list of their bytes is returned in the same order. ``output`` may
+        also be a writable buffer, such as a :class:`bytearray` as large as
+        the resource, or the path of a file to create as a sparse file, in
+        which case each range is written at its offset and ``output`` is
+        returned.
+        """
+
+        ranges = list(ranges)
+        sections = plan_ranges(ranges, self.gap)
+        pieces = {}
+
+        for i in range(0, len(sections), self.max_ranges):
+            batch = sections[i:i + self.max_ranges]
+            if not self.multipart:
+                break
+            elif len(batch) > 1:
+                pieces.update(self._fetch_multi(batch))
+
+        missing = [section for section in sections if section.start not in pieces]
+        if missing:
+            latch = Latch()
+            for section in missing:
+                latch.add()
+                self.pool.submit(self._fetch_single, section, pieces, latch)
+            latch.wait()
+
+        return self._output(ranges, sections, pieces, output)
+
+    def _request(self, sections):
+        headers = dict(self.kwargs.get('headers') or {})
+        headers['range'] = 'bytes={}'.format(
+            ','.join('{}-{}'.format(section.start, section.end) for section in sections)
+        )
+        kwargs = dict(self.kwargs, headers=headers)
+
+        return HTTPAdapter(self.url, self.session, stream=True, **kwargs)
+
+    def _fetch_multi(self, sections):
+        adapter = self._request(sections)
+        try:
+            # The ranges were ignored, don't read what may be a huge body
+            if adapter.status_code != 206:
+                self.multipart = False
+                return {}
+
+            content_type = adapter.headers.get('content-type', '')
+            if content_type.lower().startswith('multipart/byteranges'):
+                parts = parse_byteranges(bytes(adapter.read_all()), content_type)
+            else:
+                content_range = parse_content_range(adapter.headers.get('content-range'))
+                if content_range is None:
+                    return {}
+
+                start, end, total = content_range
+                parts = [(start, end, total, bytes(adapter.read_all(end - start + 1)))]
+
+                # Only the first range came back, the rest will be fetched
+                # separately, so stop batching altogether.
+                self.multipart = False
+        finally:
+            adapter.close()
+
+        for part in parts:
+            self.size = part[2] or self.size
+
+        pieces = {}
+        for section in sections:
+            data = extract_range(parts, section.start, section.end)
+            if data is not None:
+                pieces[section.start] = data
+        return pieces
+
+    def _fetch_single(self, section, pieces, latch):
+        try:
+            adapter = self._request([section])
+            try:
+                content_range = parse_content_range(adapter.headers.get('content-range'))
+                if adapter.status_code != 206 or content_range is None:
+                    raise IOError('{} does not support range requests'.format(self.url))
+
+                start, end, total = content_range
+                data = bytes(adapter.read_all(end - start + 1))
+            finally:
+                adapter.close()
+
+            self.size = total or self.size
+            data = extract_range([(start, end, total, data)], section.start, section.end)
+            if data is None:
+                raise IOError('incomplete range {}-{} of {}'.format(section.start, section.end, self.url))
+
+            pieces[section.start] = data
+        except Exception as e:
+            latch.fail(e)
+        else:
+            latch.done()
+
+    def _output(self, ranges, sections, pieces, output):
+        starts = [section.start for section in sections]
+
+        def get_range(start, end):
+            # The section containing the range is the last one starting at or before it
+            section_start = starts[bisect_right(starts, start) - 1]
+            return pieces[section_start][start - section_start:end - section_start + 1]
+
+        if output is None:
+            return [get_range(start, end) for start, end in ranges]
+
+        if isinstance(output, str):
+            size = self.size or max(section.end for section in sections) + 1
+            if not os.path.exists(output):
+                create_null_file(output, size, mode=PREALLOCATE_SPARSE)
+
+            writer = FileAdapter(output, 'r+b', buffering=0)
+            try:
+                for section in sections:
+                    writer.write_at(section.start, pieces[section.start])
+            finally:
+                writer.close()
+            return output
+
+        view = memoryview(output).cast('B')
+        for start, end in ranges:
+            view[start:end + 1] = get_range(start, end)
+        return output
@@ -0,0 +1,243 @@
+import io
+import threading
+from collections import OrderedDict
+
+from spry.io import HTTPAdapter
+from spry.utils import KIBIBYTE, parse_content_range
+from spry.workers import WorkerPool
+
+# Default number of bytes fetched by a single range request
+BLOCK_SIZE = KIBIBYTE * 256
+
+# Default number of blocks kept in memory
+CACHE_BLOCKS = 64
+
+# Default maximum number of blocks fetched ahead of sequential reads
+READ_AHEAD = 16
+
+# Threads fetching blocks ahead when no pool is shared with a Session
+PREFETCH_THREADS = 4
+
+
+class BlockCache:
+    """Keeps the most recently used blocks of a remote file in memory.
+
+    :param capacity: The maximum number of blocks. Default: 64
+    :type capacity: int
+    """
+
+    def __init__(self, capacity=CACHE_BLOCKS):
+        self.capacity = capacity
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, index):
+        with self.lock:
+            block = self.blocks.get(index)
+            if block is not None:
+                self.blocks.move_to_end(index)
+            return block
+
+    def put(self, index, block):
+        with self.lock:
+            self.blocks[index] = block
+            self.blocks.move_to_end(index)
+
+            while len(self.blocks) > self.capacity:
+                self.blocks.popitem(last=False)
+
+    def __contains__(self, index):
+        with self.lock:
+            return index in self.blocks
+
+    def __len__(self):
+        with self.lock:
+            return len(self.blocks)
+
+
+class RemoteFile(io.RawIOBase):
+    """A read-only, seekable file object over HTTP range requests, so that
+    tools like :mod:`zipfile` can read parts of a remote file without it
+    being downloaded. The file is fetched in blocks which are kept in an LRU
+    :class:`BlockCache`. Reads that continue where the previous one ended
+    double the number of blocks fetched ahead in parallel, up to
+    ``read_ahead``, while random access fetches nothing ahead.
+
+    :param url: The URL of a server supporting range requests.
+    :type url: str
+    :param session: The :class:`requests.Session` to use. Default: ``None``
+    :param block_size: The number of bytes per range request. Default: 256 KiB
+    :type block_size: int
+    :param cache_blocks: The number of blocks to keep. Default: 64
+    :type cache_blocks: int
+    :param read_ahead: The maximum number of blocks to prefetch. 0 disables
+                       prefetching. Default: 16
+    :type read_ahead: int
+    :param pool: The :class:`~spry.workers.WorkerPool` fetching blocks ahead.
+                 Default: a pool of 4 threads
+    :raises IOError: If the server does not support range requests.
+    """
+
+    def __init__(self, url, session=None, block_size=BLOCK_SIZE, cache_blocks=CACHE_BLOCKS,
+                 read_ahead=READ_AHEAD, pool=None, **kwargs):
+        super(RemoteFile, self).__init__()
+
+        self.url = url
+        self.session = session
+        self.block_size = block_size
+        self.cache = BlockCache(max(cache_blocks, read_ahead + 1))
+        self.max_read_ahead = read_ahead
+        self.pool = pool if pool is not None else WorkerPool(PREFETCH_THREADS)
+        self.kwargs = kwargs
+
+        self.position = 0
+        self.read_ahead = 0
+        self.last_block = None
+
+        # Maps block index -> event set once an in-flight fetch is over,
+        # so prefetched blocks are never requested twice.
+        self.fetching = {}
+        self.prefetching = set()
+        self.lock = threading.Lock()
+
+        self.size = self._get_size()
+
+    def _request(self, start, end):
+        headers = dict(self.kwargs.get('headers') or {})
+        headers['range'] = 'bytes={}-{}'.format(start, end)
+        kwargs = dict(self.kwargs, headers=headers)
+
+        return HTTPAdapter(self.url, self.session, stream=True, **kwargs)
+
+    def _get_size(self):
+        adapter = self._request(0, 0)
+        try:
+            content_range = parse_content_range(adapter.headers.get('content-range'))
+            if adapter.status_code != 206 or content_range is None or content_range[2] is None:
+                raise IOError('{} does not support range requests'.format(self.url))
+            return content_range[2]
+        finally:
+            adapter.close()
+
+    def _fetch(self, index):
+        start = index * self.block_size
+        end = min(start + self.block_size, self.size) - 1
+
+        adapter = self._request(start, end)
+        try:
+            if adapter.status_code != 206:
+                raise IOError('unexpected status {} for a range of {}'.format(adapter.status_code, self.url))
+
+            block = bytes(adapter.read_all(end - start + 1))
+            if len(block) != end - start + 1:
+                raise IOError('incomplete range of {}'.format(self.url))
+        finally:
+            adapter.close()
+
+        self.cache.put(index, block)
+        return block
+
+    def _get_block(self, index):
+        while True:
+            block = self.cache.get(index)
+            if block is not None:
+                return block
+
+            with self.lock:
+                event = self.fetching.get(index)
+                if event is None:
+                    event = self.fetching[index] = threading.Event()
+                    owner = True
+                else:
+                    owner = False
+
+            if not owner:
+                # Another thread is on it, recheck the cache once it is done
+                # as its fetch may have failed or the block been evicted.
+                event.wait()
+                continue
+
+            try:
+                return self._fetch(index)
+            finally:
+                with self.lock:
+                    del self.fetching[index]
+                event.set()
+
+    def _prefetch(self, index):
+        try:
+            self._get_block(index)
+        except Exception:
+            # Demand reads will retry and report the error
+            pass
+        finally:
+            with self.lock:
+                self.prefetching.discard(index)
+
+    def _update_read_ahead(self, index):
+        if self.last_block is not None and index in (self.last_block, self.last_block + 1):
+            if index != self.last_block:
+                self.read_ahead = min(max(self.read_ahead * 2, 1), self.max_read_ahead)
+        else:
+            self.read_ahead = 0
+        self.last_block = index
+
+        last_index = (self.size - 1) // self.block_size
+        for ahead in range(index + 1, min(index + self.read_ahead, last_index) + 1):
+            if ahead in self.cache:
+                continue
+
+            with self.lock:
+                if ahead in self.prefetching or ahead in self.fetching:
+                    continue
+                self.prefetching.add(ahead)
+
+            self.pool.submit(self._prefetch, ahead)
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        nbytes = min(len(view), max(self.size - self.position, 0))
+        filled = 0
+
+        while filled < nbytes:
+            index, offset = divmod(self.position, self.block_size)
+            self._update_read_ahead(index)
+            block = self._get_block(index)
+
+            count = min(len(block) - offset, nbytes - filled)
+            view[filled:filled + count] = block[offset:offset + count]
+
+            filled += count
+            self.position += count
+
+        return filled
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError('invalid whence: {}'.format(whence))
+
+        if position < 0:
+            raise ValueError('negative seek position {}'.format(position))
+
+        self.position = position
+        return position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        with self.cache.lock:
+            self.cache.blocks.clear()
+        super(RemoteFile, self).close()
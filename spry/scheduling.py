@@ -0,0 +1,159 @@
+import heapq
+from collections import deque
+from itertools import count
+from threading import Lock
+
+from spry.utils import get_origin
+
+FIFO = 'fifo'
+PRIORITY = 'priority'
+SHORTEST_JOB_FIRST = 'sjf'
+FAIR_SHARE = 'fair'
+
+POLICIES = (FIFO, PRIORITY, SHORTEST_JOB_FIRST, FAIR_SHARE)
+
+INFINITY = float('inf')
+
+
+class TransferQueue:
+    """A queue of pending transfers ordered by a scheduling policy. It is a
+    drop-in replacement for the :class:`collections.deque` that used to back
+    :attr:`Session.unfinished`, i.e. ``append``, ``popleft``, ``len`` and
+    iteration all work the same, but entries come out in policy order:
+
+    - ``fifo``: order of submission.
+    - ``priority``: highest priority first, then earliest deadline, then
+      order of submission.
+    - ``sjf``: like ``priority`` but smaller expected sizes go first among
+      equal priorities and deadlines. Unknown sizes go last.
+    - ``fair``: round-robin between hosts, each host's transfers being
+      ordered as with ``priority``. This prevents one host with a long
+      queue from starving all others.
+
+    :param policy: One of ``fifo``, ``priority``, ``sjf`` or ``fair``.
+                   Default: ``priority``
+    :type policy: str
+    """
+
+    def __init__(self, policy=PRIORITY):
+        if policy not in POLICIES:
+            raise ValueError('unknown scheduling policy: {}'.format(policy))
+
+        self.policy = policy
+        self.lock = Lock()
+        self.counter = count()
+
+        # Maps group -> heap of entries. Without fair sharing
+        # everything belongs to a single group.
+        self.heaps = {}
+        self.groups = deque()
+
+        # Maps id(transfer) -> entry for O(1) removal and reprioritization.
+        # Stale entries are left in the heaps and skipped when popped.
+        self.entries = {}
+
+    def append(self, transfer):
+        with self.lock:
+            self._push(transfer, next(self.counter))
+
+    def appendleft(self, transfer):
+        """Puts a transfer back at the front of its rank, e.g. when it could
+        not be started yet and must wait for another turn.
+        """
+
+        with self.lock:
+            self._push(transfer, -next(self.counter))
+
+    def popleft(self):
+        with self.lock:
+            while self.groups:
+                group = self.groups[0]
+                heap = self.heaps[group]
+
+                while heap:
+                    entry = heapq.heappop(heap)
+                    transfer = entry[-1]
+
+                    if transfer is not None:
+                        del self.entries[id(transfer)]
+                        break
+                else:
+                    transfer = None
+
+                if not heap:
+                    del self.heaps[group]
+                    self.groups.popleft()
+                else:
+                    self.groups.rotate(-1)
+
+                if transfer is not None:
+                    return transfer
+
+            raise IndexError('pop from an empty queue')
+
+    def remove(self, transfer):
+        with self.lock:
+            entry = self.entries.pop(id(transfer))
+            entry[-1] = None
+
+    def update(self, transfer):
+        """Reorders a queued transfer after its priority, deadline or
+        expected size has changed. Unknown transfers are ignored.
+        """
+
+        with self.lock:
+            entry = self.entries.pop(id(transfer), None)
+            if entry is not None:
+                entry[-1] = None
+                self._push(transfer, entry[-2])
+
+    def set_policy(self, policy):
+        if policy not in POLICIES:
+            raise ValueError('unknown scheduling policy: {}'.format(policy))
+
+        with self.lock:
+            transfers = [entry[-2:] for entry in self.entries.values()]
+            self.policy = policy
+            self.heaps.clear()
+            self.groups.clear()
+            self.entries.clear()
+
+            for seq, transfer in transfers:
+                self._push(transfer, seq)
+
+    def clear(self):
+        with self.lock:
+            self.heaps.clear()
+            self.groups.clear()
+            self.entries.clear()
+
+    def _push(self, transfer, seq):
+        group = get_origin(transfer.remote_path) if self.policy == FAIR_SHARE else None
+
+        if group not in self.heaps:
+            self.heaps[group] = []
+            self.groups.append(group)
+
+        entry = list(self._key(transfer)) + [seq, transfer]
+        heapq.heappush(self.heaps[group], entry)
+        self.entries[id(transfer)] = entry
+
+    def _key(self, transfer):
+        if self.policy == FIFO:
+            return ()
+
+        deadline = transfer.deadline if transfer.deadline is not None else INFINITY
+
+        if self.policy == SHORTEST_JOB_FIRST:
+            size = transfer.size_hint or INFINITY
+            return -transfer.priority, deadline, size
+
+        return -transfer.priority, deadline
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        with self.lock:
+            entries = sorted(self.entries.values(), key=lambda entry: entry[:-1])
+        return iter([entry[-1] for entry in entries])
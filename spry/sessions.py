@@ -1,15 +1,120 @@
+import logging
 import threading
 import time
 from collections import deque
+from itertools import count
 
-from spry.progress import Counter, ProgressTracker, SpeedLimiter
+from spry import events
+from spry.hooks import HookChain
+from spry.progress import (
+    CompletionMap, ConnectionLimiter, Counter, ProgressTracker, SpaceLedger, SpeedLimiter, TransferStats
+)
+from spry.scheduling import PRIORITY, TransferQueue
 from spry.utils import (
-    STATE_CHECK, unit_pair_to_bytes
+    CHUNK_SIZE, MEBIBYTE, PREALLOCATE_AUTO, STATE_CHECK, WRITE_BUFFER_SIZE, get_origin, unit_pair_to_bytes
 )
+from spry.workers import DISK_WRITERS, MEMORY_LIMIT, WORKER_THREADS, DiskWriter, Latch, PendingWrites, WorkerPool
+
+FINISHED = 'finished'
+FAILED = 'failed'
+
+log = logging.getLogger(__name__)
+
+# A streamer slower than this fraction of its siblings' median throughput
+# is a straggler, once it has been reading for long enough to tell.
+STRAGGLER_RATIO = 0.25
+HEDGE_MIN_AGE = 5
+
+# Stragglers with less left than this are not worth a second connection
+HEDGE_MIN_SIZE = MEBIBYTE * 1
+
+
+class Section:
+    """A byte range of a file handled by a single :class:`Streamer`. Offsets
+    are inclusive, and an ``end`` of 0 means the size is not known. This is
+    the in-memory counterpart of :class:`spry.db.Section`, kept separate so
+    transfers never need to load the database layer.
+    """
+
+    __slots__ = ('start', 'end', 'size')
+
+    def __init__(self, start=0, end=0, size=0):
+        self.start = start
+        self.end = end
+        self.size = size
+
+    def __repr__(self):
+        return 'Size: {}, Start: {}, End: {}'.format(self.size, self.start, self.end)
+
+
+class TransferRecord:
+    """What a Session keeps of a transfer once it is over, instead of the
+    transfer itself with its streamers, trackers and connections.
+    """
+
+    __slots__ = ('remote_path', 'local_path', 'size', 'duration', 'status', 'error')
+
+    def __init__(self, remote_path, local_path, size, duration, status, error=None):
+        self.remote_path = remote_path
+        self.local_path = local_path
+        self.size = size
+        self.duration = duration
+        self.status = status
+
+        # The text of what failed the transfer, if anything did
+        self.error = error
+
+    def __repr__(self):
+        return '{}: {}, Size: {}, Duration: {:.2f}, Status: {}'.format(
+            self.remote_path, self.local_path, self.size, self.duration, self.status
+        )
+
+
+class TransferRequest:
+    """A queued transfer that is only created once a Session starts it, so
+    that queues of millions of files hold nothing but their paths. It has
+    the scheduling hints read by :class:`~spry.scheduling.TransferQueue`,
+    and requests from the same batch share a single ``kwargs`` dict. The
+    factory is called with the request's own hints over those ``kwargs``.
+    """
+
+    __slots__ = ('factory', 'remote_path', 'local_path', 'kwargs', 'priority', 'deadline', 'size_hint')
+
+    def __init__(self, factory, remote_path, local_path, kwargs, priority=1, deadline=None, size_hint=None):
+        self.factory = factory
+        self.remote_path = remote_path
+        self.local_path = local_path
+        self.kwargs = kwargs
+        self.priority = priority
+        self.deadline = deadline
+        self.size_hint = size_hint
+
+    def create(self):
+        # The shared kwargs are copied, as the hints may have been changed
+        # for this request alone while it was queued.
+        kwargs = dict(self.kwargs, priority=self.priority, deadline=self.deadline, size_hint=self.size_hint)
+        return self.factory(self.remote_path, self.local_path, **kwargs)
+
+    def set_priority(self, priority):
+        if priority <= 0:
+            raise ValueError('priority must be positive')
+        self.priority = priority
+
+    def __repr__(self):
+        return '{}: {}'.format(self.remote_path, self.local_path)
 
 
 class Streamer:
-    def __init__(self, remote_path, local_path, section, tracker, limiter, counter, timeout):
+    # Subclasses must declare their own __slots__ too, or every
+    # instance gets a __dict__ again.
+    __slots__ = ('remote_path', 'local_path', 'section', 'tracker', 'limiter', 'total', 'timeout', 'connections',
+                 'origin', 'has_connection_slot', 'buffer_size', 'disk', 'pending', 'stats', 'pool', 'timings',
+                 'error', 'reader', 'writer', 'is_running', 'is_paused', 'is_alive', 'is_done', 'is_connected',
+                 'expected', 'received', 'position', 'started', 'finished_at', 'hedge', 'stopped', 'wake',
+                 'retries', 'hooks', 'completed')
+
+    def __init__(self, remote_path, local_path, section, tracker, limiter, counter, timeout, connections=None,
+                 buffer_size=WRITE_BUFFER_SIZE, disk=None, stats=None, pool=None, hooks=None, completed=None):
 
         self.remote_path = remote_path
         self.local_path = local_path
@@ -18,62 +123,202 @@ class Streamer:
         self.limiter = limiter
         self.total = counter
         self.timeout = timeout
+        self.connections = connections
+        self.origin = get_origin(remote_path)
+        self.has_connection_slot = False
+        self.buffer_size = buffer_size
+        self.disk = disk
+        self.pending = PendingWrites(completed) if disk is not None else None
+        self.stats = stats
+        self.pool = pool
+        self.timings = {}
+        self.error = None
         self.reader = None
         self.writer = None
 
+        # Throughput monitoring. Bytes received stay counted across attempts
+        # unless rolled back, and position is where the next byte goes.
+        self.expected = section.size
+        self.received = 0
+        self.position = section.start
+        self.started = None
+        self.finished_at = None
+        self.retries = 0
+
+        # The streamer racing this one for the same bytes, if any
+        self.hedge = None
+
+        # A HookChain, or None when nothing is registered so that the hot
+        # path only ever checks for None.
+        self.hooks = hooks
+
+        # The file's CompletionMap, where bytes are recorded once written,
+        # by the disk writers when they are the ones writing them
+        self.completed = completed
+
         # Control variables
         self.is_running = False
         self.is_paused = False
 
+        # Set by stop, and wake also by resume, so that waits for a
+        # connection slot or while paused end as soon as they change.
+        self.stopped = threading.Event()
+        self.wake = threading.Event()
+
         # Uncontrolled state
         self.is_alive = False
         self.is_done = False
         self.is_connected = True
 
+    def _begin(self):
+        """Marks the streamer as running and waits for a connection slot.
+        Returns whether to go on, i.e. it was not stopped meanwhile.
+        """
+
+        # Streamers queued by start() may have been stopped while waiting
+        # for a pool thread, anything else is being run directly.
+        if self.is_alive:
+            if not self.is_running:
+                if self.has_connection_slot:
+                    self.has_connection_slot = False
+                    self.connections.release(self.origin)
+                self.is_alive = False
+                return False
+        else:
+            self.is_alive = True
+            self.is_running = True
+            self.stopped.clear()
+
+        # Wait for the host's connection budget, shared by all transfers
+        # of a Session, to allow us another connection. Those started on
+        # a pool were given one before being queued.
+        if self.connections is not None and not self.has_connection_slot:
+            while not self.connections.acquire(self.origin, STATE_CHECK, cancel=self.stopped):
+                if not self.is_running:
+                    self.is_alive = False
+                    return False
+            self.has_connection_slot = True
+
+        return True
+
     def run(self):
-        self.is_alive = True
-        self.is_running = True
+        if not self._begin():
+            return
+
+        hooks = self.hooks
+        if hooks is not None:
+            hooks.on_start(self)
+
+        if self.started is None:
+            self.started = time.time()
 
         # last_active = time.time()
+        attempted = False
 
         while True:
 
+            if not self.is_running:
+                break
+
+            if attempted:
+                self.retries += 1
+                if hooks is not None:
+                    hooks.on_reconnect(self, self.retries + 1)
+            attempted = True
+
+            attempt_start = time.time()
             try:
                 self._setup()
                 self.is_connected = True
             except:
                 self.is_connected = False
 
-            writer = self.writer
+            if hooks is not None:
+                hooks.on_connect(self, time.time() - attempt_start, self.is_connected)
+
             reader = self.reader
+            start = self.section.start
             size = self.section.size
             tracker = self.tracker
             total = self.total
             get_size = self.limiter.get
 
+            # Readers able to move the body into the file inside the kernel
+            # bypass the buffer, see RawAdapter.splice.
+            if self.is_connected and getattr(reader, 'can_splice', False):
+                splice = reader.splice
+                fileno = self.writer.fileno()
+            else:
+                splice = None
+
+            # Contiguous data is collected and written with a single positional
+            # write once it reaches the buffer size. Only written bytes count
+            # towards the section's offsets so resumed transfers never skip
+            # data that was received but lost before reaching the disk.
+            buffer_size = self.buffer_size
+
+            # Readers able to fill a buffer in place receive straight into
+            # the one being collected, sparing a copy of every chunk.
+            readinto = getattr(reader, 'readinto', None) if self.is_connected and splice is None else None
+            buffer = bytearray(max(buffer_size, CHUNK_SIZE)) if readinto is not None else bytearray()
+            filled = 0
+
+            # Seconds spent blocked on each stage during this attempt
+            self.timings = dict.fromkeys(TransferStats.FIELDS, 0.0)
+            timings = self.timings
+
             bytes_consumed = 0
+            bytes_written = 0
             last_active = time.time()
+            self.position = start
 
             if self.is_connected:
                 while True:
 
                     # Check state controlled by parent Session
                     if not self.is_running:
-                        self.cleanup()
-                        return
+                        break
                     elif self.is_paused:
-                        time.sleep(STATE_CHECK)
+                        self.wake.wait(STATE_CHECK)
                         continue
 
                     # If a speed limit is set, this call to the limiter will
                     # block our thread until it is ready to serve more bytes.
                     # Advantageously, this also releases the GIL.
+                    wait_start = time.time()
                     chunk_size = get_size()
+                    read_start = time.time()
+                    timings['limiter'] += read_start - wait_start
+
+                    if readinto is not None:
+                        if size:
+                            chunk_size = min(chunk_size, size - bytes_consumed)
+
+                        if filled + chunk_size > len(buffer):
+                            bytes_written += self._flush(memoryview(buffer)[:filled], start + bytes_written)
+                            buffer, filled = self._renew(buffer, chunk_size), 0
 
                     # Catch broken internet connection
                     try:
-                        chunk = reader.read(chunk_size)
-                        if not chunk:
+                        if readinto is not None:
+                            nbytes = readinto(memoryview(buffer)[filled:filled + chunk_size])
+                        elif splice is None:
+                            chunk = reader.read(chunk_size)
+                            nbytes = len(chunk)
+                        else:
+                            if size:
+                                chunk_size = min(chunk_size, size - bytes_consumed)
+                            nbytes = splice(fileno, start + bytes_consumed, chunk_size)
+                        read_end = time.time()
+                        timings['network'] += read_end - read_start
+
+                        if hooks is not None and nbytes:
+                            hooks.on_limiter_wait(self, read_start - wait_start)
+                            hooks.on_read(self, nbytes, read_end - read_start)
+                            if not bytes_consumed:
+                                hooks.on_first_byte(self, read_end - attempt_start)
+
+                        if not nbytes:
 
                             # If previously disconnected and no chunk,
                             # consider still unable to connect
@@ -87,7 +332,35 @@ class Streamer:
                         self.is_connected = False
                         break
 
-                    chunk_size = len(chunk)
+                    # Already in place, within the section's bounds
+                    if splice is not None:
+                        tracker.add(nbytes)
+                        bytes_consumed += nbytes
+                        bytes_written += nbytes
+                        self.received += nbytes
+                        self.position += nbytes
+
+                        if self.completed is not None:
+                            self.completed.add(self.position - nbytes, self.position - 1)
+
+                        if size and bytes_consumed == size:
+                            break
+                        continue
+
+                    # Already in the buffer, and never past the section's end
+                    if readinto is not None:
+                        filled += nbytes
+                        tracker.add(nbytes)
+                        bytes_consumed += nbytes
+                        self.received += nbytes
+                        self.position += nbytes
+
+                        if filled >= buffer_size:
+                            bytes_written += self._flush(memoryview(buffer)[:filled], start + bytes_written)
+                            buffer, filled = self._renew(buffer, chunk_size), 0
+                        continue
+
+                    chunk_size = nbytes
 
                     # Edge case to protect against incorrect response headers or
                     # SFTP implementation, therefore maintaining file integrity
@@ -96,19 +369,45 @@ class Streamer:
                         remaining = chunk[:size - bytes_consumed]
                         chunk_size = len(remaining)
 
-                        writer.write(remaining)
+                        buffer += remaining
                         tracker.add(chunk_size)
                         bytes_consumed += chunk_size
+                        self.received += chunk_size
+                        self.position += chunk_size
                         break
 
-                    writer.write(chunk)
+                    buffer += chunk
                     tracker.add(chunk_size)
                     bytes_consumed += chunk_size
+                    self.received += chunk_size
+                    self.position += chunk_size
+
+                    if len(buffer) >= buffer_size:
+                        bytes_written += self._flush(buffer, start + bytes_written)
+                        buffer = bytearray()
+
+            # Whatever is left was received in full, so persist it
+            if readinto is not None:
+                buffer = memoryview(buffer)[:filled]
+            bytes_written += self._flush(buffer, start + bytes_written)
+
+            # Without the disk, nothing else matters
+            if not self._sync():
+                self.cleanup()
+                return
+
+            # Stopped, possibly in the middle of a read that was aborted,
+            # so only what was written counts for future attempts.
+            if not self.is_running:
+                if size:
+                    self._advance(bytes_written)
+                self.cleanup()
+                return
 
             if size:
-                if bytes_consumed == size:
-                    self.is_done = True
-                    self.section.size -= bytes_consumed
+                if bytes_written == size:
+                    self.section.size -= bytes_written
+                    self._finish()
                     self.cleanup()
                     return
                 else:
@@ -116,20 +415,22 @@ class Streamer:
                     # Connection was lost during reading, either server-side or
                     # locally. Update progress for future attempts.
                     if not self.is_connected:
-                        self.section.start += bytes_consumed
-                        self.section.size -= bytes_consumed
+                        self._advance(bytes_written)
 
                     # Scenario #2 is that the server limits # of connections and
                     # sent us a redirect or nothing. In this case, whatever was
                     # read was not the proper content. Reset from initial offset.
                     else:
                         self.tracker.remove(bytes_consumed)
+                        self.received -= bytes_consumed
+                        if self.completed is not None:
+                            self.completed.remove(start, start + bytes_written - 1)
 
             else:
 
                 # Assume finished in lieu of reference size
                 if self.is_connected:
-                    self.is_done = True
+                    self._finish()
                     self.cleanup()
                     return
 
@@ -144,22 +445,148 @@ class Streamer:
 
         self.cleanup()
 
+    def _flush(self, buffer, offset):
+        """Persists the buffer at offset, either directly or through the
+        Session's disk writers, and returns its size. In the latter case
+        the buffer is handed over and must not be reused.
+        """
+
+        nbytes = len(buffer)
+        if nbytes:
+            if self.disk is not None:
+                duration = self.disk.submit(self.writer, offset, buffer, self.pending, self.stats)
+                self.timings['backpressure'] += duration
+            else:
+                write_start = time.time()
+                self.writer.write_at(offset, buffer)
+                duration = time.time() - write_start
+                self.timings['disk'] += duration
+
+                if self.completed is not None:
+                    self.completed.add(offset, offset + nbytes - 1)
+
+            if self.hooks is not None:
+                self.hooks.on_write(self, offset, nbytes, duration)
+        return nbytes
+
+    def _renew(self, buffer, chunk_size):
+        """Returns a buffer to receive into once ``buffer`` was flushed. It
+        is reused unless it was handed to the disk writers or is too small.
+        """
+
+        if self.disk is None and chunk_size <= len(buffer):
+            return buffer
+        return bytearray(max(self.buffer_size, chunk_size, CHUNK_SIZE))
+
+    def _sync(self):
+        """Waits for handed over buffers to be written and reports this
+        attempt's timings. Returns whether all writes succeeded.
+        """
+
+        if self.stats is not None and self.timings:
+            self.stats.add(**self.timings)
+            self.timings = {}
+
+        if self.pending is not None:
+            try:
+                self.pending.wait()
+            except Exception as e:
+                self.error = e
+                return False
+        return True
+
+    def _finish(self):
+        self.is_done = True
+        self.finished_at = time.time()
+
+        if self.hooks is not None:
+            self.hooks.on_section_done(self, self.finished_at - self.started)
+
+        # Won the race, the other one's bytes are no longer needed
+        if self.hedge is not None:
+            self.hedge.stop()
+
+    def get_rate(self, now=None):
+        """Returns the bytes per second received since the streamer started,
+        or until it finished, or ``None`` if it has not started yet.
+        """
+
+        if self.started is None:
+            return None
+
+        elapsed = (self.finished_at or now or time.time()) - self.started
+        return self.received / elapsed if elapsed > 0 else None
+
+    def _advance(self, nbytes):
+        """Moves the section past bytes persisted for future attempts"""
+
+        self.section.start += nbytes
+        self.section.size -= nbytes
+
     def start(self):
         if not self.is_alive and not self.is_done:
-            threading.Thread(target=self.run).start()
+            self.is_alive = True
+            self.is_running = True
+            self.stopped.clear()
+
+            # Only take a pool thread once the host allows another
+            # connection, so that parts waiting for a busy host never hold
+            # the threads parts for other hosts could run on.
+            if self.pool is not None and self.connections is not None:
+                self.connections.acquire_later(self.origin, self._submit)
+            elif self.pool is not None:
+                self.pool.submit(self.run)
+            else:
+                threading.Thread(target=self.run).start()
+
+    def _submit(self):
+        # Called with a connection slot taken for us
+        self.has_connection_slot = True
+        self.pool.submit(self.run)
 
     def stop(self):
+        """Stops the streamer within moments, even if it is paused, waiting
+        for a connection slot or blocked reading from the network.
+        """
+
         self.is_running = False
+        self.stopped.set()
+        self.wake.set()
+
+        if self.connections is not None:
+            self.connections.interrupt()
+
+            # Still waiting for a slot, so it will never run
+            if self.connections.cancel(self.origin, self._submit):
+                self.is_alive = False
+
+        # The network side is the reader of downloads but the writer of uploads
+        for stream in (self.reader, self.writer):
+            abort = getattr(stream, 'abort', None)
+            if abort is not None:
+                abort()
 
     def pause(self):
+        self.wake.clear()
         self.is_paused = True
 
     def resume(self):
         self.is_paused = False
+        self.wake.set()
 
     def cleanup(self):
-        self.writer.close()
-        self.reader.close()
+        if self.writer:
+            self.writer.close()
+        if self.reader:
+            self.reader.close()
+
+        if self.has_connection_slot:
+            self.has_connection_slot = False
+            self.connections.release(self.origin)
+
+        if self.hooks is not None:
+            self.hooks.on_end(self)
+
         self.is_running = False
         self.is_alive = False
 
@@ -170,7 +597,13 @@ class Streamer:
 class FileSync:
     def __init__(self, method, remote_path, local_path, keep=False,
                  parts=4, speed_limit=None, timeout=20, restart=False,
-                 tracker=None, limiter=None):
+                 tracker=None, limiter=None, connections=None, priority=1,
+                 deadline=None, size_hint=None, preallocate=PREALLOCATE_AUTO,
+                 buffer_size=WRITE_BUFFER_SIZE, disk=None, stats=None, pool=None, hedge=False,
+                 shared_limiter=None, space=None, hooks=None):
+
+        if priority <= 0:
+            raise ValueError('priority must be positive')
 
         self.method = method
         self.remote_path = remote_path
@@ -178,15 +611,51 @@ class FileSync:
         self.keep = keep
         self.parts = parts or 4
         self.restart = restart
+        self.preallocate = preallocate
+        self.buffer_size = buffer_size
+
+        # Scheduling hints read by a Session's TransferQueue
+        self.priority = priority
+        self.deadline = deadline
+        self.size_hint = size_hint
 
         # Control variables
         self.speed_limit = speed_limit
         self.timeout = timeout
 
         self.streamers = []
+        self.start_time = None
+        self.error = None
+
+        # Assigned by a Session to tell its transfers apart in events
+        self.transfer_id = None
+
+        # A SpaceLedger to reserve the file's size in before creating it.
+        # When there is not enough space left yet the transfer is deferred,
+        # i.e. spawns nothing and waits to be run again.
+        self.space = space
+        self.deferred = False
+
+        # A Session's HookChain, handed to streamers if anything is registered
+        self.hooks = hooks
+
+        # Duplicate streamers racing stragglers for their remaining bytes,
+        # and those whose race is not settled yet.
+        self.hedge = hedge
+        self.hedges = []
+        self.races = []
+
+        # Bytes of the file persisted so far, by every streamer and hedge.
+        # Sections still drive resuming and the work handed to streamers.
+        self.completed = CompletionMap()
+
         self.tracker = ProgressTracker(parent=tracker)
-        self.limiter = SpeedLimiter(parent=limiter)
+        self.limiter = SpeedLimiter(parent=limiter, weight=priority, shared=shared_limiter)
         self.counter = Counter()
+        self.stats = TransferStats(parent=stats)
+        self.connections = connections
+        self.disk = disk
+        self.pool = pool
 
         if self.speed_limit:
             self.set_speed_limit(*self.speed_limit)
@@ -194,37 +663,143 @@ class FileSync:
     def _spawn(self, *args, **kwargs):
         raise NotImplementedError
 
+    def _create_streamer(self, section, tracker):
+        raise NotImplementedError
+
+    def finish(self):
+        """Called by a Session once the transfer succeeded, e.g. to
+        add the file to a cache. Does nothing by default.
+        """
+
+    def monitor(self):
+        """Called periodically while the transfer runs. Streamers much slower
+        than their siblings, e.g. because they were routed to a slow server,
+        get a hedge: a duplicate streamer on a fresh connection fetching the
+        straggler's remaining bytes. Whichever finishes first stops the other.
+        """
+
+        self._settle()
+
+        if not self.hedge or len(self.streamers) < 2:
+            return
+
+        now = time.time()
+        rates = [rate for rate in (streamer.get_rate(now) for streamer in self.streamers) if rate]
+        if len(rates) < 2:
+            return
+
+        median = sorted(rates)[len(rates) // 2]
+
+        for streamer in self.streamers:
+            if (streamer.is_alive and not streamer.is_done and streamer.hedge is None and
+                    streamer.started is not None and now - streamer.started >= HEDGE_MIN_AGE and
+                    streamer.section.end and streamer.section.end - streamer.position + 1 >= HEDGE_MIN_SIZE and
+                    (streamer.get_rate(now) or 0) < median * STRAGGLER_RATIO):
+                self._hedge(streamer)
+
+    def _hedge(self, streamer):
+        end = streamer.section.end
+        section = Section(start=streamer.position, end=end, size=end - streamer.position + 1)
+
+        # Progress is only counted once the race is settled, so the
+        # duplicate bytes never show up in the transfer's progress.
+        hedge = self._create_streamer(section, ProgressTracker())
+        hedge.hedge = streamer
+        streamer.hedge = hedge
+
+        self.hedges.append(hedge)
+        self.races.append(hedge)
+        hedge.start()
+
+    def _settle(self):
+        for hedge in list(self.races):
+            original = hedge.hedge
+            if hedge.is_alive or original.is_alive:
+                continue
+
+            self.races.remove(hedge)
+
+            # The straggler lost, so count the rest of its bytes as received
+            if hedge.is_done and not original.is_done:
+                remaining = original.expected - original.received
+                if remaining > 0:
+                    original.tracker.add(remaining)
+                elif remaining < 0:
+                    original.tracker.remove(-remaining)
+
     def run(self, *args, **kwargs):
         if not self.is_alive():
-            self._spawn(*args, **kwargs)
+            if self.start_time is None:
+                self.start_time = time.time()
 
-    def is_alive(self):
+            self.deferred = False
+
+            try:
+                self._spawn(*args, **kwargs)
+            except Exception as e:
+                # e.g. the server could not be reached, which fails the
+                # transfer rather than whoever is running it.
+                self.error = e
+                self.stop()
+
+            # Time spent waiting for space is not part of the transfer
+            if self.deferred:
+                self.start_time = None
+
+    def get_error(self):
+        """Returns the first error that failed the transfer, if any"""
+
+        if self.error is not None:
+            return self.error
         for streamer in self.streamers:
+            if streamer.error is not None:
+                return streamer.error
+        return None
+
+    def get_retries(self):
+        return sum(streamer.retries for streamer in self.streamers + self.hedges)
+
+    def get_record(self, status):
+        duration = time.time() - self.start_time if self.start_time is not None else 0.0
+        error = self.get_error() if status == FAILED else None
+        return TransferRecord(self.remote_path, self.local_path, self.tracker.total, duration, status,
+                              str(error) if error is not None else None)
+
+    def is_alive(self):
+        for streamer in self.streamers + self.hedges:
             if streamer.is_alive:
                 return True
         return False
 
     def success(self):
+        self._settle()
+
+        if self.error is not None:
+            return False
+
         for streamer in self.streamers:
-            if not streamer.is_done:
+            if not streamer.is_done and not (streamer.hedge is not None and streamer.hedge.is_done):
                 return False
         return True
 
     def stop(self):
-        for streamer in self.streamers:
+        for streamer in self.streamers + self.hedges:
             streamer.stop()
 
     def pause(self):
-        for streamer in self.streamers:
+        for streamer in self.streamers + self.hedges:
             streamer.pause()
 
     def resume(self):
-        for streamer in self.streamers:
+        for streamer in self.streamers + self.hedges:
             streamer.resume()
 
     def get_progress(self):
         return self.tracker.get_progress()
 
+    def get_stats(self):
+        return self.stats.get_stats()
+
     def set_speed_limit(self, value, unit='KiB'):
         if value:
             self.speed_limit = (value, unit)
@@ -235,22 +810,38 @@ class FileSync:
             self.speed_limit = None
             self.limiter.set_limit(0)
 
+    def set_priority(self, priority):
+        """Changes the transfer's priority, which is also its share of the
+        parent limiter's bandwidth relative to other active transfers.
+        """
+
+        self.limiter.set_weight(priority)
+        self.priority = priority
+
     @property
     def done(self):
         return self.tracker.done
 
     def _reset(self):
         self.streamers.clear()
+        del self.hedges[:]
+        del self.races[:]
         self.tracker.clear()
         self.limiter.reset()
         self.counter.set(0)
+        self.completed.clear()
 
 
 class Session:
-    def __init__(self, concurrent=4, parts=4, speed_limit=None, timeout=20, restart=False):
+    def __init__(self, concurrent=4, parts=4, speed_limit=None, timeout=20, restart=False,
+                 host_limit=None, policy=PRIORITY, preallocate=PREALLOCATE_AUTO,
+                 buffer_size=WRITE_BUFFER_SIZE, disk_writers=DISK_WRITERS, memory_limit=MEMORY_LIMIT,
+                 threads=WORKER_THREADS, history=None, spill=False, hub=None, shared_limit=None):
         self.concurrent = concurrent
         self.parts = parts
         self.restart = restart
+        self.preallocate = preallocate
+        self.buffer_size = buffer_size
 
         # Control variables
         self.is_running = False
@@ -258,13 +849,55 @@ class Session:
         self.speed_limit = speed_limit
         self.timeout = timeout
 
+        # Set to wake the loop early, e.g. when stopped or given more work
+        self.wake = threading.Event()
+
+        # Bandwidth shared with other processes, the module needs the
+        # database's data directory so it is only imported once enabled.
+        if isinstance(shared_limit, (int, float)) and shared_limit:
+            from spry.shared import SharedLimiter
+            shared_limit = SharedLimiter(shared_limit)
+        self.shared_limiter = shared_limit or None
+
         self.tracker = ProgressTracker()
-        self.limiter = SpeedLimiter()
+        self.limiter = SpeedLimiter(shared=self.shared_limiter)
+        self.connections = ConnectionLimiter(host_limit)
+        self.stats = TransferStats()
+
+        # Transfers reserve their file's size here before starting. Those
+        # that do not fit yet wait in deferred until space is released.
+        self.space = SpaceLedger()
+        self.deferred = deque()
+        self.deferred_releases = 0
 
-        self.unfinished = deque()
+        # Instrumentation of every streamer, see add_hook
+        self.hooks = HookChain()
+
+        # Received data is handed to a shared stage of disk writer threads
+        # unless disabled, in which case each streamer writes by itself.
+        self.disk = DiskWriter(disk_writers, memory_limit) if disk_writers else None
+
+        # Every streamer of every transfer runs on this pool, so the number
+        # of threads stays bounded no matter how many files are queued.
+        self.pool = WorkerPool(threads)
+
+        # Transfers still being finished off on the pool
+        self.finishing = Latch()
+
+        self.unfinished = TransferQueue(policy)
+        self.sources = deque()
         self.workers = deque()
-        self.finished = []
-        self.errors = []
+
+        # Records of the most recent transfers only, unless unbounded. Older
+        # ones are dropped or, when spilling, moved to the database.
+        self.finished = deque(maxlen=history)
+        self.errors = deque(maxlen=history)
+        self.spill = spill
+
+        # An optional EventHub, progress is only tracked for it when set
+        self.hub = hub
+        self.transfer_ids = count(1)
+        self.reported = {}
 
         if self.speed_limit:
             self.set_speed_limit(*self.speed_limit)
@@ -275,13 +908,38 @@ class Session:
     def send(self, *args, **kwargs):
         raise NotImplementedError
 
+    def add_source(self, requests):
+        """Queues transfers from an iterable of :class:`TransferRequest`, which
+        is only consumed as the session has room for more transfers. This
+        keeps memory constant for arbitrarily long inputs such as a file of
+        URLs, at the cost of scheduling policies only ordering what has been
+        pulled so far.
+        """
+
+        self.sources.append(iter(requests))
+        self.wake.set()
+
+    def _pull(self, count):
+        # Keep just enough requests queued to fill the free slots
+        while self.sources and len(self.unfinished) < count:
+            try:
+                self.unfinished.append(next(self.sources[0]))
+            except StopIteration:
+                self.sources.popleft()
+
     def _run(self, forever=False):
         self.is_running = True
 
+        if self.hub is not None:
+            self.hub.emit(events.SESSION_START)
+
         while True:
-            time.sleep(STATE_CHECK)
+            self.wake.wait(STATE_CHECK)
+            self.wake.clear()
 
             if not self.is_running:
+                for worker in self.workers:
+                    worker.stop()
                 break
             elif self.is_paused:
                 continue
@@ -292,46 +950,152 @@ class Session:
 
                 if not worker.is_alive():
 
+                    self.workers.popleft()
+                    self.space.release(worker.local_path)
+
                     if worker.success():
-                        self.finished.append(self.workers.popleft())
+                        # Off the loop thread, as this may mean hashing the file
+                        self.finishing.add()
+                        self.pool.submit(self._finish_transfer, worker)
+                        record = worker.get_record(FINISHED)
+                        self._record(self.finished, record)
                     else:
-                        self.errors.append(self.workers.popleft())
+                        record = worker.get_record(FAILED)
+                        self._record(self.errors, record)
+
+                    if self.hub is not None:
+                        self._report_end(worker, record)
 
                 else:
                     self.workers.rotate(-1)
 
+            # Retry deferred transfers first once space may have freed up
+            if self.deferred and (self.space.releases != self.deferred_releases or not self.workers):
+                while self.deferred:
+                    self.unfinished.appendleft(self.deferred.pop())
+
             # Repopulate worker queue
+            self._pull(self.concurrent - len(self.workers))
+
             while len(self.workers) < self.concurrent:
                 if self.unfinished:
-                    self.workers.append(self.unfinished.popleft())
+                    transfer = self.unfinished.popleft()
+                    if isinstance(transfer, TransferRequest):
+                        transfer = transfer.create()
+
+                    if transfer.transfer_id is None:
+                        transfer.transfer_id = next(self.transfer_ids)
+                    self.workers.append(transfer)
+
+                    if self.hub is not None:
+                        self.hub.emit(events.START, id=transfer.transfer_id, url=transfer.remote_path,
+                                         path=transfer.local_path)
                     continue
                 break
 
-            for worker in self.workers:
+            for worker in list(self.workers):
                 if not worker.is_alive():
                     worker.run()
 
-            if not forever and not self.unfinished and not self.workers:
+                    if worker.deferred:
+                        self.workers.remove(worker)
+                        self.deferred.append(worker)
+                        self.deferred_releases = self.space.releases
+                else:
+                    worker.monitor()
+
+            if self.hub is not None:
+                self._report_progress()
+
+            if not forever and not self.unfinished and not self.sources and not self.workers and not self.deferred:
                 break
 
+        # Files are only done once e.g. their manifest is recorded, which
+        # a process exiting as soon as the session stops would cut short.
+        self.finishing.wait()
         self.is_running = False
 
+        if self.hub is not None:
+            self.hub.emit(events.SESSION_FINISH, finished=len(self.finished), errors=len(self.errors))
+
+    def _finish_transfer(self, transfer):
+        # The download succeeded and was reported as such, so failing to
+        # e.g. record its manifest is only worth a log entry.
+        try:
+            transfer.finish()
+        except Exception:
+            log.exception('Could not finish %s', transfer.local_path)
+        finally:
+            self.finishing.done()
+
+    def _report_progress(self):
+        # Only what changed since the last tick, so idle sessions stay quiet
+        for worker in self.workers:
+            rate, eta, total, size = worker.tracker.get_progress()
+            if self.reported.get(worker.transfer_id) != total:
+                self.reported[worker.transfer_id] = total
+                self.hub.emit(events.PROGRESS, id=worker.transfer_id, url=worker.remote_path,
+                                 path=worker.local_path, bytes=total, size=size, rate=rate, eta=eta,
+                                 retries=worker.get_retries())
+
+        rate, eta, total, size = self.tracker.get_progress()
+        if self.reported.get(None) != total:
+            self.reported[None] = total
+            self.hub.emit(events.SESSION_PROGRESS, bytes=total, size=size, rate=rate, eta=eta)
+
+    def _report_end(self, worker, record):
+        self.reported.pop(worker.transfer_id, None)
+
+        data = dict(id=worker.transfer_id, url=record.remote_path, path=record.local_path, bytes=record.size,
+                    duration=record.duration)
+
+        if record.status == FINISHED:
+            self.hub.emit(events.FINISH, **data)
+        else:
+            self.hub.emit(events.ERROR, error=record.error, **data)
+
+    def _record(self, records, record):
+        if self.spill and records.maxlen == 0:
+            self._spill(record)
+        elif self.spill and len(records) == records.maxlen:
+            self._spill(records[0])
+        records.append(record)
+
+    def _spill(self, record):
+        from spry.db import Transfer, get_db_session
+
+        db = get_db_session()
+        db.add(Transfer(remote_path=record.remote_path, local_path=record.local_path, size=record.size,
+                        duration=record.duration, status=record.status))
+        db.commit()
+
     def run(self, *args, **kwargs):
         if not self.is_running:
             threading.Thread(target=self._run, args=args, kwargs=kwargs).start()
 
     def stop(self):
+        """Stops the session along with all running transfers"""
+
         self.is_running = False
+        self.wake.set()
 
     def pause(self):
         self.is_paused = True
+        for worker in list(self.workers):
+            worker.pause()
 
     def resume(self):
         self.is_paused = False
+        for worker in list(self.workers):
+            worker.resume()
+        self.wake.set()
 
     def get_progress(self):
         return self.tracker.get_progress()
 
+    def get_stats(self):
+        return self.stats.get_stats()
+
     def set_speed_limit(self, value, unit='KiB'):
         if value:
             self.speed_limit = (value, unit)
@@ -342,9 +1106,41 @@ class Session:
             self.speed_limit = None
             self.limiter.set_limit(0)
 
+    def set_priority(self, transfer, priority):
+        """Changes the priority of a queued or running transfer. Queued
+        transfers are reordered, running ones get a new bandwidth share.
+        """
+
+        transfer.set_priority(priority)
+        self.unfinished.update(transfer)
+
+    def set_deadline(self, transfer, deadline):
+        transfer.deadline = deadline
+        self.unfinished.update(transfer)
+
+    def set_policy(self, policy):
+        self.unfinished.set_policy(policy)
+
+    def set_host_limit(self, limit):
+        self.connections.set_limit(limit)
+
+    def add_hook(self, hook):
+        """Registers :class:`~spry.hooks.Hooks` which are called by the
+        streamers of every transfer started from now on.
+        """
+
+        self.hooks.add(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    @property
+    def host_limit(self):
+        return self.connections.limit
+
     @property
     def done(self):
-        return not self.unfinished
+        return not self.unfinished and not self.sources and not self.deferred
 
 
 
@@ -0,0 +1,188 @@
+from __future__ import division
+
+import errno
+import json
+import os
+import threading
+from time import sleep, time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+from spry.db import DATA_DIR
+from spry.utils import KIBIBYTE
+
+SHARED_FILE = os.path.join(DATA_DIR, 'bandwidth.json')
+
+# Bytes a process takes from the shared pool at once, so the file is
+# locked once per lease rather than once per chunk.
+LEASE_SIZE = KIBIBYTE * 256
+
+# Seconds after which a process that stopped drawing is forgotten, even
+# though a process with its PID exists, as PIDs get reused.
+STALE_AFTER = 10
+
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # Exists, but belongs to someone else
+        return e.errno == errno.EPERM
+    return True
+
+
+class SharedLimiter:
+    """Limits the combined bandwidth of every spry process on the host using
+    it, e.g. to keep many scheduled downloads under a NIC budget. Processes
+    draw from one pool of bytes per second kept in a file which is locked
+    while leasing. Like :class:`~spry.progress.SpeedLimiter` splits its
+    limit between children, the pool is split between processes that drew
+    during the current or previous second, by weight. Shares left unused are
+    free for others to take: a process is only expected to draw up to twice
+    what it drew during the previous second, so light users do not hold
+    back bandwidth they will not use.
+
+    The limit of the pool is the lowest limit of the processes using it.
+    Processes that exited, crashed or stopped drawing for 10 seconds are
+    dropped, along with their share.
+
+    :param limit: Bytes per second shared by all processes.
+    :type limit: int
+    :param path: The file holding the pool. Default: ``bandwidth.json`` in the
+                 spry data directory
+    :type path: str
+    :param weight: This process's relative share. Default: 1
+    :type weight: int or float
+    :param lease_size: The number of bytes taken from the pool at once.
+                       Default: 256 KiB
+    :type lease_size: int
+    :raises OSError: If file locking is not supported on this platform.
+    """
+
+    def __init__(self, limit, path=SHARED_FILE, weight=1, lease_size=LEASE_SIZE):
+        if fcntl is None:
+            raise OSError('shared limits need fcntl, which is unavailable on this platform')
+
+        self.limit = limit
+        self.path = path
+        self.weight = weight
+        self.lease_size = lease_size
+        self.lock = threading.Lock()
+
+        # What remains of the current lease, valid until the pool's window ends
+        self.tokens = 0
+        self.expires = 0
+
+    # Transfers running in worker processes receive a copy, which draws
+    # from the pool as a process of its own.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        state['tokens'] = state['expires'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get(self, size):
+        """Blocks until the pool allows receiving up to ``size`` bytes and
+        returns how many may be received.
+        """
+
+        if not self.limit:
+            return size
+
+        while True:
+            with self.lock:
+                now = time()
+                if now >= self.expires:
+                    self.tokens = 0
+
+                if self.tokens <= 0:
+                    self.tokens, self.expires = self._lease(size, now)
+
+                if self.tokens > 0:
+                    granted = min(size, self.tokens)
+                    self.tokens -= granted
+                    return granted
+
+                wait = self.expires - now
+
+            sleep(max(wait, 0))
+
+    def _lease(self, size, now):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read())
+                except ValueError:
+                    state = {'start': now, 'processes': {}}
+
+                granted = self._allocate(state, size, now)
+
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+        return granted, state['start'] + 1
+
+    def _allocate(self, state, size, now):
+        processes = state['processes']
+        pid = str(os.getpid())
+
+        for key, entry in list(processes.items()):
+            if key != pid and (now - entry['seen'] > STALE_AFTER or not pid_exists(int(key))):
+                del processes[key]
+
+        if now - state['start'] >= 1:
+            state['start'] = now
+            for entry in processes.values():
+                entry['previous'] = entry['requested']
+                entry['requested'] = 0
+
+        own = processes.setdefault(pid, {'requested': 0, 'previous': 0})
+        own.update(limit=self.limit, weight=self.weight, seen=now)
+
+        limit = min(entry['limit'] for entry in processes.values())
+        allowance = limit - sum(entry['requested'] for entry in processes.values())
+
+        active = dict(
+            (key, entry) for key, entry in processes.items()
+            if key == pid or entry['requested'] or entry['previous']
+        )
+
+        if allowance > 0 and len(active) > 1:
+            total_weight = sum(entry['weight'] for entry in active.values())
+            own_remaining = limit * self.weight / total_weight - own['requested']
+
+            reserved = 0
+            for key, entry in active.items():
+                if key != pid:
+                    share = limit * entry['weight'] / total_weight
+                    expected = min(share, entry['previous'] * 2) if entry['previous'] else share
+                    reserved += max(0, expected - entry['requested'])
+
+            allowance = min(allowance, max(own_remaining, allowance - reserved))
+
+        granted = int(min(max(size, self.lease_size), allowance)) if allowance > 0 else 0
+        own['requested'] += granted
+
+        return granted
+
+    def set_limit(self, limit):
+        with self.lock:
+            self.limit = limit
+            self.tokens = 0
@@ -0,0 +1,603 @@
+import mmap
+import os
+import select
+import socket
+import ssl
+import threading
+from collections import defaultdict
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # pragma: no cover
+    from urlparse import urlsplit
+
+from spry.io import CONNECT_TIMEOUT, READ_TIMEOUT, import_requests
+from spry.utils import CHUNK_SIZE
+
+# Idle connections kept per origin
+MAX_IDLE = 16
+
+# Longest status or header line accepted, and most header lines
+MAX_LINE = 65536
+MAX_HEADERS = 100
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Bytes received at once while looking for the end of a line
+RECEIVE_SIZE = 65536
+
+# Whether bodies can be moved from sockets to files inside the kernel, and
+# the most moved at once, the default capacity of a pipe.
+SPLICE = hasattr(os, 'splice')
+SPLICE_SIZE = 65536
+
+# Whether files can be sent without copying them into Python
+SENDFILE = hasattr(os, 'sendfile')
+
+# Request arguments the raw transport understands, anything else needs requests
+RAW_ARGUMENTS = ('auth', 'headers', 'stream', 'timeout', 'verify')
+
+
+def supports_raw(kwargs):
+    """Returns whether requests made with ``kwargs`` can be sent by a
+    :class:`RawAdapter`. Only basic auth is supported, as other schemes
+    need a round trip per request.
+    """
+
+    auth = kwargs.get('auth')
+    if auth is not None and type(auth) is not import_requests().auth.HTTPBasicAuth:
+        return False
+    return all(name in RAW_ARGUMENTS for name in kwargs)
+
+
+def build_request(method, url, headers=None, auth=None):
+    """Returns the origin of ``url`` as a ``(scheme, host, port)`` tuple and
+    the head of a request to it.
+    """
+
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS:
+        raise ValueError('unsupported scheme: {}'.format(scheme))
+
+    host = parts.hostname
+    port = parts.port or DEFAULT_PORTS[scheme]
+    target = '{}?{}'.format(parts.path or '/', parts.query) if parts.query else parts.path or '/'
+
+    requests = import_requests()
+    request_headers = {
+        'Host': host if parts.port is None else '{}:{}'.format(host, port),
+        'User-Agent': requests.utils.default_user_agent(),
+        'Accept-Encoding': 'identity',
+        'Connection': 'keep-alive'
+    }
+    if auth is not None:
+        request_headers.update(auth(requests.Request(method, url).prepare()).headers)
+    request_headers.update(headers or {})
+
+    request = '{} {} HTTP/1.1\r\n{}\r\n'.format(
+        method, target, ''.join('{}: {}\r\n'.format(name, value) for name, value in request_headers.items())
+    ).encode('latin-1')
+
+    return (scheme, host, port), request
+
+
+class Connection:
+    """A persistent HTTP/1.1 connection, over TLS for ``https``"""
+
+    def __init__(self, scheme, host, port, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), verify=True):
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+
+        sock = socket.create_connection((host, port), connect_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if scheme == 'https':
+            context = ssl.create_default_context()
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            elif verify is not True:
+                context.load_verify_locations(verify)
+
+            try:
+                sock = context.wrap_socket(sock, server_hostname=host)
+            except Exception:
+                sock.close()
+                raise
+
+        sock.settimeout(read_timeout)
+        self.sock = sock
+        self.read_timeout = read_timeout
+        self.encrypted = scheme == 'https'
+
+        # Bytes received past the last line read. Anything else goes
+        # straight from the socket to where the caller wants it.
+        self.buffer = bytearray()
+
+        # Created on the first splice and the first wait for the socket
+        self.pipe = None
+        self.poller = None
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def readline(self, limit=MAX_LINE):
+        buffer = self.buffer
+        searched = 0
+
+        while True:
+            end = buffer.find(b'\n', searched)
+            if end >= 0:
+                line = bytes(buffer[:end + 1])
+                del buffer[:end + 1]
+                return line
+            elif len(buffer) > limit:
+                raise IOError('line too long')
+
+            searched = len(buffer)
+            data = self.sock.recv(RECEIVE_SIZE)
+            if not data:
+                line = bytes(buffer)
+                del buffer[:]
+                return line
+            buffer += data
+
+    def read(self, nbytes):
+        """Returns up to ``nbytes``, fewer if that is what arrived"""
+
+        buffer = self.buffer
+        if buffer:
+            data = bytes(buffer[:nbytes])
+            del buffer[:nbytes]
+            return data
+        return self.sock.recv(nbytes)
+
+    def readinto(self, view):
+        buffer = self.buffer
+        if buffer:
+            nbytes = min(len(view), len(buffer))
+            view[:nbytes] = buffer[:nbytes]
+            del buffer[:nbytes]
+            return nbytes
+        return self.sock.recv_into(view)
+
+    def splice(self, fd, offset, nbytes):
+        """Moves up to ``nbytes`` from the socket to ``offset`` of the
+        file ``fd`` through a pipe, without copying them into Python.
+        Returns how many, 0 meaning the connection was closed. Linux only,
+        and not over TLS as the kernel does not decrypt.
+        """
+
+        # Whatever came along with the headers is already here
+        buffer = self.buffer
+        if buffer:
+            nbytes = min(nbytes, len(buffer))
+            written = os.pwrite(fd, buffer[:nbytes], offset)
+            del buffer[:written]
+            return written
+
+        if self.pipe is None:
+            self.pipe = os.pipe()
+        pipe_read, pipe_write = self.pipe
+
+        while True:
+            self._wait(select.POLLIN)
+            try:
+                moved = os.splice(self.sock.fileno(), pipe_write, min(nbytes, SPLICE_SIZE))
+                break
+            except BlockingIOError:
+                continue
+
+        # Should the file refuse them, bytes left in the pipe are dropped
+        # along with the connection, which is not reused then.
+        written = 0
+        while written < moved:
+            written += os.splice(pipe_read, fd, moved - written, offset_dst=offset + written)
+
+        return moved
+
+    def sendfile(self, fd, offset, nbytes):
+        """Sends ``nbytes`` at ``offset`` of the file ``fd`` with the kernel
+        copying them straight to the socket. Plain HTTP only.
+        """
+
+        sent = 0
+        while sent < nbytes:
+            try:
+                count = os.sendfile(self.sock.fileno(), fd, offset + sent, nbytes - sent)
+            except BlockingIOError:
+                self._wait(select.POLLOUT)
+                continue
+
+            if not count:
+                raise IOError('file ended before all bytes were sent')
+            sent += count
+
+        return sent
+
+    def _wait(self, event):
+        """Waits for the socket, which is non-blocking because of its
+        timeout, to be ready for ``event``.
+        """
+
+        if self.poller is None:
+            self.poller = select.poll()
+
+        # Registering again changes the events waited for
+        self.poller.register(self.sock.fileno(), event)
+        if not self.poller.poll(None if self.read_timeout is None else self.read_timeout * 1000):
+            raise socket.timeout('timed out')
+
+    def read_head(self):
+        """Reads a response's status line and headers. Returns the status
+        code, the HTTP version and the headers with lowercase names.
+        """
+
+        line = self.readline()
+        if not line:
+            raise IOError('connection closed by the server')
+
+        parts = line.decode('latin-1').split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+            raise IOError('invalid status line: {!r}'.format(line))
+        version, status = parts[0], int(parts[1])
+
+        headers = {}
+        for _ in range(MAX_HEADERS + 1):
+            line = self.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+
+            name, _, value = line.decode('latin-1').partition(':')
+            name, value = name.strip().lower(), value.strip()
+            headers[name] = '{}, {}'.format(headers[name], value) if name in headers else value
+        else:
+            raise IOError('too many headers')
+
+        return status, version, headers
+
+    def close(self):
+        if self.pipe is not None:
+            for fd in self.pipe:
+                os.close(fd)
+            self.pipe = None
+        self.sock.close()
+
+
+class ConnectionPool:
+    """Idle keep-alive connections by origin, shared by every streamer of
+    a :class:`~spry.sessions.Session` using the raw transport.
+
+    :param max_idle: The number of idle connections kept per origin.
+                     Default: 16
+    :type max_idle: int
+    """
+
+    def __init__(self, max_idle=MAX_IDLE):
+        self.max_idle = max_idle
+        self.idle = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop()
+        return None
+
+    def put(self, key, connection):
+        with self.lock:
+            connections = self.idle[key]
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        with self.lock:
+            connections = [connection for idle in self.idle.values() for connection in idle]
+            self.idle.clear()
+
+        for connection in connections:
+            connection.close()
+
+
+class RawAdapter:
+    """A minimal HTTP/1.1 client with the interface of
+    :class:`~spry.io.HTTPAdapter`, for fetching ranges without the overhead
+    of requests, urllib3 and http.client on every connection and chunk.
+    Connections are kept alive and reused through a :class:`ConnectionPool`
+    once a response was read to its end. Chunked responses are decoded and
+    :meth:`readinto` fills caller buffers without intermediate copies.
+
+    Redirects, cookies, proxies and auth schemes other than basic are not
+    supported, which is why requests is still used to probe a URL, see
+    :func:`supports_raw`. Response bodies are never decoded.
+
+    :param url: The URL to get, e.g. where the probe ended up.
+    :type url: str
+    :param pool: Where to take connections from and return them to.
+                 Default: ``None``, a new connection closed afterwards
+    :type pool: :class:`ConnectionPool` or ``None``
+    :raises IOError: If the connection failed or the response is invalid.
+    """
+
+    def __init__(self, url, pool=None, headers=None, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), verify=True,
+                 auth=None, method='GET', **kwargs):
+        (scheme, host, port), request = build_request(method, url, headers, auth)
+
+        self.pool = pool
+        self.key = (scheme, host, port, verify)
+        self.method = method
+        self.connection = None
+        self.done = False
+
+        # A pooled connection may have been closed by the server meanwhile,
+        # which only shows once used, so retry those on a new one.
+        while True:
+            connection = pool.get(self.key) if pool is not None else None
+            reused = connection is not None
+            if not reused:
+                connection = Connection(scheme, host, port, timeout=timeout, verify=verify)
+
+            try:
+                connection.send(request)
+                self.status_code, version, self.headers = connection.read_head()
+            except (IOError, OSError):
+                connection.close()
+                if reused:
+                    continue
+                raise
+
+            self.connection = connection
+            break
+
+        self._frame(version)
+
+    def _frame(self, version):
+        """Works out where the body of the response ends"""
+
+        headers = self.headers
+        connection_header = headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            self.keep_alive = connection_header == 'keep-alive'
+        else:
+            self.keep_alive = connection_header != 'close'
+
+        # Bytes left in the body or the current chunk, None if unknown
+        self.chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+        self.chunk_left = None
+        self.remaining = None
+
+        if self.chunked:
+            pass
+        elif self.method == 'HEAD' or self.status_code in (204, 304) or 100 <= self.status_code < 200:
+            self.remaining = 0
+        elif 'content-length' in headers:
+            self.remaining = int(headers['content-length'])
+        else:
+            # The body ends with the connection
+            self.keep_alive = False
+
+    def _available(self, nbytes):
+        """Returns how many bytes may be read next, handling chunk framing"""
+
+        if self.done:
+            return 0
+
+        if self.chunked:
+            connection = self.connection
+
+            # The CRLF after a chunk's data
+            if self.chunk_left == 0:
+                connection.readline()
+                self.chunk_left = None
+
+            if self.chunk_left is None:
+                line = connection.readline()
+                try:
+                    self.chunk_left = int(line.split(b';', 1)[0].strip(), 16)
+                except ValueError:
+                    raise IOError('invalid chunk size: {!r}'.format(line))
+
+                if self.chunk_left == 0:
+                    # Trailers, if any, end with an empty line
+                    for _ in range(MAX_HEADERS + 1):
+                        if connection.readline() in (b'\r\n', b'\n', b''):
+                            break
+                    self._end()
+                    return 0
+
+            return min(nbytes, self.chunk_left)
+
+        if self.remaining is None:
+            return nbytes
+        elif not self.remaining:
+            self._end()
+        return min(nbytes, self.remaining)
+
+    def _consume(self, nbytes, requested):
+        if not nbytes and requested:
+            if self.remaining is None and not self.chunked:
+                self._end()
+                return
+            raise IOError('connection closed before the response ended')
+
+        if self.chunked:
+            self.chunk_left -= nbytes
+        elif self.remaining is not None:
+            self.remaining -= nbytes
+            if not self.remaining:
+                self._end()
+
+    def _end(self):
+        self.done = True
+
+        # Only a connection whose response was read in full can be reused
+        if self.keep_alive and self.pool is not None:
+            self.pool.put(self.key, self.connection)
+        else:
+            self.connection.close()
+
+    def readinto(self, b):
+        """Reads up to ``len(b)`` bytes of the body into ``b`` and returns
+        how many, 0 meaning the body ended.
+        """
+
+        view = memoryview(b)
+        nbytes = self._available(len(view))
+        if not nbytes:
+            return 0
+
+        received = self.connection.readinto(view[:nbytes])
+        self._consume(received, nbytes)
+        return received
+
+    def read(self, nbytes):
+        nbytes = self._available(nbytes)
+        if not nbytes:
+            return b''
+
+        data = self.connection.read(nbytes)
+        self._consume(len(data), nbytes)
+        return data
+
+    @property
+    def can_splice(self):
+        """Whether :meth:`splice` can be used for this response, i.e. on
+        Linux for plain HTTP bodies of a known length.
+        """
+
+        return SPLICE and not self.connection.encrypted and not self.chunked and self.remaining is not None
+
+    def splice(self, fd, offset, nbytes):
+        """Like :meth:`readinto`, but moves the bytes to ``offset`` of the
+        file ``fd`` inside the kernel. See :attr:`can_splice`.
+        """
+
+        nbytes = self._available(nbytes)
+        if not nbytes:
+            return 0
+
+        moved = self.connection.splice(fd, offset, nbytes)
+        self._consume(moved, nbytes)
+        return moved
+
+    def read_all(self, nbytes=None):
+        """Reads until ``nbytes`` were received or the response ends"""
+
+        if nbytes is None:
+            data = bytearray()
+            while True:
+                chunk = self.read(CHUNK_SIZE)
+                if not chunk:
+                    return data
+                data += chunk
+
+        data = bytearray(nbytes)
+        view = memoryview(data)
+        filled = 0
+        while filled < nbytes:
+            received = self.readinto(view[filled:])
+            if not received:
+                break
+            filled += received
+
+        del view
+        del data[filled:]
+        return data
+
+    def abort(self):
+        """Shuts down the connection from any thread, which makes a read
+        blocked in another thread return or raise right away.
+        """
+
+        try:
+            self.connection.sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+
+    def close(self):
+        # Unread bytes would be taken for the next response
+        if not self.done:
+            self.done = True
+            self.connection.close()
+
+
+class RawUploadAdapter(RawAdapter):
+    """Sends ``size`` bytes of a local file as the body of a request, in
+    pieces at any offsets given to :meth:`send_file`. On plain connections
+    the kernel copies them from the file to the socket with sendfile. Over
+    TLS, where it cannot, they are sent from a memory map of the file so
+    they are not read into Python first either. The response is only read
+    by :meth:`get_response`, after which the adapter reads like a
+    :class:`RawAdapter`.
+
+    :param source: The file to send from.
+    :type source: :class:`~spry.io.FileAdapter`
+    :param size: The number of bytes that will be sent.
+    :type size: int
+    """
+
+    def __init__(self, url, source, size, pool=None, headers=None, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                 verify=True, auth=None, method='PUT', **kwargs):
+        headers = dict(headers or {})
+        headers['Content-Length'] = str(size)
+        (scheme, host, port), request = build_request(method, url, headers, auth)
+
+        self.pool = pool
+        self.key = (scheme, host, port, verify)
+        self.method = method
+        self.source = source
+        self.map = None
+
+        # Known once the body was sent
+        self.status_code = None
+        self.headers = {}
+        self.done = False
+
+        # A stale pooled connection only shows once the response is read,
+        # when it is too late to retry here, so it fails like any other.
+        connection = pool.get(self.key) if pool is not None else None
+        if connection is None:
+            connection = Connection(scheme, host, port, timeout=timeout, verify=verify)
+
+        self.connection = connection
+        try:
+            connection.send(request)
+        except Exception:
+            connection.close()
+            raise
+
+    def send_file(self, offset, nbytes):
+        """Sends ``nbytes`` of the file from ``offset`` and returns how many"""
+
+        connection = self.connection
+        if SENDFILE and not connection.encrypted:
+            return connection.sendfile(self.source.fileno(), offset, nbytes)
+
+        if self.map is None:
+            self.map = mmap.mmap(self.source.fileno(), 0, access=mmap.ACCESS_READ)
+        connection.send(memoryview(self.map)[offset:offset + nbytes])
+        return nbytes
+
+    def get_response(self):
+        """Reads the response once the whole body was sent, then its body
+        so that the connection can be reused. Returns the status code.
+        """
+
+        self.status_code, version, self.headers = self.connection.read_head()
+        self._frame(version)
+        self.read_all()
+
+        return self.status_code
+
+    def close(self):
+        # Unread bytes would be taken for the next response
+        if not self.done:
+            self.done = True
+            self.connection.close()
+
+        if self.map is not None:
+            self.map.close()
+            self.map = None
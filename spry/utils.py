@@ -1,13 +1,21 @@
 from __future__ import division
 
 import datetime
+import errno
 import os
 import re
+import shutil
 from collections import defaultdict, OrderedDict
 from functools import wraps
 from threading import Lock
 from time import time
 
+try:
+    from urllib.parse import unquote, urljoin, urlsplit
+except ImportError:  # pragma: no cover
+    from urllib import unquote
+    from urlparse import urljoin, urlsplit
+
 SECOND = 1
 MINUTE = SECOND * 60
 HOUR = MINUTE * 60
@@ -53,13 +61,48 @@ CLI_CONSTANTS = {
     'false': False,
 }
 
+DEFAULT_PORTS = {
+    'http': 80,
+    'https': 443,
+    'sftp': 22,
+}
+
 # Time between polls of Streamer objects' status in Session
 STATE_CHECK = SECOND * 1
 
+# Ways of reserving disk space for a file before writing its sections
+PREALLOCATE_AUTO = 'auto'
+PREALLOCATE_FULL = 'fallocate'
+PREALLOCATE_SPARSE = 'sparse'
+PREALLOCATE_NONE = 'none'
+PREALLOCATION_MODES = (PREALLOCATE_AUTO, PREALLOCATE_FULL, PREALLOCATE_SPARSE, PREALLOCATE_NONE)
+
+# How sections are fetched, requests or lean keep-alive connections of our own
+REQUESTS = 'requests'
+RAW = 'raw'
+TRANSPORTS = (REQUESTS, RAW)
+
+# File systems on which reserving blocks up front gains nothing. Copy-on-write
+# ones allocate new extents on every write anyway, and network ones often lack
+# fallocate so libc emulates it by writing zeros over the wire.
+SPARSE_FILE_SYSTEMS = {
+    '9p', 'btrfs', 'ceph', 'cifs', 'fuse.glusterfs', 'fuse.sshfs',
+    'glusterfs', 'nfs', 'nfs4', 'smb3', 'smbfs', 'zfs',
+}
+
+MOUNTS_FILE = '/proc/self/mounts'
+
+# Linux ioctl sharing a file's extents with another, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
 # 16 KiB per TCP request seems optimal, and is also the
 # recommended chunk size of the Bittorrent protocol
 CHUNK_SIZE = KIBIBYTE * 16
 
+# Received chunks are coalesced into writes of this size per section,
+# trading a little memory for far fewer write calls and IOPS
+WRITE_BUFFER_SIZE = MEBIBYTE * 1
+
 
 def find_dirs_and_files(directory):
     dirs = []
@@ -111,6 +154,95 @@ def parse_fname_from_headers(headers):
     return fname
 
 
+CONTENT_RANGE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)', re.IGNORECASE)
+
+
+def parse_content_range(value):
+    """
+    Parses a Content-Range header into a tuple of inclusive start and
+    end offsets and the total size, which is ``None`` if unknown.
+    Returns ``None`` if the header is missing or malformed.
+
+    Examples:
+        'bytes 0-99/1000' returns (0, 99, 1000)
+        'bytes 100-199/*' returns (100, 199, None)
+    """
+
+    match = CONTENT_RANGE.match(value or '')
+    if not match:
+        return None
+
+    start, end, total = match.groups()
+    return int(start), int(end), None if total == '*' else int(total)
+
+
+LINK = re.compile(r'<([^>]*)>([^,]*)')
+METALINK_TYPE = 'application/metalink4+xml'
+
+
+def parse_metalink_url(headers, url):
+    """
+    Returns the absolute URL of the Metalink document describing the
+    resource at ``url``, which servers link to with ``rel=describedby``
+    in a Link header (RFC 6249), or ``None`` if there is none.
+
+    Examples:
+        '<f.meta4>; rel=describedby; type="application/metalink4+xml"'
+        for 'http://a/f' returns 'http://a/f.meta4'
+    """
+
+    for target, params in LINK.findall(headers.get('link', '')):
+        attributes = {}
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            attributes[name.strip().lower()] = value.strip().strip('"')
+
+        if 'describedby' not in attributes.get('rel', '').lower().split():
+            continue
+
+        if attributes.get('type', '').lower() == METALINK_TYPE or target.endswith('.meta4'):
+            return urljoin(url, target)
+
+    return None
+
+
+def parse_fname_from_url(url):
+    """
+    Infers file name from the last segment of a URL's path. Separators
+    that were percent-encoded are split on after decoding, so the name
+    can never point outside the directory it is joined to.
+
+    Examples:
+        'http://example.com/a/b.iso' returns 'b.iso'
+        'http://example.com/a/..%2F..%2F.bashrc' returns '.bashrc'
+    """
+
+    name = os.path.basename(unquote(urlsplit(url).path).replace('\\', '/'))
+    if name in ('', '.', '..'):
+        return None
+    return name
+
+
+def get_origin(url):
+    """
+    Returns the origin of a URL i.e. scheme, host and port, used to
+    group connections that end up at the same server.
+
+    Examples:
+        'https://example.com/file.iso' returns 'https://example.com:443'
+        'http://Example.com:8080/a?b=c' returns 'http://example.com:8080'
+    """
+
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    port = parts.port or DEFAULT_PORTS.get(scheme)
+    host = (parts.hostname or '').lower()
+
+    if port:
+        return '{}://{}:{}'.format(scheme, host, port)
+    return '{}://{}'.format(scheme, host)
+
+
 def parse_kwargs(args):
     """
     Returns a properly formatted dict of CLI keyword arguments
@@ -321,30 +453,165 @@ def calc_section_data(size, num_parts):
     return section_data
 
 
-def create_null_file(path, size=1):
-    """Creates an empty file of optional size"""
-
-    parent_dir = os.path.dirname(path)
-    existing_dir = parent_dir
-    free_space = 0
+def find_existing_dir(path):
+    """
+    Walks up the file system from ``path`` until an existing
+    directory is found, e.g. to check the disk space remaining
+    where a file will be created.
+    """
 
-    # Walk up file system until an existing directory
-    # is found to check for disk space remaining
     while True:
-        if os.path.exists(existing_dir):
-            free_space = disk_usage(existing_dir)['free']
-            break
-        existing_dir = os.path.dirname(existing_dir)
+        if os.path.exists(path or os.curdir):
+            return path or os.curdir
+        path = os.path.dirname(path)
+
+
+def get_allocated_size(path):
+    """
+    Returns the number of bytes of disk space a file takes up,
+    which for sparse files is less than their size, or 0 if it
+    does not exist.
+    """
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return 0
+
+    # Windows has no block count, files there are assumed dense
+    blocks = getattr(stat, 'st_blocks', None)
+    return blocks * 512 if blocks is not None else stat.st_size
 
-    if size >= free_space:
+
+def create_null_file(path, size=1, mode=PREALLOCATE_AUTO, overwrite=True):
+    """
+    Creates an empty file of optional size, reserving its disk space
+    according to the preallocation mode:
+
+    - 'fallocate' allocates every block up front so that sections written
+      out of order still end up in contiguous extents.
+    - 'sparse' only sets the file's size, leaving blocks to be allocated
+      as they are written.
+    - 'none' creates an empty file which grows as sections are written.
+    - 'auto' picks 'sparse' for file systems in SPARSE_FILE_SYSTEMS or
+      when fallocate is unavailable, else 'fallocate'.
+
+    If overwrite is false and a file of the right size already exists,
+    e.g. when resuming, it is left untouched.
+    """
+
+    if not size or size < 1:
+        raise ValueError('size must be a positive integer')
+    elif mode not in PREALLOCATION_MODES:
+        raise ValueError('unknown preallocation mode: {}'.format(mode))
+
+    existing_size = os.path.getsize(path) if os.path.isfile(path) else 0
+    if not overwrite and existing_size == size:
+        return
+
+    parent_dir = os.path.dirname(path)
+    free_space = disk_usage(find_existing_dir(parent_dir))['free']
+
+    # The space of a file we are about to replace is ours to reuse
+    if size >= free_space + existing_size:
         raise OSError('insufficient storage space remaining')
 
-    if not os.path.exists(parent_dir):
+    if parent_dir and not os.path.exists(parent_dir):
         os.makedirs(parent_dir)
 
+    if mode == PREALLOCATE_AUTO:
+        mode = get_preallocation_mode(parent_dir or os.curdir)
+
     with open(path, 'wb') as f:
-        f.seek(size - 1)
-        f.write(b'\x00')
+        if mode == PREALLOCATE_FULL:
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                mode = PREALLOCATE_SPARSE
+
+        if mode == PREALLOCATE_SPARSE:
+            f.truncate(size)
+
+
+def get_preallocation_mode(path):
+    """Returns the preallocation mode 'auto' resolves to for a directory"""
+
+    if not hasattr(os, 'posix_fallocate'):
+        return PREALLOCATE_SPARSE
+    elif get_file_system(path) in SPARSE_FILE_SYSTEMS:
+        return PREALLOCATE_SPARSE
+    return PREALLOCATE_FULL
+
+
+def get_file_system(path):
+    """
+    Returns the type of the file system holding an existing path,
+    e.g. 'ext4', or None if it cannot be determined. Only Linux,
+    through /proc/self/mounts, is currently supported.
+    """
+
+    try:
+        with open(MOUNTS_FILE, 'r') as f:
+            mounts = f.read().splitlines()
+    except (IOError, OSError):
+        return None
+
+    path = os.path.realpath(path)
+    best_match = ''
+    file_system = None
+
+    for line in mounts:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+
+        # Spaces and other special characters are octal-escaped
+        mount_point = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields[1])
+
+        if path == mount_point or path.startswith(mount_point.rstrip(os.sep) + os.sep):
+            if len(mount_point) >= len(best_match):
+                best_match = mount_point
+                file_system = fields[2]
+
+    return file_system
+
+
+def clone_file(src, dst, hardlink=False):
+    """
+    Makes dst a copy of src as cheaply as possible. A reflink, sharing
+    extents copy-on-write, is tried first, then a hard link if allowed,
+    and finally a regular copy. Returns which of 'reflink', 'hardlink'
+    or 'copy' was used.
+
+    Hard links share the file itself, so later changes to either
+    path show in both.
+    """
+
+    if os.path.exists(dst):
+        os.remove(dst)
+
+    try:
+        import fcntl
+
+        with open(src, 'rb') as source, open(dst, 'wb') as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        return 'reflink'
+    except (ImportError, IOError, OSError):
+        if os.path.exists(dst):
+            os.remove(dst)
+
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError:
+            pass
+
+    shutil.copyfile(src, dst)
+    return 'copy'
 
 
 if hasattr(os, 'statvfs'):
@@ -0,0 +1,286 @@
+import logging
+import threading
+from collections import deque
+from time import time
+
+try:
+    from queue import Queue
+except ImportError:  # pragma: no cover
+    from Queue import Queue
+
+from spry.utils import MEBIBYTE
+
+# Default number of threads persisting buffers for a Session
+DISK_WRITERS = 2
+
+# Default session-wide number of received bytes allowed to wait for disk
+MEMORY_LIMIT = MEBIBYTE * 64
+
+# Default maximum number of threads running a Session's streamers
+WORKER_THREADS = 16
+
+# Seconds a pool thread waits for a new task before exiting
+IDLE_TIMEOUT = 5
+
+log = logging.getLogger(__name__)
+
+
+class MemoryBudget:
+    """Bounds the number of bytes held in memory between network readers and
+    disk writers. Readers that would exceed it block until writers catch up,
+    which applies backpressure to the network instead of growing without
+    bound when the disk is slower.
+
+    :param limit: The maximum number of bytes in flight. A falsy value means
+                  no limit. Default: ``None``
+    :type limit: int or ``None``
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, nbytes):
+        """Blocks until ``nbytes`` fit in the budget and returns the number
+        of seconds spent waiting. A request larger than the whole budget is
+        let through once nothing else is in flight, so it cannot deadlock.
+        """
+
+        waited = 0
+        with self.condition:
+            if self.limit and self.in_flight and self.in_flight + nbytes > self.limit:
+                start_time = time()
+                while self.in_flight and self.in_flight + nbytes > self.limit:
+                    self.condition.wait()
+                waited = time() - start_time
+
+            self.in_flight += nbytes
+
+        return waited
+
+    def release(self, nbytes):
+        with self.condition:
+            self.in_flight -= nbytes
+            self.condition.notify_all()
+
+
+class Latch:
+    """Counts tasks handed to other threads so that whoever handed them out
+    can wait for all of them to end. The first error a task reports is
+    re-raised by :meth:`wait`.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.error = None
+        self.condition = threading.Condition()
+
+    def add(self):
+        with self.condition:
+            self.count += 1
+
+    def done(self):
+        with self.condition:
+            self.count -= 1
+            self.condition.notify_all()
+
+    def fail(self, error):
+        with self.condition:
+            self.count -= 1
+            if self.error is None:
+                self.error = error
+            self.condition.notify_all()
+
+    def wait(self):
+        with self.condition:
+            while self.count:
+                self.condition.wait()
+
+            error, self.error = self.error, None
+
+        if error is not None:
+            raise error
+
+
+class PendingWrites:
+    """Tracks the buffers a single streamer has handed to a
+    :class:`DiskWriter` so it can wait for them to be persisted.
+
+    :param completed: Where the ranges of successful writes are recorded.
+                      Default: ``None``
+    :type completed: :class:`~spry.progress.CompletionMap` or ``None``
+    """
+
+    def __init__(self, completed=None):
+        self.count = 0
+        self.written = 0
+        self.error = None
+        self.completed = completed
+        self.condition = threading.Condition()
+
+    def add(self):
+        with self.condition:
+            self.count += 1
+
+    def done(self, nbytes, offset=None):
+        # Recorded before waiters are woken, so the range is known to be
+        # persisted by the time wait returns.
+        if self.completed is not None and offset is not None and nbytes:
+            self.completed.add(offset, offset + nbytes - 1)
+
+        with self.condition:
+            self.count -= 1
+            self.written += nbytes
+            self.condition.notify_all()
+
+    def fail(self, error):
+        with self.condition:
+            self.count -= 1
+            self.error = error
+            self.condition.notify_all()
+
+    def wait(self):
+        """Blocks until every submitted buffer was written and returns the
+        number of bytes written since the last call. The first error raised
+        by a write is re-raised here.
+        """
+
+        with self.condition:
+            while self.count:
+                self.condition.wait()
+
+            written, self.written = self.written, 0
+            error, self.error = self.error, None
+
+        if error is not None:
+            raise error
+        return written
+
+
+class DiskWriter:
+    """A stage of threads persisting buffers received by streamers, so that a
+    slow disk no longer stalls reading from the socket. Buffers wait in a
+    queue bounded by a session-wide :class:`MemoryBudget`.
+
+    :param threads: The number of writer threads. Default: 2
+    :type threads: int
+    :param memory_limit: The maximum number of bytes waiting to be written.
+                         Default: 64 MiB
+    :type memory_limit: int
+    """
+
+    def __init__(self, threads=DISK_WRITERS, memory_limit=MEMORY_LIMIT):
+        self.threads = threads
+        self.budget = MemoryBudget(memory_limit)
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.started = False
+
+    def submit(self, writer, offset, data, pending, stats=None):
+        """Queues ``data`` to be written at ``offset`` and returns the number
+        of seconds spent blocked on the memory budget.
+        """
+
+        if not self.started:
+            self._start()
+
+        waited = self.budget.acquire(len(data))
+        pending.add()
+        self.queue.put((writer, offset, data, pending, stats))
+
+        return waited
+
+    def _start(self):
+        with self.lock:
+            if not self.started:
+                for _ in range(self.threads):
+                    thread = threading.Thread(target=self._work)
+                    thread.daemon = True
+                    thread.start()
+                self.started = True
+
+    def _work(self):
+        while True:
+            writer, offset, data, pending, stats = self.queue.get()
+            nbytes = len(data)
+            start_time = time()
+
+            try:
+                writer.write_at(offset, data)
+            except Exception as e:
+                pending.fail(e)
+            else:
+                pending.done(nbytes, offset)
+            finally:
+                self.budget.release(nbytes)
+
+                if stats is not None:
+                    stats.add(disk=time() - start_time)
+
+
+class WorkerPool:
+    """Runs tasks on a bounded number of reusable threads. Threads are only
+    created when there are more queued tasks than idle threads, and exit
+    after being idle for a while, so a :class:`~spry.sessions.Session` with
+    thousands of queued sections never runs more than ``threads`` at once.
+
+    :param threads: The maximum number of threads. Default: 16
+    :type threads: int
+    :param idle_timeout: Seconds an idle thread waits for work before
+                         exiting. Default: 5
+    :type idle_timeout: int or float
+    """
+
+    def __init__(self, threads=WORKER_THREADS, idle_timeout=IDLE_TIMEOUT):
+        if threads < 1:
+            raise ValueError('a pool needs at least one thread')
+
+        self.max_threads = threads
+        self.idle_timeout = idle_timeout
+        self.tasks = deque()
+        self.condition = threading.Condition()
+        self.thread_count = 0
+        self.idle = 0
+
+    def submit(self, func, *args):
+        with self.condition:
+            self.tasks.append((func, args))
+
+            if len(self.tasks) > self.idle and self.thread_count < self.max_threads:
+                self.thread_count += 1
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+
+            self.condition.notify()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.tasks:
+                    self.idle += 1
+                    woken = self.condition.wait(self.idle_timeout)
+                    self.idle -= 1
+
+                    if not woken and not self.tasks:
+                        self.thread_count -= 1
+                        return
+
+                func, args = self.tasks.popleft()
+
+            try:
+                func(*args)
+            except Exception:
+                # Tasks handle their own errors, a stray one
+                # must not cost the pool a thread.
+                log.exception('Unhandled error in pool task %r', func)
+
+    def set_threads(self, threads):
+        with self.condition:
+            self.max_threads = threads
+
+    @property
+    def pending(self):
+        with self.condition:
+            return len(self.tasks)
@@ -0,0 +1,32 @@
+import pytest
+
+from .server import RangeServer
+
+
+@pytest.fixture
+def serve():
+    """Starts a :class:`RangeServer` of the given data and options, e.g.
+    ``serve(DATA, ranges=False)``. Every server started is closed once the
+    test ends.
+    """
+
+    servers = []
+
+    def start(data, **kwargs):
+        server = RangeServer(data, **kwargs)
+        servers.append(server)
+        return server
+
+    yield start
+
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture
+def server(request, serve):
+    """A :class:`RangeServer` of the test module's ``DATA``, or of the data
+    the test is parametrized with indirectly.
+    """
+
+    return serve(getattr(request, 'param', request.module.DATA))
@@ -0,0 +1,174 @@
+import re
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+RANGE = re.compile(r'(\d+)-(\d*)')
+
+BOUNDARY = 'SPRY_TEST_BOUNDARY'
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.authorizations.append(self.headers.get('authorization'))
+
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', self.server.redirect or '/file')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        server = self.server
+        if server.metalink is not None and self.path.endswith('.meta4'):
+            return self.send_body(200, server.metalink, {'Content-Type': 'application/metalink4+xml'})
+
+        data = server.data
+        header = self.headers.get('range')
+
+        with server.lock:
+            server.requests.append(header)
+
+        if not header or not server.ranges:
+            return self.send_body(200, data)
+
+        ranges = []
+        for match in RANGE.finditer(header):
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+            ranges.append((start, end))
+
+        # Servers without multi-range support commonly serve the first range
+        if len(ranges) == 1 or not server.multipart:
+            start, end = ranges[0]
+            return self.send_body(206, data[start:end + 1],
+                                  {'Content-Range': 'bytes {}-{}/{}'.format(start, end, len(data))})
+
+        body = b''
+        for start, end in ranges:
+            body += '--{}\r\nContent-Type: application/octet-stream\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(
+                BOUNDARY, start, end, len(data)
+            ).encode('latin-1')
+            body += data[start:end + 1] + b'\r\n'
+        body += '--{}--\r\n'.format(BOUNDARY).encode('latin-1')
+
+        self.send_body(206, body, {'Content-Type': 'multipart/byteranges; boundary={}'.format(BOUNDARY)})
+
+    def do_PUT(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('content-length', 0)))
+        header = self.headers.get('content-range')
+
+        with server.lock:
+            server.requests.append(header)
+
+            if not header:
+                server.uploads[self.path] = bytearray(body)
+            elif not server.ranges:
+                return self.send_body(400, b'')
+            else:
+                start, end, total = map(int, re.match(r'bytes (\d+)-(\d+)/(\d+)', header).groups())
+                upload = server.uploads.setdefault(self.path, bytearray(total))
+                upload[start:end + 1] = body
+
+        self.send_body(201, b'')
+
+    def send_body(self, status, body, headers=None):
+        self.send_response(status)
+        if self.server.metalink is not None and self.command == 'GET' and not self.path.endswith('.meta4'):
+            self.send_header('Link', '<{}.meta4>; rel=describedby; type="application/metalink4+xml"'.format(
+                self.path.rpartition('/')[2]
+            ))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+
+        if not self.server.chunked:
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i in range(0, len(body), 1000):
+            chunk = body[i:i + 1000]
+            self.wfile.write('{:x};ext=1\r\n'.format(len(chunk)).encode('latin-1') + chunk + b'\r\n')
+        self.wfile.write(b'0\r\nTrailer: value\r\n\r\n')
+
+
+class RangeServer:
+    """A local HTTP server for tests serving ``data`` at every path,
+    with support for range requests unless ``ranges`` is false and
+    for multi-range requests unless ``multipart`` is false. Bodies are
+    sent in chunks if ``chunked`` is true. Files PUT to it are kept in
+    :attr:`uploads` by path, assembled from parts with ``Content-Range``
+    headers unless ``ranges`` is false. A ``metalink`` document is served
+    next to every path with the suffix ``.meta4`` and linked to.
+    ``/redirect`` points to ``redirect``, by default the file itself. The
+    ``Authorization`` header of every GET is kept in :attr:`authorizations`.
+    """
+
+    def __init__(self, data, ranges=True, multipart=True, chunked=False, metalink=None, redirect=None):
+        self.server = ThreadingServer(('127.0.0.1', 0), RangeHandler)
+        self.server.data = data
+        self.server.ranges = ranges
+        self.server.multipart = multipart
+        self.server.chunked = chunked
+        self.server.metalink = metalink
+        self.server.redirect = redirect
+        self.server.authorizations = []
+        self.server.connections = 0
+        self.server.uploads = {}
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/file'.format(self.server.server_address[1])
+
+    @property
+    def redirect_url(self):
+        return 'http://127.0.0.1:{}/redirect'.format(self.server.server_address[1])
+
+    @property
+    def uploads(self):
+        with self.server.lock:
+            return dict((path, bytes(data)) for path, data in self.server.uploads.items())
+
+    @property
+    def authorizations(self):
+        with self.server.lock:
+            return list(self.server.authorizations)
+
+    @property
+    def requests(self):
+        with self.server.lock:
+            return list(self.server.requests)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,174 @@
+import os
+import pickle
+
+import pytest
+
+from spry import cache as cache_module, db
+from spry.cache import DownloadCache, hash_file
+from spry.http import HTTPFileSync
+
+VALIDATORS = {'etag': '"v1"', 'last-modified': 'Sat, 01 Jan 2000 00:00:00 GMT'}
+
+
+@pytest.fixture
+def cache(tmpdir, monkeypatch):
+    data_dir = str(tmpdir.join('spry'))
+    monkeypatch.setattr(db, 'DATA_DIR', data_dir)
+    monkeypatch.setattr(db, 'DB_FILE', os.path.join(data_dir, 'sessions.db'))
+    monkeypatch.setattr(db, '_engine', None)
+    db.DBSession.remove()
+
+    yield DownloadCache(os.path.join(data_dir, 'cache'), max_size=100)
+
+    db.DBSession.remove()
+
+
+def make_file(tmpdir, name, data):
+    path = str(tmpdir.join(name))
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = headers
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+
+    def get(self, url, **kwargs):
+        self.requests.append(kwargs)
+        return self.response
+
+
+class TestDownloadCache:
+    def test_store_and_lookup(self, cache, tmpdir):
+        path = make_file(tmpdir, 'f', b'spry')
+        cache.store('http://a/f', path, VALIDATORS)
+
+        entry = cache.lookup('http://a/f')
+        assert entry.digest == hash_file(path)
+        assert entry.size == 4
+        assert cache.get_validators(entry) == {
+            'If-None-Match': '"v1"', 'If-Modified-Since': 'Sat, 01 Jan 2000 00:00:00 GMT'
+        }
+
+    def test_without_validators_not_stored(self, cache, tmpdir):
+        path = make_file(tmpdir, 'f', b'spry')
+        assert cache.store('http://a/f', path, {'etag': None, 'last-modified': None}) is None
+        assert cache.lookup('http://a/f') is None
+
+    def test_same_content_stored_once(self, cache, tmpdir):
+        path = make_file(tmpdir, 'f', b'spry')
+        cache.store('http://a/f', path, VALIDATORS)
+        cache.store('http://b/f', path, VALIDATORS)
+
+        assert cache.get_size() == 4
+        assert len(os.listdir(os.path.dirname(cache.get_blob_path(hash_file(path))))) == 1
+
+    def test_changed_content_replaces_blob(self, cache, tmpdir):
+        old = make_file(tmpdir, 'old', b'spry')
+        cache.store('http://a/f', old, VALIDATORS)
+        new = make_file(tmpdir, 'new', b'SPRY')
+        cache.store('http://a/f', new, VALIDATORS)
+
+        blobs = [name for _, _, names in os.walk(cache.directory) for name in names]
+        assert blobs == [hash_file(new)]
+        assert cache.get_size() == 4
+
+    def test_shared_blob_kept_when_replaced(self, cache, tmpdir):
+        old = make_file(tmpdir, 'old', b'spry')
+        cache.store('http://a/f', old, VALIDATORS)
+        cache.store('http://b/f', old, VALIDATORS)
+        cache.store('http://a/f', make_file(tmpdir, 'new', b'SPRY'), VALIDATORS)
+
+        assert os.path.isfile(cache.get_blob_path(hash_file(old)))
+        assert cache.lookup('http://b/f') is not None
+
+    def test_failed_copy_leaves_nothing(self, cache, tmpdir, monkeypatch):
+        def clone_file(src, dst):
+            raise IOError('disk full')
+
+        monkeypatch.setattr(cache_module, 'clone_file', clone_file)
+        path = make_file(tmpdir, 'f', b'spry')
+        with pytest.raises(IOError):
+            cache.store('http://a/f', path, VALIDATORS)
+
+        assert os.listdir(os.path.dirname(cache.get_blob_path(hash_file(path)))) == []
+        assert cache.lookup('http://a/f') is None
+
+    def test_serve(self, cache, tmpdir):
+        path = make_file(tmpdir, 'f', b'spry')
+        entry = cache.store('http://a/f', path, VALIDATORS)
+
+        target = str(tmpdir.join('target'))
+        cache.serve(entry, target)
+        with open(target, 'rb') as f:
+            assert f.read() == b'spry'
+
+    def test_evicts_least_recently_used(self, cache, tmpdir):
+        first = cache.store('http://a/1', make_file(tmpdir, '1', b'1' * 40), VALIDATORS)
+        cache.store('http://a/2', make_file(tmpdir, '2', b'2' * 40), VALIDATORS)
+        cache.serve(first, str(tmpdir.join('target')))
+        cache.store('http://a/3', make_file(tmpdir, '3', b'3' * 40), VALIDATORS)
+
+        assert cache.get_size() <= cache.max_size
+        assert cache.lookup('http://a/1') is not None
+        assert cache.lookup('http://a/2') is None
+        assert cache.lookup('http://a/3') is not None
+
+    def test_missing_file_forgotten(self, cache, tmpdir):
+        entry = cache.store('http://a/f', make_file(tmpdir, 'f', b'spry'), VALIDATORS)
+        os.remove(cache.get_blob_path(entry.digest))
+
+        assert cache.lookup('http://a/f') is None
+
+    def test_picklable(self, cache):
+        copy = pickle.loads(pickle.dumps(cache))
+        assert copy.directory == cache.directory
+        assert copy.lock is not cache.lock
+
+
+class TestHTTPFileSyncCache:
+    def test_not_modified_served_from_cache(self, cache, tmpdir):
+        cache.store('http://a/f', make_file(tmpdir, 'f', b'spry'), VALIDATORS)
+        session = FakeSession(FakeResponse(304, {}))
+
+        target = str(tmpdir.join('target'))
+        transfer = HTTPFileSync('get', 'http://a/f', target, session=session, cache=cache)
+        transfer.run()
+
+        assert session.requests[0]['headers']['If-None-Match'] == '"v1"'
+        assert transfer.cache_hit
+        assert not transfer.is_alive() and transfer.success()
+        assert transfer.tracker.total == transfer.tracker.size == 4
+        with open(target, 'rb') as f:
+            assert f.read() == b'spry'
+
+    def test_finish_stores(self, cache, tmpdir):
+        path = make_file(tmpdir, 'f', b'spry')
+        transfer = HTTPFileSync('get', 'http://a/f', path, session=FakeSession(None), cache=cache)
+        transfer.validators = VALIDATORS
+        transfer.finish()
+
+        assert cache.lookup('http://a/f').size == 4
+
+    def test_finish_survives_store_error(self, cache, tmpdir, monkeypatch, caplog):
+        def store(url, path, headers):
+            raise IOError('disk full')
+
+        monkeypatch.setattr(cache, 'store', store)
+        transfer = HTTPFileSync('get', 'http://a/f', make_file(tmpdir, 'f', b'spry'), session=FakeSession(None),
+                                cache=cache)
+        transfer.validators = VALIDATORS
+        transfer.finish()
+
+        assert 'Could not cache http://a/f' in caplog.text
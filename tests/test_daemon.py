@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+
+import pytest
+
+from spry import daemon, sessions
+from spry.daemon import Daemon, DaemonClient
+from spry.http import HTTPSession
+
+DATA = os.urandom(100000)
+
+
+@pytest.fixture
+def running(monkeypatch, tmp_path):
+    monkeypatch.setattr(sessions, 'STATE_CHECK', 0.01)
+    monkeypatch.setattr(daemon, 'STATE_CHECK', 0.01)
+
+    session = HTTPSession(concurrent=1, parts=2)
+    controller = Daemon(session, str(tmp_path / 'daemon.sock'))
+
+    thread = threading.Thread(target=controller.serve_forever)
+    thread.start()
+    while not controller.is_serving:
+        time.sleep(0.01)
+
+    yield controller
+
+    if controller.is_serving:
+        controller.shutdown()
+    thread.join(5)
+
+
+def wait_for(client, transfer_id, state):
+    for _ in range(500):
+        status = client.request('status', id=transfer_id)
+        if status['state'] == state:
+            return status
+        time.sleep(0.01)
+    raise AssertionError('transfer {} never became {}'.format(transfer_id, state))
+
+
+class TestDaemon:
+    def test_get(self, running, server, tmp_path):
+        path = str(tmp_path / 'file')
+
+        with DaemonClient(running.path) as client:
+            transfer_id = client.request('get', url=server.url, path=path)['id']
+            status = wait_for(client, transfer_id, 'finished')
+
+        assert status['bytes'] == len(DATA)
+        with open(path, 'rb') as f:
+            assert f.read() == DATA
+
+    def test_cancel_queued(self, running, server, tmp_path):
+        with DaemonClient(running.path) as client:
+            client.request('pause')
+            transfer_id = client.request('get', url=server.url, path=str(tmp_path / 'file'))['id']
+
+            assert client.request('status', id=transfer_id)['state'] == 'queued'
+            client.request('priority', id=transfer_id, priority=5)
+            assert client.request('status', id=transfer_id)['priority'] == 5
+
+            client.request('stop', id=transfer_id)
+            assert client.request('status', id=transfer_id)['state'] == 'cancelled'
+            assert not running.session.unfinished
+
+    def test_cancel_deferred(self, server, tmp_path):
+        session = HTTPSession()
+        controller = Daemon(session, str(tmp_path / 'daemon.sock'))
+        transfer = session.get(server.url, str(tmp_path / 'file'), use_defaults=True)
+        controller.transfers[transfer.transfer_id] = transfer
+
+        # Put off by the space ledger instead of queued
+        session.unfinished.remove(transfer)
+        session.deferred.append(transfer)
+
+        controller.do_stop(transfer.transfer_id)
+        assert controller.do_status(transfer.transfer_id)['state'] == 'cancelled'
+        assert not session.deferred and not session.unfinished
+
+    def test_socket_private(self, running):
+        assert os.stat(running.path).st_mode & 0o077 == 0
+
+    def test_errors(self, running):
+        with DaemonClient(running.path) as client:
+            with pytest.raises(IOError):
+                client.request('stop', id=42)
+            with pytest.raises(IOError):
+                client.request('unknown')
+
+            # The connection stays usable
+            assert client.request('status')['transfers'] == []
+
+    def test_watch(self, running, server, tmp_path):
+        with DaemonClient(running.path) as watcher:
+            events = watcher.watch()
+
+            with DaemonClient(running.path) as client:
+                client.request('get', url=server.url, path=str(tmp_path / 'file'))
+
+            for event in events:
+                if event['event'] == 'finish':
+                    break
+
+        assert event['bytes'] == len(DATA)
+
+    def test_stop_shuts_down(self, running):
+        with DaemonClient(running.path) as client:
+            client.request('stop')
+
+        for _ in range(500):
+            if not os.path.exists(running.path):
+                break
+            time.sleep(0.01)
+
+        assert not os.path.exists(running.path)
+        with pytest.raises(IOError):
+            DaemonClient(running.path)
+
+    def test_refuses_second_daemon(self, running):
+        with pytest.raises(IOError):
+            Daemon(HTTPSession(), running.path).serve_forever()
@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from spry import db
+
+# Seconds allowed for `import spry.cli` in a fresh interpreter, generous
+# enough for slow CI machines but far below the cost of loading SQLAlchemy
+# and connecting to the database.
+IMPORT_BUDGET = 1.0
+
+IMPORT_SCRIPT = '''
+import sys, time
+start = time.time()
+import spry.cli
+print(time.time() - start)
+print(int(any(name.split('.')[0] == 'sqlalchemy' for name in sys.modules)))
+print(int(any(name.split('.')[0] in ('requests', 'urllib3') for name in sys.modules)))
+'''
+
+
+def measure_import():
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT])
+    elapsed, sqlalchemy_loaded, requests_loaded = output.decode().split()
+    return float(elapsed), sqlalchemy_loaded == '1', requests_loaded == '1'
+
+
+class TestLazyImports:
+    def test_database_not_loaded(self):
+        assert not measure_import()[1]
+
+    def test_import_budget(self):
+        # Best of a few runs to ignore a cold disk cache
+        results = [measure_import() for _ in range(3)]
+        assert min(elapsed for elapsed, _, _ in results) < IMPORT_BUDGET
+        assert not any(requests_loaded for _, _, requests_loaded in results)
+
+
+@pytest.fixture
+def database(tmpdir, monkeypatch):
+    data_dir = str(tmpdir.join('spry'))
+    monkeypatch.setattr(db, 'DATA_DIR', data_dir)
+    monkeypatch.setattr(db, 'DB_FILE', os.path.join(data_dir, 'sessions.db'))
+    monkeypatch.setattr(db, '_engine', None)
+    bind = db.session_factory.kw.get('bind')
+    db.DBSession.remove()
+
+    yield data_dir
+
+    # Later tests must not find sessions bound to the temporary database
+    db.DBSession.remove()
+    if db._engine is not None:
+        db._engine.dispose()
+    db.session_factory.configure(bind=bind)
+
+
+class TestGetEngine:
+    def test_created_once_on_first_use(self, database):
+        assert not os.path.exists(database)
+        engine = db.get_engine()
+        assert os.path.exists(database)
+        assert db.get_engine() is engine
+        assert db.session_factory.kw['bind'] is engine
@@ -0,0 +1,78 @@
+from spry import events, sessions
+from spry.events import EventHub
+from spry.sessions import FileSync, Session, TransferRequest
+
+
+class InstantSync(FileSync):
+    def _spawn(self, *args, **kwargs):
+        self.tracker.grow(10)
+        self.tracker.add(10)
+
+
+class BrokenSync(FileSync):
+    def _spawn(self, *args, **kwargs):
+        raise IOError('unreachable')
+
+
+class TestEventHub:
+    def test_subscribers_called(self):
+        hub = EventHub()
+        received = []
+        hub.subscribe(received.append)
+        hub.emit('test', value=1)
+
+        assert received[0]['event'] == 'test'
+        assert received[0]['value'] == 1
+        assert 'time' in received[0]
+
+    def test_unsubscribe(self):
+        hub = EventHub()
+        received = []
+        hub.subscribe(received.append)
+        hub.unsubscribe(received.append)
+        hub.emit('test')
+
+        assert not received
+
+
+class TestSessionEvents:
+    def run_session(self, monkeypatch, *transfers):
+        monkeypatch.setattr(sessions, 'STATE_CHECK', 0.01)
+        hub = EventHub()
+        received = []
+        hub.subscribe(received.append)
+
+        session = Session(hub=hub)
+        session.add_source(
+            TransferRequest(lambda url, path, cls=cls, **kwargs: cls('get', url, path, **kwargs), url, path,
+                            {'tracker': session.tracker})
+            for cls, url, path in transfers
+        )
+        session._run()
+        return received
+
+    def test_lifecycle(self, monkeypatch):
+        received = self.run_session(monkeypatch, (InstantSync, 'http://example.com/a', 'a'))
+        kinds = [event['event'] for event in received]
+
+        assert kinds[0] == events.SESSION_START
+        assert kinds[-1] == events.SESSION_FINISH
+        assert kinds.index(events.START) < kinds.index(events.FINISH)
+
+        finish = [event for event in received if event['event'] == events.FINISH][0]
+        assert finish['url'] == 'http://example.com/a'
+        assert finish['bytes'] == 10
+        assert received[-1]['finished'] == 1
+
+    def test_progress_only_when_changed(self, monkeypatch):
+        received = self.run_session(monkeypatch, (InstantSync, 'http://example.com/a', 'a'))
+        progress = [event for event in received if event['event'] == events.SESSION_PROGRESS]
+
+        assert [event['bytes'] for event in progress] == [10]
+
+    def test_error(self, monkeypatch):
+        received = self.run_session(monkeypatch, (BrokenSync, 'http://example.com/a', 'a'))
+        error = [event for event in received if event['event'] == events.ERROR][0]
+
+        assert error['error'] == 'unreachable'
+        assert received[-1]['errors'] == 1
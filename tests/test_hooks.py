@@ -0,0 +1,134 @@
+import json
+
+from spry.hooks import HookChain, Hooks, Profiler, SpanExporter, TimingHistogram
+from spry.sessions import Section
+from .test_sessions import FakeReader, FakeStreamer
+
+
+class RecordingHooks(Hooks):
+    def __init__(self):
+        self.calls = []
+
+    def on_start(self, streamer):
+        self.calls.append('start')
+
+    def on_connect(self, streamer, duration, connected):
+        self.calls.append(('connect', connected))
+
+    def on_first_byte(self, streamer, delay):
+        self.calls.append('first_byte')
+
+    def on_read(self, streamer, nbytes, duration):
+        self.calls.append(('read', nbytes))
+
+    def on_write(self, streamer, offset, nbytes, duration):
+        self.calls.append(('write', offset, nbytes))
+
+    def on_reconnect(self, streamer, attempt):
+        self.calls.append(('reconnect', attempt))
+
+    def on_section_done(self, streamer, duration):
+        self.calls.append('done')
+
+    def on_end(self, streamer):
+        self.calls.append('end')
+
+
+def run_streamer(hook, readers, size=20):
+    streamer = FakeStreamer(Section(start=0, end=size - 1, size=size), readers, hooks=HookChain([hook]))
+    streamer.run()
+    return streamer
+
+
+class TestHookChain:
+    def test_empty_is_falsy(self):
+        chain = HookChain()
+        assert not chain
+
+        chain.add(Hooks())
+        assert chain
+
+    def test_only_overridden_callbacks(self):
+        chain = HookChain([Hooks(), RecordingHooks()])
+        assert len(chain._on_read) == 1
+        assert not chain._on_limiter_wait
+
+    def test_remove(self):
+        hook = RecordingHooks()
+        chain = HookChain([hook])
+        chain.remove(hook)
+
+        assert not chain and not chain._on_read
+
+
+class TestStreamerHooks:
+    def test_lifecycle(self):
+        hook = RecordingHooks()
+        run_streamer(hook, [FakeReader([b'a' * 10] * 2)])
+
+        assert hook.calls == ['start', ('connect', True), ('read', 10), 'first_byte', ('read', 10),
+                              ('write', 0, 20), 'done', 'end']
+
+    def test_reconnect(self):
+        hook = RecordingHooks()
+        streamer = run_streamer(hook, [FakeReader([b'a' * 10], fail=True), FakeReader([b'b' * 10])])
+
+        assert streamer.is_done
+        assert ('reconnect', 2) in hook.calls
+        assert hook.calls.count('first_byte') == 2
+
+
+class TestTimingHistogram:
+    def test_percentiles(self):
+        histogram = TimingHistogram(every=1)
+        for duration in (0.001, 0.001, 0.001, 0.1):
+            histogram.record('read', duration)
+
+        assert histogram.get_percentile('read', 50) < 0.002
+        assert 0.1 <= histogram.get_percentile('read', 99) < 0.2
+        assert histogram.get_percentile('write', 50) is None
+
+    def test_sampled(self):
+        histogram = TimingHistogram(every=2)
+        run_streamer(histogram, [FakeReader([b'a' * 10] * 2)])
+
+        assert sum(count for _, count in histogram.get_histogram('read')) == 1
+        assert histogram.get_histogram('section')
+        assert 'read' in histogram.format()
+
+
+class TestProfiler:
+    def test_profiles_streamers(self, tmpdir):
+        profiler = Profiler()
+        with profiler:
+            run_streamer(profiler, [FakeReader([b'a' * 10] * 2)])
+
+        assert profiler.stats is not None
+        profiler.dump(str(tmpdir.join('run.prof')))
+        assert tmpdir.join('run.prof').check()
+
+    def test_idle_when_stopped(self):
+        profiler = Profiler()
+        run_streamer(profiler, [FakeReader([b'a' * 10] * 2)])
+        assert profiler.stats is None
+
+
+class TestSpanExporter:
+    def test_spans(self, tmpdir):
+        path = str(tmpdir.join('spans.jsonl'))
+        exporter = SpanExporter(path)
+        run_streamer(exporter, [FakeReader([b'a' * 10], fail=True), FakeReader([b'b' * 10])])
+        exporter.close()
+
+        with open(path) as f:
+            spans = [json.loads(line) for line in f]
+
+        sections = [span for span in spans if span['name'] == 'section']
+        connects = [span for span in spans if span['name'] == 'connect']
+
+        assert [span['status'] for span in sections] == ['error', 'ok']
+        assert sections[1]['attributes']['attempt'] == 2
+        assert sum(span['attributes']['bytes'] for span in sections) == 20
+        assert len(connects) == 2
+        assert len(set(span['trace_id'] for span in spans)) == 1
+        assert connects[1]['parent_span_id'] == sections[1]['span_id']
@@ -0,0 +1,12 @@
+from spry.io import FileAdapter
+
+
+class TestFileAdapter:
+    def test_write_at(self, tmpdir):
+        fp = tmpdir.join('f')
+        fp.write_binary(b'\x00' * 10)
+        writer = FileAdapter(str(fp), 'r+b', buffering=0)
+        writer.write_at(6, b'spry')
+        writer.write_at(0, bytearray(b'fast'))
+        writer.close()
+        assert fp.read_binary() == b'fast\x00\x00spry'
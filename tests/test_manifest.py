@@ -0,0 +1,179 @@
+import binascii
+import hashlib
+import os
+import time
+
+import pytest
+
+from spry import db
+from spry.http import HTTPFileSync
+from spry.manifest import Manifest, ManifestStore, get_hash_name, hash_blocks, parse_metalink
+from spry.workers import WorkerPool
+
+DATA = os.urandom(10000)
+
+BLOCK_SIZE = 1024
+
+METALINK = '''<?xml version="1.0" encoding="UTF-8"?>
+<metalink xmlns="urn:ietf:params:xml:ns:metalink">
+  <file name="other">
+    <size>1</size>
+    <pieces length="1" type="sha-256"><hash>{other}</hash></pieces>
+  </file>
+  <file name="file">
+    <size>{size}</size>
+    <url>http://mirror/file</url>
+    <pieces length="{length}" type="sha-1">{hashes}</pieces>
+  </file>
+</metalink>
+'''
+
+
+def make_metalink(data, block_size=2000):
+    hashes = ''.join(
+        '<hash>{}</hash>'.format(hashlib.sha1(data[i:i + block_size]).hexdigest())
+        for i in range(0, len(data), block_size)
+    )
+    return METALINK.format(other=hashlib.sha256(b'x').hexdigest(), size=len(data), length=block_size,
+                           hashes=hashes).encode('utf-8')
+
+
+def make_file(tmpdir, data):
+    path = str(tmpdir.join('file'))
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def corrupt(path, *offsets):
+    with open(path, 'r+b') as f:
+        for offset in offsets:
+            f.seek(offset)
+            f.write(b'\0' * 10)
+
+
+@pytest.fixture
+def store(tmpdir, monkeypatch):
+    data_dir = str(tmpdir.join('spry'))
+    monkeypatch.setattr(db, 'DATA_DIR', data_dir)
+    monkeypatch.setattr(db, 'DB_FILE', os.path.join(data_dir, 'sessions.db'))
+    monkeypatch.setattr(db, '_engine', None)
+    db.DBSession.remove()
+
+    yield ManifestStore(block_size=BLOCK_SIZE)
+
+    db.DBSession.remove()
+
+
+class TestHashBlocks:
+    def test_blocks(self, tmpdir):
+        path = make_file(tmpdir, DATA)
+        expected = [hashlib.sha256(DATA[i:i + BLOCK_SIZE]).digest() for i in range(0, len(DATA), BLOCK_SIZE)]
+
+        assert hash_blocks(path, len(DATA), BLOCK_SIZE, pool=WorkerPool(3)) == expected
+        assert hash_blocks(path, len(DATA), BLOCK_SIZE, indexes=[9, 2]) == [expected[9], expected[2]]
+
+    def test_hash_name(self):
+        assert get_hash_name('sha-256') == 'sha256'
+        with pytest.raises(ValueError):
+            get_hash_name('crc-32')
+
+
+class TestManifest:
+    def test_verify(self, tmpdir):
+        path = make_file(tmpdir, DATA)
+        manifest = Manifest.from_file(path, BLOCK_SIZE)
+        assert manifest.verify(path) == []
+
+        corrupt(path, 1500, 9990)
+        assert manifest.verify(path) == [1, 9]
+        assert manifest.get_range(9) == (9216, 9999)
+
+    def test_short_file(self, tmpdir):
+        path = make_file(tmpdir, DATA)
+        manifest = Manifest.from_file(path, BLOCK_SIZE)
+
+        with open(path, 'r+b') as f:
+            f.truncate(5000)
+        assert manifest.verify(path) == [4, 5, 6, 7, 8, 9]
+
+    def test_bytes(self, tmpdir):
+        manifest = Manifest.from_file(make_file(tmpdir, DATA), BLOCK_SIZE)
+        copy = Manifest.from_bytes(manifest.to_bytes(), manifest.size, BLOCK_SIZE)
+        assert copy.hashes == manifest.hashes
+
+    def test_wrong_number_of_hashes(self):
+        with pytest.raises(ValueError):
+            Manifest(10, 4, [b'a', b'b'])
+
+    def test_repair(self, server, tmpdir):
+        path = make_file(tmpdir, DATA)
+        manifest = Manifest.from_file(path, BLOCK_SIZE, url=server.url)
+        corrupt(path, 1500, 2100, 2500)
+
+        assert manifest.repair(path, pool=WorkerPool(2)) == [1, 2]
+        with open(path, 'rb') as f:
+            assert f.read() == DATA
+
+        # Only the broken blocks were fetched
+        assert server.requests == ['bytes=1024-3071']
+
+    def test_repair_size(self, server, tmpdir):
+        path = make_file(tmpdir, DATA[:5000] + b'extra' * 1000)
+        manifest = Manifest(len(DATA), BLOCK_SIZE, hash_blocks(make_file(tmpdir.mkdir('a'), DATA), len(DATA),
+                                                                BLOCK_SIZE))
+
+        assert manifest.repair(path, url=server.url) == [4, 5, 6, 7, 8, 9]
+        with open(path, 'rb') as f:
+            assert f.read() == DATA
+
+    def test_repair_mismatch(self, server, tmpdir):
+        path = make_file(tmpdir, DATA[::-1])
+        manifest = Manifest.from_file(path, BLOCK_SIZE, url=server.url)
+        corrupt(path, 0)
+
+        with pytest.raises(IOError):
+            manifest.repair(path)
+
+
+class TestMetalink:
+    def test_parse(self):
+        manifest = parse_metalink(make_metalink(DATA), 'file')
+
+        assert manifest.size == len(DATA)
+        assert manifest.block_size == 2000
+        assert manifest.algorithm == 'sha1'
+        assert manifest.url == 'http://mirror/file'
+        assert manifest.hashes[1] == binascii.unhexlify(hashlib.sha1(DATA[2000:4000]).hexdigest())
+
+    def test_first_file_by_default(self):
+        assert parse_metalink(make_metalink(DATA)).size == 1
+
+    def test_no_pieces(self):
+        assert parse_metalink(b'<metalink xmlns="urn:ietf:params:xml:ns:metalink"/>') is None
+
+
+class TestManifestStore:
+    def test_record_and_load(self, store, tmpdir):
+        path = make_file(tmpdir, DATA)
+        store.record('http://a/file', path)
+
+        manifest = store.load(path)
+        assert manifest.url == 'http://a/file'
+        assert manifest.block_size == BLOCK_SIZE
+        assert manifest.verify(path) == []
+        assert store.load(str(tmpdir.join('other'))) is None
+
+    def test_download_records_metalink(self, serve, store, tmpdir):
+        server = serve(DATA, metalink=make_metalink(DATA))
+        transfer = HTTPFileSync('get', server.url, str(tmpdir.join('file')), manifest=store)
+        transfer.run()
+        while transfer.is_alive():
+            time.sleep(0.01)
+        transfer.finish()
+
+        manifest = store.load(transfer.local_path)
+        assert manifest.algorithm == 'sha1'
+        assert manifest.block_size == 2000
+        assert manifest.url == server.url
+        assert manifest.verify(transfer.local_path) == []
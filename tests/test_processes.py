@@ -0,0 +1,107 @@
+import time
+
+import pytest
+
+from spry.http import HTTPSession
+from spry.processes import ProcessFileSync, ProcessGroup
+from spry.progress import ProgressTracker, SpeedLimiter, TransferStats
+from spry.sessions import FileSync
+
+
+class Member:
+    def __init__(self, priority=1):
+        self.priority = priority
+
+
+class ChunkSync(FileSync):
+    """Pretends to transfer 10 chunks of 100 bytes, or fails on request"""
+
+    def __init__(self, method, remote_path, local_path, fail=False, **kwargs):
+        super(ChunkSync, self).__init__(method, remote_path, local_path, **kwargs)
+        self.fail = fail
+        self.finished = False
+
+    def _spawn(self, *args, **kwargs):
+        if self.fail:
+            raise IOError('unreachable')
+
+        self.tracker.grow(1000)
+        for _ in range(10):
+            self.tracker.add(100)
+        self.stats.add(network=1.0)
+        self.finished = True
+
+    def is_alive(self):
+        return False
+
+    def success(self):
+        return self.finished
+
+
+def wait_until_done(transfer, seconds=60):
+    end_time = time.time() + seconds
+    while transfer.is_alive() and time.time() < end_time:
+        time.sleep(0.05)
+
+
+class TestProcessGroup:
+    def test_own_limit_when_not_promoted(self):
+        group = ProcessGroup(SpeedLimiter(limit=100))
+        assert group.get_limit(Member()) is None
+
+    def test_unlimited(self):
+        limiter = SpeedLimiter()
+        limiter.promote()
+        assert ProcessGroup(limiter).get_limit(Member()) == 0
+
+    def test_split_by_priority(self):
+        limiter = SpeedLimiter(limit=1000)
+        limiter.promote()
+        group = ProcessGroup(limiter)
+        heavy, light = Member(3), Member(1)
+        group.join(heavy)
+        group.join(light)
+        assert group.get_limit(heavy) == 750
+        assert group.get_limit(light) == 250
+        group.leave(heavy)
+        assert group.get_limit(light) == 1000
+
+
+class TestProcessFileSync:
+    def test_progress_relayed(self):
+        session_tracker = ProgressTracker()
+        session_stats = TransferStats()
+        transfer = ProcessFileSync(ChunkSync, 'get', 'http://example.com/f', 'f',
+                                   tracker=session_tracker, stats=session_stats)
+        transfer.run()
+        assert transfer.is_alive()
+        wait_until_done(transfer)
+
+        assert transfer.success()
+        assert session_tracker.total == 1000
+        assert session_tracker.size == 1000
+        assert session_stats.network == 1.0
+
+    def test_failure_in_worker(self):
+        transfer = ProcessFileSync(ChunkSync, 'get', 'http://example.com/f', 'f', fail=True)
+        transfer.run()
+        wait_until_done(transfer)
+        assert not transfer.is_alive()
+        assert not transfer.success()
+
+    def test_speed_limit(self):
+        transfer = ProcessFileSync(ChunkSync, 'get', 'http://example.com/f', 'f', speed_limit=(100, 'KiB'))
+        assert transfer.limiter.limit == 102400
+        assert transfer.kwargs['speed_limit'] == (100, 'KiB')
+
+        transfer.run()
+        wait_until_done(transfer)
+        assert transfer.success()
+
+    def test_no_host_limit(self):
+        with pytest.raises(ValueError):
+            HTTPSession(processes=True, host_limit=2)
+
+        session = HTTPSession(processes=True)
+        with pytest.raises(ValueError):
+            session.set_host_limit(2)
@@ -1,8 +1,269 @@
 from __future__ import division
 
+import threading
 import time
 
-from spry.progress import ProgressTracker
+import pytest
+
+from spry import progress
+from spry.progress import CompletionMap, ConnectionLimiter, ProgressTracker, SpaceLedger, SpeedLimiter
+
+
+class TestSpeedLimiter:
+    def test_no_limit_returns_request_size(self):
+        limiter = SpeedLimiter(request_size=10)
+        assert limiter.get() == 10
+
+    def test_limit_caps_request(self):
+        limiter = SpeedLimiter(limit=15, request_size=10)
+        assert limiter.get() == 10
+        assert limiter.get() == 5
+
+    def test_child_delegates_when_parent_promoted(self):
+        parent = SpeedLimiter(limit=15, request_size=10)
+        parent.promote()
+        child = SpeedLimiter(parent=parent)
+        child.get()
+        assert parent.requested == 10
+
+    def test_child_independent_when_parent_not_promoted(self):
+        parent = SpeedLimiter(limit=15, request_size=10)
+        child = SpeedLimiter(parent=parent)
+        child.get()
+        assert parent.requested == 0
+
+    def test_bandwidth_split_by_weight(self):
+        parent = SpeedLimiter(limit=4000, request_size=100)
+        parent.promote()
+        heavy = SpeedLimiter(parent=parent, weight=3)
+        light = SpeedLimiter(parent=parent, weight=1)
+        light.get()
+        for _ in range(30):
+            heavy.get()
+        assert parent.child_requested[heavy] == 3000
+
+        # Heavy used its share; what is left is reserved for light
+        remaining = parent.limit - parent.requested
+        assert parent._child_allowance(heavy, remaining) == 0
+        assert parent._child_allowance(light, remaining) == 900
+
+    def test_idle_child_stops_counting(self):
+        parent = SpeedLimiter(limit=1000, request_size=100)
+        parent.promote()
+        busy = SpeedLimiter(parent=parent)
+        idle = SpeedLimiter(parent=parent)
+        idle.get()
+        busy.get()
+        parent._next_window(time.time())
+        busy.get()
+        assert parent._child_allowance(busy, 900) == 400
+        parent._next_window(time.time())
+        busy.get()
+        assert parent._child_allowance(busy, 900) == 900
+
+    def test_invalid_weight_raises_error(self):
+        with pytest.raises(ValueError):
+            SpeedLimiter().set_weight(0)
+
+
+class TestConnectionLimiter:
+    def test_no_limit(self):
+        limiter = ConnectionLimiter()
+        for _ in range(100):
+            assert limiter.acquire('http://a:80', 0)
+        assert limiter.get_active('http://a:80') == 100
+
+    def test_limit_per_origin(self):
+        limiter = ConnectionLimiter(2)
+        assert limiter.acquire('http://a:80', 0)
+        assert limiter.acquire('http://a:80', 0)
+        assert not limiter.acquire('http://a:80', 0)
+        assert limiter.acquire('http://b:80', 0)
+
+    def test_release_frees_slot(self):
+        limiter = ConnectionLimiter(1)
+        limiter.acquire('http://a:80')
+        limiter.release('http://a:80')
+        assert limiter.get_active('http://a:80') == 0
+        assert limiter.acquire('http://a:80', 0)
+
+    def test_waiter_woken_by_release(self):
+        limiter = ConnectionLimiter(1)
+        limiter.acquire('http://a:80')
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(limiter.acquire('http://a:80', 5)))
+        thread.start()
+        time.sleep(0.1)
+        assert not acquired
+        limiter.release('http://a:80')
+        thread.join()
+        assert acquired == [True]
+
+    def test_acquire_later(self):
+        limiter = ConnectionLimiter(1)
+        called = []
+        assert limiter.acquire_later('http://a:80', lambda: called.append(1))
+        assert not limiter.acquire_later('http://a:80', lambda: called.append(2))
+        assert not limiter.acquire_later('http://a:80', lambda: called.append(3))
+        assert called == [1]
+
+        limiter.release('http://a:80')
+        assert called == [1, 2]
+        assert limiter.get_active('http://a:80') == 1
+
+        limiter.set_limit(3)
+        assert called == [1, 2, 3]
+        assert limiter.get_active('http://a:80') == 2
+
+    def test_cancel_waiting_callback(self):
+        limiter = ConnectionLimiter(1)
+        limiter.acquire('http://a:80')
+        callback = [].pop
+        limiter.acquire_later('http://a:80', callback)
+
+        assert limiter.cancel('http://a:80', callback)
+        assert not limiter.cancel('http://a:80', callback)
+        limiter.release('http://a:80')
+        assert limiter.get_active('http://a:80') == 0
+
+    def test_cancelled_by_interrupt(self):
+        limiter = ConnectionLimiter(1)
+        limiter.acquire('http://a:80')
+        cancel = threading.Event()
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(limiter.acquire('http://a:80', 5, cancel)))
+        thread.start()
+        time.sleep(0.1)
+
+        start_time = time.time()
+        cancel.set()
+        limiter.interrupt()
+        thread.join()
+        assert acquired == [False]
+        assert time.time() - start_time < 1
+
+    def test_raising_limit_wakes_waiters(self):
+        limiter = ConnectionLimiter(1)
+        limiter.acquire('http://a:80')
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(limiter.acquire('http://a:80', 5)))
+        thread.start()
+        time.sleep(0.1)
+        limiter.set_limit(2)
+        thread.join()
+        assert acquired == [True]
+
+
+class TestSpaceLedger:
+    @pytest.fixture(autouse=True)
+    def free_space(self, monkeypatch):
+        monkeypatch.setattr(progress, 'disk_usage', lambda path: {'total': 2000, 'used': 1000, 'free': 1000})
+
+    def test_reserve(self, tmpdir):
+        ledger = SpaceLedger()
+        assert ledger.reserve(str(tmpdir.join('a')), 600)
+        assert not ledger.reserve(str(tmpdir.join('b')), 600)
+
+    def test_release(self, tmpdir):
+        ledger = SpaceLedger()
+        ledger.reserve(str(tmpdir.join('a')), 600)
+        ledger.release(str(tmpdir.join('a')))
+
+        assert ledger.releases == 1
+        assert ledger.reserve(str(tmpdir.join('b')), 600)
+
+    def test_written_bytes_not_outstanding(self, tmpdir):
+        ledger = SpaceLedger()
+        ledger.reserve(str(tmpdir.join('a')), 600)
+
+        # Free space reported by the file system already accounts for it
+        tmpdir.join('a').write(b'a' * 600, mode='wb')
+        assert ledger.reserve(str(tmpdir.join('b')), 600)
+
+    def test_never_fits(self, tmpdir):
+        with pytest.raises(OSError):
+            SpaceLedger().reserve(str(tmpdir.join('a')), 1000)
+
+
+class TestCompletionMap:
+    def test_merges(self):
+        completed = CompletionMap(100)
+        completed.add(10, 19)
+        completed.add(30, 39)
+        completed.add(20, 29)
+        completed.add(35, 49)
+
+        assert list(completed) == [(10, 49)]
+        assert completed.completed == 40
+
+    def test_holes(self):
+        completed = CompletionMap(100)
+        completed.add(0, 99)
+        completed.remove(10, 19)
+        completed.remove(50, 50)
+
+        assert list(completed) == [(0, 9), (20, 49), (51, 99)]
+        assert completed.completed == 89
+        assert not completed.is_complete()
+
+    def test_contains(self):
+        completed = CompletionMap()
+        completed.add(10, 19)
+
+        assert completed.contains(10, 19)
+        assert completed.contains(12, 15)
+        assert not completed.contains(9, 15)
+        assert not completed.contains(15, 20)
+
+    def test_next_missing(self):
+        completed = CompletionMap(100)
+        completed.add(0, 9)
+        completed.add(20, 29)
+
+        assert completed.next_missing() == (10, 19)
+        assert completed.next_missing(15) == (15, 19)
+        assert completed.next_missing(25) == (30, 99)
+        assert list(completed.missing()) == [(10, 19), (30, 99)]
+
+        completed.add(10, 99)
+        assert completed.next_missing() is None
+        assert completed.is_complete()
+
+    def test_unknown_size(self):
+        completed = CompletionMap()
+        completed.add(10, 19)
+
+        assert list(completed.missing()) == [(0, 9)]
+
+    def test_many_intervals(self, monkeypatch):
+        monkeypatch.setattr(CompletionMap, 'CHUNK_SIZE', 4)
+
+        completed = CompletionMap(1000)
+        for start in range(0, 1000, 10):
+            completed.add(start, start + 4)
+        assert len(completed) == 100
+
+        for start in range(0, 1000, 20):
+            completed.add(start + 5, start + 9)
+        assert len(completed) == 50
+        assert completed.completed == 750
+        assert completed.next_missing(12) == (15, 19)
+
+        completed.remove(0, 499)
+        assert completed.next_missing() == (0, 499)
+        assert completed.completed == 375
+
+    def test_serialization(self):
+        completed = CompletionMap(1000)
+        for start in range(0, 1000, 10):
+            completed.add(start, start + 4)
+
+        restored = CompletionMap.from_bytes(completed.to_bytes())
+        assert list(restored) == list(completed)
+        assert restored.completed == completed.completed
+        assert restored.size == 1000
+
+        assert CompletionMap.from_bytes(CompletionMap().to_bytes()).size is None
 
 
 class TestProgressTracker:
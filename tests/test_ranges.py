@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+from spry.ranges import RangeFetcher, extract_range, parse_byteranges, plan_ranges
+
+DATA = os.urandom(100000)
+
+RANGES = [(50000, 50099), (10, 19), (0, 4), (99990, 99999), (30, 39)]
+
+INNER_RANGES = [(100, 199), (5000, 5099)]
+
+
+class TestPlanRanges:
+    def test_sorted(self):
+        sections = plan_ranges([(10, 19), (0, 4)], gap=0)
+        assert [(s.start, s.end, s.size) for s in sections] == [(0, 4, 5), (10, 19, 10)]
+
+    def test_merged_within_gap(self):
+        sections = plan_ranges([(10, 19), (0, 4), (15, 30)], gap=5)
+        assert [(s.start, s.end, s.size) for s in sections] == [(0, 30, 31)]
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            plan_ranges([(5, 4)])
+
+
+class TestParseByteranges:
+    def test_parts(self):
+        body = (
+            b'--xyz\r\nContent-Range: bytes 0-3/10\r\n\r\n--xy\r\n'
+            b'--xyz\r\nContent-Type: text/plain\r\nContent-Range: bytes 6-9/10\r\n\r\nabcd\r\n'
+            b'--xyz--\r\n'
+        )
+        assert parse_byteranges(body, 'multipart/byteranges; boundary=xyz') == [
+            (0, 3, 10, b'--xy'), (6, 9, 10, b'abcd')
+        ]
+
+    def test_no_boundary(self):
+        with pytest.raises(ValueError):
+            parse_byteranges(b'', 'multipart/byteranges')
+
+
+class TestExtractRange:
+    def test_covered(self):
+        assert extract_range([(10, 19, None, b'0123456789')], 12, 14) == b'234'
+
+    def test_not_covered(self):
+        assert extract_range([(10, 19, None, b'0123456789')], 15, 25) is None
+
+
+class TestRangeFetcher:
+    def test_multipart(self, server):
+        fetcher = RangeFetcher(server.url, gap=0)
+        assert fetcher.fetch(RANGES) == [DATA[start:end + 1] for start, end in RANGES]
+        assert len(server.requests) == 1
+
+    def test_batches(self, server):
+        fetcher = RangeFetcher(server.url, gap=0, max_ranges=2)
+        assert fetcher.fetch(RANGES) == [DATA[start:end + 1] for start, end in RANGES]
+        assert len(server.requests) == 3
+
+    def test_nearby_merged(self, server):
+        fetcher = RangeFetcher(server.url, gap=100)
+        assert fetcher.fetch(RANGES) == [DATA[start:end + 1] for start, end in RANGES]
+        assert server.requests == ['bytes=0-39,50000-50099,99990-99999']
+
+    def test_fallback_to_single_ranges(self, serve):
+        server = serve(DATA, multipart=False)
+        fetcher = RangeFetcher(server.url, gap=0)
+        assert fetcher.fetch(RANGES) == [DATA[start:end + 1] for start, end in RANGES]
+        assert not fetcher.multipart
+        assert len(server.requests) == len(RANGES)
+
+    def test_buffer_output(self, server):
+        buffer = bytearray(len(DATA))
+        RangeFetcher(server.url).fetch(RANGES, output=buffer)
+
+        for start, end in RANGES:
+            assert buffer[start:end + 1] == DATA[start:end + 1]
+        assert buffer[40:50000] == bytearray(49960)
+
+    def test_sparse_file_output(self, server, tmpdir):
+        path = str(tmpdir.join('sparse'))
+        RangeFetcher(server.url, gap=0).fetch(RANGES, output=path)
+
+        assert os.path.getsize(path) == len(DATA)
+        with open(path, 'rb') as f:
+            for start, end in RANGES:
+                f.seek(start)
+                assert f.read(end - start + 1) == DATA[start:end + 1]
+
+    def test_sparse_file_full_size(self, server, tmpdir):
+        path = str(tmpdir.join('sparse'))
+        RangeFetcher(server.url, gap=0).fetch(INNER_RANGES, output=path)
+        assert os.path.getsize(path) == len(DATA)
+
+    def test_ranges_unsupported(self, serve):
+        server = serve(DATA, ranges=False)
+        with pytest.raises(IOError):
+            RangeFetcher(server.url).fetch(RANGES)
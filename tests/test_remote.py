@@ -0,0 +1,83 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+from spry.remote import BlockCache, RemoteFile
+
+DATA = os.urandom(100000)
+
+
+class TestBlockCache:
+    def test_evicts_least_recently_used(self):
+        cache = BlockCache(2)
+        cache.put(0, b'a')
+        cache.put(1, b'b')
+        cache.get(0)
+        cache.put(2, b'c')
+
+        assert 0 in cache and 2 in cache
+        assert 1 not in cache
+
+
+class TestRemoteFile:
+    def test_size(self, server):
+        f = RemoteFile(server.url)
+        assert f.size == len(DATA)
+        assert f.seek(0, io.SEEK_END) == len(DATA)
+
+    def test_random_access(self, server):
+        f = RemoteFile(server.url, block_size=1000, read_ahead=0)
+
+        f.seek(54321)
+        assert f.read(5000) == DATA[54321:59321]
+        f.seek(-10, io.SEEK_END)
+        assert f.read() == DATA[-10:]
+        assert f.read(10) == b''
+
+    def test_only_touched_blocks_fetched(self, server):
+        f = RemoteFile(server.url, block_size=1000, read_ahead=0)
+        f.seek(5500)
+        f.read(1000)
+
+        # The size probe, then blocks 5 and 6
+        assert server.requests == ['bytes=0-0', 'bytes=5000-5999', 'bytes=6000-6999']
+
+    def test_cached_blocks_reused(self, server):
+        f = RemoteFile(server.url, block_size=1000, read_ahead=0)
+        f.read(10)
+        f.seek(0)
+        f.read(10)
+
+        assert len(server.requests) == 2
+
+    def test_read_ahead_grows_when_sequential(self, server):
+        f = RemoteFile(server.url, block_size=1000, read_ahead=8)
+        for _ in range(5):
+            f.read(1000)
+
+        assert f.read_ahead == 8
+        f.seek(90000)
+        f.read(1)
+        assert f.read_ahead == 0
+
+    def test_sequential_read(self, server):
+        f = RemoteFile(server.url, block_size=1000, read_ahead=8)
+        assert f.read() == DATA
+
+    def test_zipfile(self, serve):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            archive.writestr('a.txt', b'spry' * 1000)
+            archive.writestr('b.bin', DATA)
+
+        server = serve(buffer.getvalue())
+        with zipfile.ZipFile(RemoteFile(server.url, block_size=4096)) as archive:
+            assert archive.namelist() == ['a.txt', 'b.bin']
+            assert archive.read('a.txt') == b'spry' * 1000
+
+    def test_ranges_unsupported(self, serve):
+        server = serve(DATA, ranges=False)
+        with pytest.raises(IOError):
+            RemoteFile(server.url)
@@ -0,0 +1,117 @@
+import pytest
+
+from spry.scheduling import TransferQueue
+
+
+class Transfer:
+    def __init__(self, url='http://example.com/file', priority=1, deadline=None, size_hint=None):
+        self.remote_path = url
+        self.priority = priority
+        self.deadline = deadline
+        self.size_hint = size_hint
+
+
+def drain(queue):
+    items = []
+    while queue:
+        items.append(queue.popleft())
+    return items
+
+
+class TestTransferQueue:
+    def test_unknown_policy_raises_error(self):
+        with pytest.raises(ValueError):
+            TransferQueue('lifo')
+
+    def test_empty_pop_raises_error(self):
+        with pytest.raises(IndexError):
+            TransferQueue().popleft()
+
+    def test_fifo(self):
+        queue = TransferQueue('fifo')
+        transfers = [Transfer(priority=i + 1) for i in range(5)]
+        for transfer in transfers:
+            queue.append(transfer)
+        assert drain(queue) == transfers
+
+    def test_priority_ties_are_fifo(self):
+        queue = TransferQueue()
+        transfers = [Transfer() for _ in range(5)]
+        for transfer in transfers:
+            queue.append(transfer)
+        assert drain(queue) == transfers
+
+    def test_priority(self):
+        queue = TransferQueue()
+        low, high = Transfer(priority=1), Transfer(priority=5)
+        queue.append(low)
+        queue.append(high)
+        assert drain(queue) == [high, low]
+
+    def test_deadline_breaks_priority_ties(self):
+        queue = TransferQueue()
+        none, late, early = Transfer(), Transfer(deadline=200), Transfer(deadline=100)
+        for transfer in (none, late, early):
+            queue.append(transfer)
+        assert drain(queue) == [early, late, none]
+
+    def test_shortest_job_first(self):
+        queue = TransferQueue('sjf')
+        unknown, big, small = Transfer(), Transfer(size_hint=20 * 1024 ** 3), Transfer(size_hint=2048)
+        for transfer in (unknown, big, small):
+            queue.append(transfer)
+        assert drain(queue) == [small, big, unknown]
+
+    def test_fair_share_alternates_hosts(self):
+        queue = TransferQueue('fair')
+        a = [Transfer('http://a.com/{}'.format(i)) for i in range(3)]
+        b = [Transfer('http://b.com/{}'.format(i)) for i in range(2)]
+        for transfer in a + b:
+            queue.append(transfer)
+        assert drain(queue) == [a[0], b[0], a[1], b[1], a[2]]
+
+    def test_update_reorders(self):
+        queue = TransferQueue()
+        first, second = Transfer(), Transfer()
+        queue.append(first)
+        queue.append(second)
+        second.priority = 3
+        queue.update(second)
+        assert len(queue) == 2
+        assert drain(queue) == [second, first]
+
+    def test_update_unknown_ignored(self):
+        queue = TransferQueue()
+        queue.update(Transfer())
+        assert len(queue) == 0
+
+    def test_remove(self):
+        queue = TransferQueue()
+        first, second = Transfer(), Transfer()
+        queue.append(first)
+        queue.append(second)
+        queue.remove(first)
+        assert drain(queue) == [second]
+
+    def test_appendleft(self):
+        queue = TransferQueue()
+        first, second = Transfer(), Transfer()
+        queue.append(first)
+        queue.appendleft(second)
+        assert drain(queue) == [second, first]
+
+    def test_iteration_in_order(self):
+        queue = TransferQueue()
+        low, high = Transfer(priority=1), Transfer(priority=2)
+        queue.append(low)
+        queue.append(high)
+        assert list(queue) == [high, low]
+        assert len(queue) == 2
+
+    def test_set_policy(self):
+        queue = TransferQueue()
+        low, high = Transfer(priority=1), Transfer(priority=2)
+        queue.append(low)
+        queue.append(high)
+        queue.set_policy('fifo')
+        assert drain(queue) == [low, high]
@@ -0,0 +1,551 @@
+import os
+import threading
+import time
+
+import pytest
+
+from spry import db, progress, sessions
+from spry.progress import CompletionMap, ConnectionLimiter, Counter, ProgressTracker, SpeedLimiter, TransferStats
+from spry.sessions import FileSync, Section, Session, Streamer, TransferRequest
+from spry.workers import DiskWriter, WorkerPool
+
+
+class FakeReader:
+    def __init__(self, chunks, fail=False):
+        self.chunks = list(chunks)
+        self.fail = fail
+
+    def read(self, nbytes):
+        if self.chunks:
+            return self.chunks.pop(0)
+        elif self.fail:
+            raise IOError('connection lost')
+        return b''
+
+    def close(self):
+        pass
+
+
+class IntoReader(FakeReader):
+    """Fills buffers in place, like the raw transport"""
+
+    def readinto(self, view):
+        if not self.chunks:
+            return len(self.read(0))
+
+        chunk = self.chunks.pop(0)
+        nbytes = min(len(view), len(chunk))
+        view[:nbytes] = chunk[:nbytes]
+        if nbytes < len(chunk):
+            self.chunks.insert(0, chunk[nbytes:])
+        return nbytes
+
+
+class FakeWriter:
+    def __init__(self, error=None):
+        self.writes = []
+        self.error = error
+        self.lock = threading.Lock()
+
+    def write_at(self, offset, bytes_):
+        if self.error:
+            raise self.error
+        with self.lock:
+            self.writes.append((offset, bytes(bytes_)))
+
+    def close(self):
+        pass
+
+
+class FakeStreamer(Streamer):
+    def __init__(self, section, readers, url='http://example.com/f', **kwargs):
+        super(FakeStreamer, self).__init__(url, 'f', section, ProgressTracker(),
+                                           SpeedLimiter(), Counter(), timeout=0, **kwargs)
+        self.readers = readers
+        self.writer = FakeWriter()
+
+    def _setup(self):
+        self.reader = self.readers.pop(0)
+
+
+class TestStreamer:
+    def test_writes_coalesced(self):
+        section = Section(start=100, end=139, size=40)
+        streamer = FakeStreamer(section, [FakeReader([b'a' * 10] * 4)], buffer_size=25)
+        streamer.run()
+        assert streamer.is_done
+        assert streamer.writer.writes == [(100, b'a' * 30), (130, b'a' * 10)]
+
+    def test_unbuffered(self):
+        section = Section(start=0, end=19, size=20)
+        streamer = FakeStreamer(section, [FakeReader([b'a' * 10] * 2)], buffer_size=0)
+        streamer.run()
+        assert streamer.writer.writes == [(0, b'a' * 10), (10, b'a' * 10)]
+
+    def test_received_data_persisted_on_disconnect(self):
+        section = Section(start=0, end=39, size=40)
+        readers = [FakeReader([b'a' * 10], fail=True), FakeReader([b'b' * 30])]
+        streamer = FakeStreamer(section, readers)
+        streamer.run()
+        assert streamer.is_done
+        assert streamer.writer.writes == [(0, b'a' * 10), (10, b'b' * 30)]
+        assert streamer.tracker.total == 40
+
+    def test_records_completion(self):
+        section = Section(start=100, end=139, size=40)
+        completed = CompletionMap(200)
+        readers = [FakeReader([b'a' * 10], fail=True), FakeReader([b'b' * 30])]
+        streamer = FakeStreamer(section, readers, buffer_size=0, completed=completed)
+        streamer.run()
+
+        assert list(completed) == [(100, 139)]
+        assert completed.next_missing() == (0, 99)
+
+    def test_overflow_truncated(self):
+        section = Section(start=0, end=14, size=15)
+        streamer = FakeStreamer(section, [FakeReader([b'a' * 10] * 2)])
+        streamer.run()
+        assert streamer.writer.writes == [(0, b'a' * 15)]
+
+    def test_readinto(self):
+        section = Section(start=100, end=139, size=40)
+        streamer = FakeStreamer(section, [IntoReader([b'a' * 10] * 4)], buffer_size=25)
+        streamer.run()
+        assert streamer.is_done
+        assert streamer.writer.writes == [(100, b'a' * 30), (130, b'a' * 10)]
+
+    def test_readinto_stops_at_section_end(self):
+        section = Section(start=0, end=14, size=15)
+        reader = IntoReader([b'a' * 10] * 2)
+        streamer = FakeStreamer(section, [reader])
+        streamer.run()
+        assert streamer.writer.writes == [(0, b'a' * 15)]
+        assert reader.chunks == [b'a' * 5]
+
+    def test_readinto_buffers_handed_over(self):
+        section = Section(start=0, end=39, size=40)
+        chunks = [c * 10 for c in (b'a', b'b', b'c', b'd')]
+        streamer = FakeStreamer(section, [IntoReader(chunks)], buffer_size=10, disk=DiskWriter())
+        streamer.run()
+        assert streamer.is_done
+        assert sorted(streamer.writer.writes) == [(i * 10, chunk) for i, chunk in enumerate(chunks)]
+
+    def test_disk_writer_stage(self):
+        section = Section(start=0, end=39, size=40)
+        stats = TransferStats()
+        streamer = FakeStreamer(section, [FakeReader([b'a' * 10] * 4)], buffer_size=10,
+                                disk=DiskWriter(memory_limit=20), stats=stats)
+        streamer.run()
+        assert streamer.is_done
+        assert sorted(streamer.writer.writes) == [(i * 10, b'a' * 10) for i in range(4)]
+        assert stats.network >= 0 and stats.disk > 0
+
+    def test_disk_error_fails_section(self):
+        section = Section(start=0, end=39, size=40)
+        streamer = FakeStreamer(section, [FakeReader([b'a' * 10] * 4)], buffer_size=10, disk=DiskWriter())
+        streamer.writer.error = IOError('disk full')
+        streamer.run()
+        assert not streamer.is_done
+        assert isinstance(streamer.error, IOError)
+
+    def test_start_on_pool(self):
+        section = Section(start=0, end=19, size=20)
+        streamer = FakeStreamer(section, [FakeReader([b'a' * 10] * 2)], pool=WorkerPool(1))
+        streamer.start()
+        assert streamer.is_alive
+        for _ in range(50):
+            if streamer.is_done:
+                break
+            time.sleep(0.1)
+        assert streamer.is_done and not streamer.is_alive
+
+    def test_stopped_while_queued(self):
+        pool = WorkerPool(1)
+        release = threading.Event()
+        pool.submit(release.wait, 5)
+        section = Section(start=0, end=19, size=20)
+        streamer = FakeStreamer(section, [FakeReader([b'a' * 10] * 2)], pool=pool)
+        streamer.start()
+        streamer.stop()
+        release.set()
+        time.sleep(0.2)
+        assert not streamer.is_alive and not streamer.is_done
+        assert streamer.writer.writes == []
+
+
+    def test_busy_host_holds_no_threads(self):
+        pool = WorkerPool(2)
+        connections = ConnectionLimiter(1)
+        readers = [BlockingReader() for _ in range(3)]
+        busy = [
+            FakeStreamer(Section(start=0, end=99, size=100), [reader], url='http://a.com/f', pool=pool,
+                         connections=connections)
+            for reader in readers
+        ]
+        other = FakeStreamer(Section(start=0, end=19, size=20), [FakeReader([b'a' * 10] * 2)],
+                             url='http://b.com/f', pool=pool, connections=connections)
+
+        for streamer in busy + [other]:
+            streamer.start()
+
+        # One part of a.com runs, the others wait without a thread
+        for _ in range(50):
+            if other.is_done:
+                break
+            time.sleep(0.1)
+        assert other.is_done
+        assert connections.get_active('http://a.com:80') == 1
+
+        # Stopping the running part hands its slot to the next one
+        busy[0].stop()
+        for _ in range(50):
+            if readers[1].reads:
+                break
+            time.sleep(0.1)
+        assert readers[1].reads and not readers[2].reads
+
+        # Parts still waiting for a slot are dropped right away
+        busy[2].stop()
+        assert not busy[2].is_alive
+        busy[1].stop()
+        for _ in range(50):
+            if not connections.get_active('http://a.com:80'):
+                break
+            time.sleep(0.1)
+        assert not connections.get_active('http://a.com:80')
+        assert not readers[2].reads
+
+
+class InstantSync(FileSync):
+    def _spawn(self, *args, **kwargs):
+        pass
+
+
+class FailingSync(FileSync):
+    def _spawn(self, *args, **kwargs):
+        raise IOError('unreachable')
+
+
+class UnfinishableSync(InstantSync):
+    def finish(self):
+        raise IOError('database is locked')
+
+
+def make_sync(url, path, **kwargs):
+    return InstantSync('get', url, path, **kwargs)
+
+
+def make_failing_sync(url, path, **kwargs):
+    return FailingSync('get', url, path, **kwargs)
+
+
+def make_unfinishable_sync(url, path, **kwargs):
+    return UnfinishableSync('get', url, path, **kwargs)
+
+
+class TestSessionSources:
+    def test_pulled_lazily(self):
+        pulled = []
+
+        def requests():
+            for i in range(10):
+                pulled.append(i)
+                yield TransferRequest(make_sync, 'http://example.com/{}'.format(i), str(i), {})
+
+        session = Session(concurrent=2)
+        session.add_source(requests())
+        assert not pulled and not session.done
+
+        session._pull(2)
+        assert pulled == [0, 1]
+
+    def test_requests_created_when_started(self, monkeypatch):
+        monkeypatch.setattr(sessions, 'STATE_CHECK', 0.01)
+        session = Session(concurrent=2)
+        session.add_source(
+            TransferRequest(make_sync, 'http://example.com/{}'.format(i), str(i), {})
+            for i in range(5)
+        )
+        session._run()
+
+        assert session.done
+        assert [record.local_path for record in session.finished] == [str(i) for i in range(5)]
+
+    def test_created_with_own_hints(self):
+        kwargs = {'priority': 1, 'deadline': None, 'size_hint': None}
+        requests = [TransferRequest(make_sync, 'http://example.com/{}'.format(i), str(i), kwargs) for i in range(2)]
+        requests[0].set_priority(5)
+
+        assert requests[0].create().priority == 5
+        assert requests[1].create().priority == 1
+        assert kwargs['priority'] == 1
+
+        with pytest.raises(ValueError):
+            requests[1].set_priority(0)
+
+
+class ReservingSync(FileSync):
+    def _spawn(self, *args, **kwargs):
+        if not self.space.reserve(self.local_path, 600):
+            self.deferred = True
+            return
+        self.running_until = time.time() + 0.05
+
+    def is_alive(self):
+        return time.time() < getattr(self, 'running_until', 0)
+
+    def success(self):
+        return True
+
+
+class TestSpaceAdmission:
+    def test_deferred_until_released(self, monkeypatch, tmpdir):
+        monkeypatch.setattr(sessions, 'STATE_CHECK', 0.01)
+        monkeypatch.setattr(progress, 'disk_usage', lambda path: {'total': 2000, 'used': 1000, 'free': 1000})
+
+        session = Session(concurrent=3)
+        transfers = [ReservingSync('get', str(i), str(tmpdir.join(str(i))), space=session.space) for i in range(3)]
+        for transfer in transfers:
+            session.unfinished.append(transfer)
+        session._run()
+
+        assert len(session.finished) == 3 and not session.errors
+        assert session.done and not session.space.reservations
+
+        # Only one fit at a time, so each started after the previous ended
+        ends = sorted(transfer.running_until for transfer in transfers)
+        assert ends[1] - ends[0] >= 0.05 and ends[2] - ends[1] >= 0.05
+
+
+class TestSessionHistory:
+    def run_session(self, monkeypatch, count, **kwargs):
+        monkeypatch.setattr(sessions, 'STATE_CHECK', 0.01)
+        session = Session(concurrent=4, **kwargs)
+        session.add_source(
+            TransferRequest(make_sync, 'http://example.com/{}'.format(i), str(i), {}) for i in range(count)
+        )
+        session._run()
+        return session
+
+    def test_records_compact(self, monkeypatch):
+        session = self.run_session(monkeypatch, 1)
+        record = session.finished[0]
+
+        assert record.status == sessions.FINISHED
+        assert record.remote_path == 'http://example.com/0'
+        assert not hasattr(record, '__dict__')
+
+    def test_history_limit(self, monkeypatch):
+        session = self.run_session(monkeypatch, 6, history=2)
+        assert [record.local_path for record in session.finished] == ['4', '5']
+
+    def test_failure_keeps_error(self, monkeypatch):
+        monkeypatch.setattr(sessions, 'STATE_CHECK', 0.01)
+        session = Session()
+        session.add_source([TransferRequest(make_failing_sync, 'http://example.com/f', 'f', {})])
+        session._run()
+
+        assert session.errors[0].status == sessions.FAILED
+        assert session.errors[0].error == 'unreachable'
+
+    def test_finish_error_logged(self, monkeypatch, caplog):
+        monkeypatch.setattr(sessions, 'STATE_CHECK', 0.01)
+        session = Session()
+        session.add_source([TransferRequest(make_unfinishable_sync, 'http://example.com/f', 'f', {})])
+        session._run()
+
+        assert session.finished[0].status == sessions.FINISHED
+        assert 'Could not finish f' in caplog.text
+        assert 'database is locked' in caplog.text
+
+    @pytest.fixture
+    def database(self, monkeypatch, tmpdir):
+        data_dir = str(tmpdir.join('spry'))
+        monkeypatch.setattr(db, 'DATA_DIR', data_dir)
+        monkeypatch.setattr(db, 'DB_FILE', os.path.join(data_dir, 'sessions.db'))
+        monkeypatch.setattr(db, '_engine', None)
+        db.DBSession.remove()
+
+        yield
+
+        db.DBSession.remove()
+
+    def get_spilled(self):
+        return [transfer.local_path for transfer in db.get_db_session().query(db.Transfer).order_by(db.Transfer.id)]
+
+    def test_spill(self, monkeypatch, database):
+        session = self.run_session(monkeypatch, 6, history=2, spill=True)
+        assert self.get_spilled() == ['0', '1', '2', '3']
+        assert len(session.finished) == 2
+
+    def test_spill_without_history(self, monkeypatch, database):
+        session = self.run_session(monkeypatch, 3, history=0, spill=True)
+        assert self.get_spilled() == ['0', '1', '2']
+        assert not session.finished
+
+
+class TestSlots:
+    def test_no_instance_dict(self):
+        objects = [
+            Section(), ProgressTracker(), SpeedLimiter(), Counter(), TransferStats(),
+            Streamer('http://example.com/f', 'f', Section(), ProgressTracker(), SpeedLimiter(), Counter(), 0)
+        ]
+        for obj in objects:
+            assert not hasattr(obj, '__dict__')
+
+
+class SlowReader:
+    def read(self, nbytes):
+        time.sleep(0.005)
+        return b'a' * 1024
+
+    def close(self):
+        pass
+
+
+class RaceStreamer(Streamer):
+    def __init__(self, section, tracker, reader):
+        super(RaceStreamer, self).__init__('http://example.com/f', 'f', section, tracker, SpeedLimiter(),
+                                           Counter(), timeout=0)
+        self.reader_ = reader
+        self.writer = FakeWriter()
+
+    def _setup(self):
+        self.reader = self.reader_
+
+
+class HedgedSync(FileSync):
+    def _spawn(self, *args, **kwargs):
+        pass
+
+    def _create_streamer(self, section, tracker):
+        return RaceStreamer(section, tracker, FakeReader([b'b' * section.size]))
+
+
+class TestHedging:
+    def make_sync(self):
+        sync = HedgedSync('get', 'http://example.com/f', 'f', hedge=True)
+        now = time.time()
+
+        fast = RaceStreamer(Section(0, 0, 0), ProgressTracker(), None)
+        fast.started, fast.finished_at, fast.received, fast.is_done = now - 10, now, sessions.MEBIBYTE * 10, True
+
+        size = sessions.MEBIBYTE * 3
+        slow = RaceStreamer(Section(0, size - 1, size), sync.tracker, SlowReader())
+        sync.streamers.extend([fast, slow])
+
+        return sync, slow
+
+    def test_straggler_hedged_and_loser_stopped(self):
+        sync, slow = self.make_sync()
+        slow.start()
+        time.sleep(0.05)
+        slow.started -= 10
+
+        sync.monitor()
+        assert slow.hedge is not None
+
+        while sync.is_alive():
+            time.sleep(0.01)
+
+        assert slow.hedge.is_done and not slow.is_done
+        assert sync.success()
+        assert sync.tracker.total == slow.expected
+
+    def test_disabled(self):
+        sync, slow = self.make_sync()
+        sync.hedge = False
+        slow.start()
+        slow.started -= 10
+
+        sync.monitor()
+        slow.stop()
+        assert slow.hedge is None
+
+    def test_siblings_not_slower(self):
+        sync, slow = self.make_sync()
+        slow.started = time.time() - 10
+        slow.received = sessions.MEBIBYTE * 10
+        slow.is_alive = True
+
+        sync.monitor()
+        assert slow.hedge is None
+
+
+class BlockingReader:
+    def __init__(self):
+        self.aborted = threading.Event()
+        self.reads = 0
+
+    def read(self, nbytes):
+        self.reads += 1
+        if self.reads == 1:
+            return b'a' * 10
+
+        # Like a socket with a stalled peer, until aborted
+        self.aborted.wait(10)
+        raise IOError('connection aborted')
+
+    def abort(self):
+        self.aborted.set()
+
+    def close(self):
+        pass
+
+
+class TestPromptControl:
+    def run_until(self, streamer, condition):
+        thread = threading.Thread(target=streamer.run)
+        thread.start()
+        while not condition():
+            time.sleep(0.005)
+        return thread
+
+    def test_stop_aborts_blocked_read(self):
+        streamer = FakeStreamer(Section(start=0, end=99, size=100), [BlockingReader()], buffer_size=0)
+        thread = self.run_until(streamer, lambda: streamer.received == 10)
+        time.sleep(0.05)
+
+        start_time = time.time()
+        streamer.stop()
+        thread.join()
+
+        assert time.time() - start_time < 1
+        assert streamer.writer.writes == [(0, b'a' * 10)]
+        assert streamer.section.start == 10 and streamer.section.size == 90
+
+    def test_stop_while_paused(self):
+        streamer = FakeStreamer(Section(start=0, end=99, size=100), [BlockingReader()])
+        streamer.pause()
+        thread = self.run_until(streamer, lambda: streamer.is_alive)
+        time.sleep(0.05)
+
+        start_time = time.time()
+        streamer.stop()
+        thread.join()
+        assert time.time() - start_time < 0.5
+
+    def test_stop_while_waiting_for_connection(self):
+        connections = ConnectionLimiter(1)
+        connections.acquire('http://example.com:80')
+        streamer = FakeStreamer(Section(start=0, end=99, size=100), [BlockingReader()], connections=connections)
+        thread = self.run_until(streamer, lambda: streamer.is_alive)
+        time.sleep(0.05)
+
+        start_time = time.time()
+        streamer.stop()
+        thread.join()
+        assert time.time() - start_time < 0.5
+        assert not streamer.is_alive
+
+    def test_session_stop_wakes_loop(self):
+        session = Session()
+        session.add_source(iter([]))
+        thread = threading.Thread(target=session._run, kwargs={'forever': True})
+        thread.start()
+        time.sleep(0.05)
+
+        start_time = time.time()
+        session.stop()
+        thread.join()
+        assert time.time() - start_time < 0.5
@@ -0,0 +1,85 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from spry.progress import SpeedLimiter
+from spry.shared import SharedLimiter
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'bandwidth.json')
+
+
+def write_state(path, **processes):
+    state = {'start': time.time(), 'processes': {}}
+    for pid, entry in processes.items():
+        state['processes'][pid] = dict(dict(limit=1000, weight=1, requested=0, previous=0, seen=time.time()), **entry)
+
+    with open(path, 'w') as f:
+        json.dump(state, f)
+
+
+def get_dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return str(process.pid)
+
+
+class TestSharedLimiter:
+    def test_no_limit(self, path):
+        assert SharedLimiter(0, path).get(10) == 10
+        assert not os.path.exists(path)
+
+    def test_leases(self, path):
+        limiter = SharedLimiter(1000, path, lease_size=300)
+        assert limiter.get(100) == 100
+        assert limiter.get(500) == 200
+
+        with open(path) as f:
+            state = json.load(f)
+        assert state['processes'][str(os.getpid())]['requested'] == 300
+
+    def test_waits_for_next_window(self, path):
+        limiter = SharedLimiter(1000, path, lease_size=1000)
+        limiter.get(1000)
+
+        start = time.time()
+        assert limiter.get(1000) == 1000
+        assert time.time() - start > 0.5
+
+    def test_fair_share(self, path):
+        write_state(path, **{str(os.getppid()): {'previous': 1000}})
+        assert SharedLimiter(1000, path).get(1000) == 500
+
+    def test_weights(self, path):
+        write_state(path, **{str(os.getppid()): {'previous': 1000, 'weight': 3}})
+        assert SharedLimiter(1000, path).get(1000) == 250
+
+    def test_light_user_leaves_rest(self, path):
+        write_state(path, **{str(os.getppid()): {'previous': 100}})
+        assert SharedLimiter(1000, path).get(1000) == 800
+
+    def test_idle_process_ignored(self, path):
+        write_state(path, **{str(os.getppid()): {}})
+        assert SharedLimiter(1000, path).get(1000) == 1000
+
+    def test_reclaims_dead_process(self, path):
+        pid = get_dead_pid()
+        write_state(path, **{pid: {'previous': 1000, 'requested': 1000}})
+        assert SharedLimiter(1000, path).get(1000) == 1000
+
+        with open(path) as f:
+            assert pid not in json.load(f)['processes']
+
+    def test_lowest_limit(self, path):
+        write_state(path, **{str(os.getppid()): {'limit': 400}})
+        assert SharedLimiter(1000, path).get(1000) == 400
+
+    def test_caps_speed_limiter(self, path):
+        limiter = SpeedLimiter(request_size=10, shared=SharedLimiter(5, path))
+        assert limiter.get() == 5
@@ -0,0 +1,219 @@
+import os
+import socket
+import time
+
+import pytest
+import requests
+
+from spry import sessions, transport
+from spry.http import HTTPFileSync, HTTPSession
+from spry.transport import SPLICE, ConnectionPool, RawAdapter, supports_raw
+from spry.utils import RAW, REQUESTS
+
+DATA = os.urandom(100000)
+
+
+def test_supports_raw():
+    assert supports_raw({'headers': {}, 'verify': False})
+    assert supports_raw({'auth': requests.auth.HTTPBasicAuth('user', 'pass')})
+    assert not supports_raw({'auth': requests.auth.HTTPDigestAuth('user', 'pass')})
+    assert not supports_raw({'proxies': {}})
+
+
+class TestRawAdapter:
+    def test_range(self, server):
+        adapter = RawAdapter(server.url, headers={'range': 'bytes=10-19'})
+        assert adapter.status_code == 206
+        assert adapter.headers['content-range'] == 'bytes 10-19/{}'.format(len(DATA))
+        assert adapter.read_all() == DATA[10:20]
+        assert adapter.read(10) == b''
+
+    def test_readinto(self, server):
+        adapter = RawAdapter(server.url)
+        buffer = bytearray(len(DATA) + 10)
+        view = memoryview(buffer)
+
+        filled = 0
+        while True:
+            received = adapter.readinto(view[filled:])
+            if not received:
+                break
+            filled += received
+
+        assert filled == len(DATA)
+        assert buffer[:filled] == DATA
+
+    def test_chunked(self, serve):
+        server = serve(DATA, chunked=True)
+        pool = ConnectionPool()
+        assert RawAdapter(server.url, pool).read_all() == DATA
+        assert RawAdapter(server.url, pool, headers={'range': 'bytes=5-2004'}).read_all(3000) == DATA[5:2005]
+        assert server.server.connections == 1
+
+    def test_keep_alive(self, server):
+        pool = ConnectionPool()
+        for start in range(0, 50, 10):
+            adapter = RawAdapter(server.url, pool, headers={'range': 'bytes={}-{}'.format(start, start + 9)})
+            assert adapter.read_all(10) == DATA[start:start + 10]
+
+        assert server.server.connections == 1
+
+    def test_unfinished_response_not_reused(self, server):
+        pool = ConnectionPool()
+        adapter = RawAdapter(server.url, pool)
+        adapter.read(10)
+        adapter.close()
+
+        assert RawAdapter(server.url, pool).read_all() == DATA
+        assert server.server.connections == 2
+
+    @pytest.mark.skipif(not SPLICE, reason='needs os.splice')
+    def test_splice(self, server, tmp_path):
+        path = str(tmp_path / 'file')
+        with open(path, 'wb') as f:
+            f.truncate(len(DATA) + 10)
+
+        adapter = RawAdapter(server.url, headers={'range': 'bytes=100-'})
+        assert adapter.can_splice
+
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            offset = 10
+            while True:
+                moved = adapter.splice(fd, offset, 5000)
+                if not moved:
+                    break
+                offset += moved
+        finally:
+            os.close(fd)
+
+        with open(path, 'rb') as f:
+            assert f.read()[10:offset] == DATA[100:]
+
+    def test_no_splice_when_chunked(self, serve):
+        server = serve(DATA, chunked=True)
+        adapter = RawAdapter(server.url)
+        assert not adapter.can_splice
+        adapter.close()
+
+    def test_stale_connection_replaced(self, server):
+        pool = ConnectionPool()
+        RawAdapter(server.url, pool).read_all()
+        for connections in pool.idle.values():
+            for connection in connections:
+                connection.sock.shutdown(2)
+
+        assert RawAdapter(server.url, pool).read_all() == DATA
+
+
+class TestRawTransport:
+    def test_download(self, monkeypatch, server, tmp_path):
+        monkeypatch.setattr(sessions, 'STATE_CHECK', 0.01)
+
+        path = str(tmp_path / 'file')
+        session = HTTPSession(parts=4, transport=RAW)
+        transfer = session.get(server.redirect_url, path, use_defaults=True)
+        session._run()
+
+        assert transfer.transport == RAW
+        assert transfer.stream_url == server.url
+        assert transfer.completed.is_complete()
+        with open(path, 'rb') as f:
+            assert f.read() == DATA
+
+    def test_no_credentials_for_other_origin(self, monkeypatch, serve, server, tmp_path):
+        monkeypatch.setattr(sessions, 'STATE_CHECK', 0.01)
+
+        origin = serve(DATA, redirect=server.url)
+        path = str(tmp_path / 'file')
+        session = HTTPSession(parts=4, transport=RAW)
+        transfer = session.get(origin.redirect_url, path, use_defaults=True,
+                               auth=requests.auth.HTTPBasicAuth('user', 'pass'))
+        session._run()
+
+        assert transfer.transport == REQUESTS
+        assert all(origin.authorizations)
+        assert server.authorizations and not any(server.authorizations)
+        with open(path, 'rb') as f:
+            assert f.read() == DATA
+
+    def test_falls_back_to_requests(self, server, tmp_path):
+        session = HTTPSession()
+        transfer = session.get(server.url, str(tmp_path / 'file'), transport=RAW, proxies={})
+        assert transfer.transport == REQUESTS
+
+
+class TestUpload:
+    @pytest.fixture
+    def source(self, tmp_path):
+        path = str(tmp_path / 'source')
+        with open(path, 'wb') as f:
+            f.write(DATA)
+        return path
+
+    def send(self, monkeypatch, server, source, **kwargs):
+        monkeypatch.setattr(sessions, 'STATE_CHECK', 0.01)
+
+        session = HTTPSession()
+        transfer = session.send(server.url, source, **kwargs)
+        session._run()
+        return transfer
+
+    def test_whole_file(self, monkeypatch, server, source):
+        transfer = self.send(monkeypatch, server, source, parts=1)
+
+        assert transfer.success()
+        assert server.uploads['/file'] == DATA
+        assert server.requests == [None]
+
+    def test_parts(self, monkeypatch, server, source):
+        transfer = self.send(monkeypatch, server, source, parts=4)
+
+        assert transfer.success()
+        assert transfer.tracker.total == len(DATA)
+        assert server.uploads['/file'] == DATA
+        assert sorted(server.requests) == sorted(
+            'bytes {}-{}/{}'.format(start, start + 24999, len(DATA)) for start in range(0, len(DATA), 25000)
+        )
+
+    def test_memory_map_fallback(self, monkeypatch, server, source):
+        monkeypatch.setattr(transport, 'SENDFILE', False)
+        transfer = self.send(monkeypatch, server, source, parts=2)
+
+        assert transfer.success()
+        assert server.uploads['/file'] == DATA
+
+    def test_rejected(self, monkeypatch, serve, source):
+        server = serve(DATA, ranges=False)
+        transfer = self.send(monkeypatch, server, source, parts=2)
+
+        assert not transfer.success()
+        assert '400' in str(transfer.get_error())
+
+    def test_stop_aborts_blocked_upload(self, source):
+        # Accepts the upload but never reads it or answers
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+
+        try:
+            transfer = HTTPFileSync('send', 'http://127.0.0.1:{}/file'.format(listener.getsockname()[1]), source,
+                                    parts=1)
+            transfer.run()
+            connection, _ = listener.accept()
+            time.sleep(0.1)
+
+            start_time = time.time()
+            transfer.stop()
+            while transfer.is_alive():
+                time.sleep(0.01)
+
+            assert time.time() - start_time < 1
+            assert not transfer.success()
+            connection.close()
+        finally:
+            listener.close()
+
+    def test_needs_raw_transport(self, server, source):
+        with pytest.raises(ValueError):
+            HTTPSession().send(server.url, source, proxies={})
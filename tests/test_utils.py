@@ -24,6 +24,94 @@ class TestCreateNullFile:
         assert os.stat(fp).st_size == size
         os.remove(fp)
 
+    def test_invalid_mode_raises_error(self, tmpdir):
+        with pytest.raises(ValueError):
+            utils.create_null_file(str(tmpdir.join('f')), 10, mode='reserve')
+
+    def test_modes_correct_size(self, tmpdir):
+        size = 123456
+        for mode in (utils.PREALLOCATE_AUTO, utils.PREALLOCATE_FULL, utils.PREALLOCATE_SPARSE):
+            fp = str(tmpdir.join(mode))
+            utils.create_null_file(fp, size, mode=mode)
+            assert os.stat(fp).st_size == size
+
+    def test_mode_none_empty(self, tmpdir):
+        fp = str(tmpdir.join('f'))
+        utils.create_null_file(fp, 12345, mode=utils.PREALLOCATE_NONE)
+        assert os.stat(fp).st_size == 0
+
+    @pytest.mark.skipif(not hasattr(os, 'posix_fallocate'), reason='requires posix_fallocate')
+    def test_fallocate_allocates_blocks(self, tmpdir):
+        size = utils.MEBIBYTE * 4
+        full, sparse = str(tmpdir.join('full')), str(tmpdir.join('sparse'))
+        utils.create_null_file(full, size, mode=utils.PREALLOCATE_FULL)
+        utils.create_null_file(sparse, size, mode=utils.PREALLOCATE_SPARSE)
+        if utils.get_file_system(str(tmpdir)) not in utils.SPARSE_FILE_SYSTEMS:
+            assert os.stat(full).st_blocks * 512 >= size
+        assert os.stat(sparse).st_blocks * 512 < size
+
+    def test_existing_file_kept_when_not_overwriting(self, tmpdir):
+        fp = tmpdir.join('f')
+        fp.write_binary(b'spry')
+        utils.create_null_file(str(fp), 4, overwrite=False)
+        assert fp.read_binary() == b'spry'
+
+    def test_existing_file_wrong_size_replaced(self, tmpdir):
+        fp = tmpdir.join('f')
+        fp.write_binary(b'spry')
+        utils.create_null_file(str(fp), 5, overwrite=False)
+        assert fp.read_binary() == b'\x00' * 5
+
+    def test_existing_file_overwritten(self, tmpdir):
+        fp = tmpdir.join('f')
+        fp.write_binary(b'spry')
+        utils.create_null_file(str(fp), 4, mode=utils.PREALLOCATE_SPARSE)
+        assert fp.read_binary() == b'\x00' * 4
+
+
+class TestGetFileSystem:
+    @pytest.mark.skipif(not os.path.exists(utils.MOUNTS_FILE), reason='requires /proc')
+    def test_root(self):
+        assert utils.get_file_system(os.sep)
+
+    def test_unknown_when_no_mounts_file(self, monkeypatch):
+        monkeypatch.setattr(utils, 'MOUNTS_FILE', os.path.join(tempfile.gettempdir(), 'spry_no_such_file'))
+        assert utils.get_file_system(os.sep) is None
+
+    def test_sparse_file_systems_choose_sparse(self, monkeypatch):
+        monkeypatch.setattr(utils, 'get_file_system', lambda path: 'btrfs')
+        assert utils.get_preallocation_mode(os.sep) == utils.PREALLOCATE_SPARSE
+
+
+class TestCloneFile:
+    def test_same_contents(self, tmpdir):
+        src, dst = str(tmpdir.join('src')), str(tmpdir.join('dst'))
+        with open(src, 'wb') as f:
+            f.write(b'spry' * 1000)
+
+        assert utils.clone_file(src, dst) in ('reflink', 'copy')
+        with open(dst, 'rb') as f:
+            assert f.read() == b'spry' * 1000
+
+    def test_hardlink_allowed(self, tmpdir):
+        src, dst = str(tmpdir.join('src')), str(tmpdir.join('dst'))
+        with open(src, 'wb') as f:
+            f.write(b'spry')
+
+        if utils.clone_file(src, dst, hardlink=True) == 'hardlink':
+            assert os.path.samefile(src, dst)
+
+    def test_replaces_existing(self, tmpdir):
+        src, dst = str(tmpdir.join('src')), str(tmpdir.join('dst'))
+        with open(src, 'wb') as f:
+            f.write(b'new')
+        with open(dst, 'wb') as f:
+            f.write(b'old contents')
+
+        utils.clone_file(src, dst)
+        with open(dst, 'rb') as f:
+            assert f.read() == b'new'
+
 
 class TestGetFileNameFromHeader:
     def test_failure_returns_none(self):
@@ -38,6 +126,66 @@ class TestGetFileNameFromHeader:
         assert utils.parse_fname_from_headers(headers) == 'fname.ext'
 
 
+class TestParseContentRange:
+    def test_known_size(self):
+        assert utils.parse_content_range('bytes 0-99/1000') == (0, 99, 1000)
+
+    def test_unknown_size(self):
+        assert utils.parse_content_range('bytes 100-199/*') == (100, 199, None)
+
+    def test_invalid(self):
+        assert utils.parse_content_range(None) is None
+        assert utils.parse_content_range('bytes */1000') is None
+
+
+class TestParseMetalinkURL:
+    def test_relative(self):
+        headers = {'link': '<f.meta4>; rel=describedby; type="application/metalink4+xml"'}
+        assert utils.parse_metalink_url(headers, 'http://a/b/f') == 'http://a/b/f.meta4'
+
+    def test_among_other_links(self):
+        headers = {'link': '<http://m/f>; rel=duplicate, <http://a/f.meta4>; rel="describedby"'}
+        assert utils.parse_metalink_url(headers, 'http://a/f') == 'http://a/f.meta4'
+
+    def test_none(self):
+        assert utils.parse_metalink_url({}, 'http://a/f') is None
+        assert utils.parse_metalink_url({'link': '<http://a/f.pgp>; rel=describedby'}, 'http://a/f') is None
+
+
+class TestGetFileNameFromURL:
+    def test_last_segment(self):
+        assert utils.parse_fname_from_url('http://example.com/a/b.iso?c=d') == 'b.iso'
+
+    def test_unquoted(self):
+        assert utils.parse_fname_from_url('http://example.com/my%20file.txt') == 'my file.txt'
+
+    def test_no_name(self):
+        assert utils.parse_fname_from_url('http://example.com/') is None
+
+    def test_encoded_separators(self):
+        assert utils.parse_fname_from_url('http://example.com/a/..%2F..%2F.bashrc') == '.bashrc'
+        assert utils.parse_fname_from_url('http://example.com/a/..%5C..%5Cevil.exe') == 'evil.exe'
+
+    def test_dot_segments(self):
+        assert utils.parse_fname_from_url('http://example.com/a/%2E%2E') is None
+        assert utils.parse_fname_from_url('http://example.com/a/..%2F') is None
+        assert utils.parse_fname_from_url('http://example.com/a/.') is None
+
+
+class TestGetOrigin:
+    def test_default_port(self):
+        assert utils.get_origin('https://example.com/file.iso') == 'https://example.com:443'
+
+    def test_explicit_port(self):
+        assert utils.get_origin('http://example.com:8080/a?b=c') == 'http://example.com:8080'
+
+    def test_case_insensitive(self):
+        assert utils.get_origin('HTTP://Example.COM/a') == utils.get_origin('http://example.com/b')
+
+    def test_different_ports_differ(self):
+        assert utils.get_origin('http://example.com/') != utils.get_origin('https://example.com/')
+
+
 class TestTimestamp:
     def test_consecutive_creation_unique(self):
         num_timestamps = 1000
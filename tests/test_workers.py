@@ -0,0 +1,196 @@
+import threading
+import time
+
+import pytest
+
+from spry.progress import CompletionMap, TransferStats
+from spry.workers import DiskWriter, Latch, MemoryBudget, PendingWrites, WorkerPool
+
+
+class Writer:
+    def __init__(self, error=None):
+        self.writes = {}
+        self.error = error
+
+    def write_at(self, offset, bytes_):
+        if self.error:
+            raise self.error
+        self.writes[offset] = bytes(bytes_)
+
+
+class TestMemoryBudget:
+    def test_within_budget_no_wait(self):
+        budget = MemoryBudget(10)
+        assert budget.acquire(5) == 0
+        assert budget.acquire(5) == 0
+        assert budget.in_flight == 10
+
+    def test_oversize_allowed_when_empty(self):
+        budget = MemoryBudget(10)
+        assert budget.acquire(50) == 0
+
+    def test_blocks_until_released(self):
+        budget = MemoryBudget(10)
+        budget.acquire(8)
+        waited = []
+        thread = threading.Thread(target=lambda: waited.append(budget.acquire(5)))
+        thread.start()
+        time.sleep(0.1)
+        assert not waited
+        budget.release(8)
+        thread.join()
+        assert waited[0] > 0
+        assert budget.in_flight == 5
+
+
+class TestLatch:
+    def test_waits_for_tasks(self):
+        latch = Latch()
+        done = []
+
+        def task():
+            time.sleep(0.05)
+            done.append(1)
+            latch.done()
+
+        for _ in range(3):
+            latch.add()
+            threading.Thread(target=task).start()
+        latch.wait()
+        assert done == [1, 1, 1]
+
+    def test_first_error_raised(self):
+        latch = Latch()
+        latch.add()
+        latch.add()
+        latch.fail(IOError('first'))
+        latch.fail(ValueError('second'))
+        with pytest.raises(IOError):
+            latch.wait()
+        latch.wait()
+
+
+class TestPendingWrites:
+    def test_wait_returns_written(self):
+        pending = PendingWrites()
+        pending.add()
+        pending.done(5)
+        assert pending.wait() == 5
+        assert pending.wait() == 0
+
+    def test_wait_raises_error(self):
+        pending = PendingWrites()
+        pending.add()
+        pending.fail(IOError('disk full'))
+        with pytest.raises(IOError):
+            pending.wait()
+
+
+class TestDiskWriter:
+    def test_writes_persisted(self):
+        disk = DiskWriter(threads=2, memory_limit=10)
+        writer = Writer()
+        pending = PendingWrites()
+        stats = TransferStats()
+        for i in range(10):
+            disk.submit(writer, i * 4, bytearray(b'spry'), pending, stats)
+        assert pending.wait() == 40
+        assert writer.writes == dict((i * 4, b'spry') for i in range(10))
+        assert disk.budget.in_flight == 0
+        assert stats.disk > 0
+
+    def test_write_error_reported(self):
+        disk = DiskWriter(threads=1)
+        pending = PendingWrites()
+        disk.submit(Writer(IOError('disk full')), 0, b'spry', pending)
+        with pytest.raises(IOError):
+            pending.wait()
+        assert disk.budget.in_flight == 0
+
+    def test_completed_once_written(self):
+        disk = DiskWriter(threads=2)
+        completed = CompletionMap(40)
+        pending = PendingWrites(completed)
+        for i in range(10):
+            disk.submit(Writer(), i * 4, bytearray(b'spry'), pending)
+        pending.wait()
+        assert list(completed) == [(0, 39)]
+
+    def test_failed_write_not_completed(self):
+        disk = DiskWriter(threads=1)
+        completed = CompletionMap(4)
+        pending = PendingWrites(completed)
+        disk.submit(Writer(IOError('disk full')), 0, b'spry', pending)
+        with pytest.raises(IOError):
+            pending.wait()
+        assert list(completed) == []
+
+
+class TestWorkerPool:
+    def test_invalid_threads_raises_error(self):
+        with pytest.raises(ValueError):
+            WorkerPool(0)
+
+    def test_runs_tasks(self):
+        pool = WorkerPool(2)
+        done = threading.Event()
+        pool.submit(done.set)
+        assert done.wait(5)
+
+    def test_task_error_logged(self, caplog):
+        def fail():
+            raise IOError('disk full')
+
+        pool = WorkerPool(1)
+        done = threading.Event()
+        pool.submit(fail)
+        pool.submit(done.set)
+        assert done.wait(5)
+        assert 'disk full' in caplog.text
+
+    def test_thread_cap(self):
+        pool = WorkerPool(3)
+        release = threading.Event()
+        started = []
+        lock = threading.Lock()
+
+        def task(i):
+            with lock:
+                started.append(i)
+            release.wait(5)
+
+        for i in range(10):
+            pool.submit(task, i)
+        time.sleep(0.2)
+        assert pool.thread_count == 3
+        assert len(started) == 3
+        assert pool.pending == 7
+
+        release.set()
+        time.sleep(0.2)
+        assert sorted(started) == list(range(10))
+        assert pool.thread_count == 3
+
+    def test_long_task_does_not_block_others(self):
+        pool = WorkerPool(2)
+        release = threading.Event()
+        done = threading.Event()
+        pool.submit(release.wait, 5)
+        pool.submit(done.set)
+        assert done.wait(1)
+        release.set()
+
+    def test_idle_threads_exit(self):
+        pool = WorkerPool(2, idle_timeout=0.1)
+        done = threading.Event()
+        pool.submit(done.set)
+        done.wait(5)
+        time.sleep(0.5)
+        assert pool.thread_count == 0
+
+    def test_task_error_keeps_thread(self):
+        pool = WorkerPool(1)
+        done = threading.Event()
+        pool.submit(lambda: 1 / 0)
+        pool.submit(done.set)
+        assert done.wait(5)